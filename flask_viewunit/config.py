@@ -9,15 +9,48 @@ other setters are optional, but allow you to use additional test features.
     authentication.
 - set_db_select_hook: Optional. This allows tests to make simple database
     assertions.
+- set_db_batch_select_hook: Optional. This lets viewunit check all of a
+    run_view's database assertions with a single query.
+- set_db_execute_hook: Optional. This lets test classes declare fixtures,
+    which viewunit loads and cleans up.
+- set_db_connection_hook: Optional. This lets tests with transactional = True
+    run in a transaction that's rolled back afterwards, instead of cleaning up
+    in dbTearDown.
+- set_fixture_snapshots: Optional. For SQLite test databases, this builds
+    dbSetUpClass fixtures once and restores a snapshot of them before each
+    test.
+- set_well_formed_cache_file: Optional. This keeps expect_well_formed results
+    on disk, so unchanged pages aren't parsed again on the next run.
+- set_well_formed_workers: Optional. This checks expect_well_formed in
+    background processes, collecting the results when the test ends.
+- set_db_explain_dialect: Optional. This lets expect_no_full_scans EXPLAIN
+    the statements a view ran, through the db_select hook.
+- set_full_scan_allowlist: Optional. Tables that expect_no_full_scans lets
+    views scan, like small lookup tables.
+- set_benchmark_baseline_file: Optional. This keeps benchmark_view results
+    in a JSON file, and fails benchmarks that regress against them.
+- set_latency_ledger: Optional. This appends a record of every run_view
+    request to a ledger file, for reporting on endpoint latency over time.
+- set_replay_file: Optional. This appends every run_view request to a file,
+    which replay.py can send to the app as load.
+- set_snapshot_store: Optional. This keeps the golden responses
+    expect_snapshot compares views' responses with.
+- set_html_validator: Optional. This replaces the html5lib parse used by
+    expect_well_formed, e.g. with the faster validation.fast_check_html.
+
+Settings are process-wide, except that override() replaces them for the current
+thread within a with block, so several threads can run views against different
+apps or databases at once.
 """
+from contextlib import contextmanager
+import threading
 
 
 def set_app(app):
     """
     Set viewunit to use the given Flask app for testing
     """
-    global _APP
-    _APP = app
+    _set('app', app)
 
 
 def set_session_user_setter(setter):
@@ -30,8 +63,7 @@ def set_session_user_setter(setter):
     It should update the session such that your views will believe that user_id
     is currently logged in.
     """
-    global _SESSION_USER_SETTER
-    _SESSION_USER_SETTER = setter
+    _set('session_user_setter', setter)
 
 
 def set_db_select_hook(db_select):
@@ -44,38 +76,396 @@ def set_db_select_hook(db_select):
     It should return a list of rows, which can be dicts, tuples or dtuples
     (which you can find by googling "dtuple.py").
     """
-    global _DB_SELECT
-    _DB_SELECT = db_select
+    _set('db_select', db_select)
+
+
+def set_db_batch_select_hook(db_batch_select):
+    """
+    Set viewunit to use the given function to check all of a run_view's
+    expect_db_has/expect_db_lacks pairs in one round trip. db_batch_select will
+    be called just like the db_select hook:
+
+        db_batch_select(query, sql_parameters)
+
+    but query is always a single 'SELECT EXISTS (...) AS e0, ...' statement,
+    with one boolean column per (table, dict) pair. It should return a list
+    holding that one row (a dict, tuple or dtuple). Usually this is the same
+    function you pass to set_db_select_hook.
+
+    If no batch hook is set, viewunit runs one query per pair through the
+    db_select hook instead.
+    """
+    _set('db_batch_select', db_batch_select)
+
+
+def set_db_execute_hook(db_execute):
+    """
+    Set viewunit to use the given function to write fixtures (see
+    ViewTestMixin.fixtures). It will be called with a statement and a list of
+    parameter tuples:
+
+        db_execute(sql, seq_of_params)
+
+    and should run the statement once for each tuple, with DB-API's
+    executemany or the fastest equivalent the driver offers, then commit.
+    Like the db_select hook, placeholders are %s.
+    """
+    _set('db_execute', db_execute)
+
+
+def set_db_connection_hook(db_connect):
+    """
+    Set viewunit to use the given function to open a DB-API connection to the
+    test database, for transactional tests (see ViewTestMixin.transactional).
+    It's called with no arguments, once per test:
+
+        db_connect()
+
+    The app's database layer, dbSetUp and the db_select hook should all use
+    viewunit.get_test_connection() when it isn't None, so they share the
+    test's transaction. viewunit.transactional_connect wraps a connection
+    factory to do that for the app.
+    """
+    _set('db_connection', db_connect)
+
+
+def set_fixture_snapshots(db_file, directory):
+    """
+    Set viewunit to snapshot the fixtures built by test classes' dbSetUpClass
+    methods. db_file is the path of the SQLite database the tests run
+    against, and snapshots are kept in directory (something like
+    '.viewunit_fixtures' in your project directory), so they carry across
+    runs. See fixtures.py. Pass None for both to turn snapshots off.
+    """
+    _set('fixture_snapshots', (db_file, directory))
+
+
+def set_well_formed_cache_file(path, max_entries=10000):
+    """
+    Set viewunit to keep expect_well_formed results in a SQLite file at path
+    (something like '.viewunit_cache' in your project directory), keyed by a
+    hash of the response body. The max_entries most recently used results are
+    kept. Pass None to go back to caching only in memory.
+    """
+    _set('well_formed_cache_file', (path, max_entries))
+
+
+def set_well_formed_workers(max_workers):
+    """
+    Set viewunit to check expect_well_formed in a pool of max_workers
+    processes (0 means one per CPU). run_view doesn't wait for the check;
+    failures are reported from end_full, naming the template and path of the
+    offending page. Needs concurrent.futures (the 'futures' package on Python
+    2). Pass None to check synchronously, which is the default.
+    """
+    _set('well_formed_workers', max_workers)
+
+
+def set_html_validator(validator):
+    """
+    Set viewunit to use the given function to check that pages are well
+    formed. validator will be called as:
 
+        validator(response_data)
+
+    It should return None if the page is well formed, otherwise an
+    (error, element, line) tuple describing the first problem, where element
+    may be None. To use it with set_well_formed_workers, validator must be a
+    module-level function, so it can be pickled.
+
+    validation.check_html (html5lib, the default),
+    validation.fast_check_html (the same results, faster) and
+    validation.lenient_check_html (faster still with lxml, but misses some
+    errors) are built in. Pass None to go back to the default.
+    """
+    _set('html_validator', validator)
+
+
+def set_db_explain_dialect(dialect):
+    """
+    Set how expect_no_full_scans asks the database for query plans: 'sqlite'
+    (EXPLAIN QUERY PLAN) or 'postgres' (EXPLAIN). Plans are fetched with the
+    db_select hook, so that must be set too.
+    """
+    assert dialect in ('sqlite', 'postgres'), \
+        "Unknown explain dialect: %s" % dialect
+    _set('db_explain_dialect', dialect)
+
+
+def set_full_scan_allowlist(tables):
+    """
+    Set the tables that views may scan in full without failing
+    expect_no_full_scans=True.
+    """
+    _set('full_scan_allowlist', frozenset(tables))
+
+
+def set_benchmark_baseline_file(path, threshold=0.25):
+    """
+    Set viewunit to compare benchmark_view results with the baselines in the
+    JSON file at path (which you'd normally check in). A benchmark fails if
+    its median time is more than threshold (a fraction, so 0.25 is 25%) above
+    its baseline. Benchmarks without a baseline record one; set the
+    VIEWUNIT_UPDATE_BENCHMARKS environment variable to re-record them all.
+    """
+    _set('benchmark_baseline_file', (path, threshold))
+
+
+def set_latency_ledger(path):
+    """
+    Set viewunit to record every run_view request (URL rule, method, status,
+    time, size and template) in a SQLite ledger at path. See ledger.py for
+    reporting on it. Pass None to stop recording.
+    """
+    _set('latency_ledger', path)
+
+
+def set_replay_file(path):
+    """
+    Set viewunit to append every run_view request (path, method, session,
+    data and user_id) to the file at path, as JSON lines, for replay.py to
+    replay as load. Pass None to stop recording.
+    """
+    _set('replay_file', path)
+
+
+def set_snapshot_store(directory, headers=('Content-Type', 'Location')):
+    """
+    Set viewunit to keep expect_snapshot's golden responses in directory
+    (something like 'tests/snapshots', which you'd normally check in), and
+    to include the given response headers in them. See snapshots.py.
+    """
+    _set('snapshot_store', (directory, tuple(headers)))
+
+
+# The process-wide configuration, used unless a thread has an override active
+_DEFAULTS = {
+    'app': None,
+    'session_user_setter': None,
+    'db_select': None,
+    'db_batch_select': None,
+    'db_execute': None,
+    'db_connection': None,
+    'fixture_snapshots': (None, None),
+    'well_formed_cache_file': (None, None),
+    'well_formed_workers': None,
+    'html_validator': None,
+    'db_explain_dialect': None,
+    'full_scan_allowlist': frozenset(),
+    'benchmark_baseline_file': (None, None),
+    'latency_ledger': None,
+    'replay_file': None,
+    'snapshot_store': (None, ()),
+}
+_LOCAL = threading.local()
+
+
+@contextmanager
+def override(**hooks):
+    """
+    Override configuration for the current thread, for the duration of a with
+    block. Keyword names are the setter names without 'set_' and '_hook', e.g.
+
+        with config.override(app=other_app, db_select=other_select):
+            self.run_view('/')
+
+    Unnamed settings fall through to any enclosing override, then to the
+    process-wide configuration. While an override is active, the set_*
+    functions change the override rather than the process-wide configuration,
+    so other threads aren't affected. Overrides can be nested.
+    """
+    unknown = set(hooks) - set(_DEFAULTS)
+    assert not unknown, "Unknown viewunit config: %s" % ", ".join(unknown)
 
-_APP = None
-_SESSION_USER_SETTER = None
-_DB_SELECT = None
+    stack = _stack()
+    stack.append(dict(hooks))
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def snapshot():
+    """
+    Return the configuration the current thread sees, as a dict of override()
+    keywords, so it can be carried into threads the current one starts:
+
+        settings = config.snapshot()
+        ...
+        with config.override(**settings):
+            ...
+    """
+    return dict((name, _get(name)) for name in _DEFAULTS)
+
+
+def _stack():
+    """
+    Return the current thread's stack of override dicts
+    """
+    if not hasattr(_LOCAL, 'stack'):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+
+def _set(name, value):
+    """
+    Set a configuration value in the innermost override, if there is one, or
+    process-wide otherwise
+    """
+    stack = _stack()
+    if stack:
+        stack[-1][name] = value
+    else:
+        _DEFAULTS[name] = value
+
+
+def _get(name):
+    """
+    Get a configuration value from the innermost override that has it, or the
+    process-wide configuration
+    """
+    for hooks in reversed(_stack()):
+        if name in hooks:
+            return hooks[name]
+    return _DEFAULTS[name]
 
 
 def get_app():
     """
     Gets the currently configured app for testing
     """
-    assert _APP is not None, \
+    app = _get('app')
+    assert app is not None, \
         "Call viewunit.config.set_app() before running tests"
-    return _APP
+    return app
 
 
 def get_session_user_setter():
     """
     Gets the currently configured app for testing
     """
-    assert _SESSION_USER_SETTER is not None, \
+    setter = _get('session_user_setter')
+    assert setter is not None, \
         "Call viewunit.config.set_session_user_setter() before " + \
         "running tests"
-    return _SESSION_USER_SETTER
+    return setter
 
 
 def get_db_select_hook():
     """
     Gets the currently configured app for testing
     """
-    assert _DB_SELECT is not None, \
+    db_select = _get('db_select')
+    assert db_select is not None, \
         "Call viewunit.config.set_db_select_hook() before running tests"
-    return _DB_SELECT
+    return db_select
+
+
+def get_db_batch_select_hook():
+    """
+    Gets the currently configured batch select hook, or None if there isn't one
+    """
+    return _get('db_batch_select')
+
+
+def get_db_execute_hook():
+    """
+    Gets the currently configured execute hook
+    """
+    db_execute = _get('db_execute')
+    assert db_execute is not None, \
+        "Call viewunit.config.set_db_execute_hook() before loading fixtures"
+    return db_execute
+
+
+def get_db_connection_hook():
+    """
+    Gets the currently configured connection hook
+    """
+    db_connect = _get('db_connection')
+    assert db_connect is not None, \
+        "Call viewunit.config.set_db_connection_hook() before running " + \
+        "transactional tests"
+    return db_connect
+
+
+def get_fixture_snapshots():
+    """
+    Gets the (db_file, directory) fixture snapshots are taken of and kept in.
+    Both are None if snapshots are off.
+    """
+    return _get('fixture_snapshots')
+
+
+def get_well_formed_cache_file():
+    """
+    Gets the (path, max_entries) of the well formed cache file. path is None if
+    results are only cached in memory.
+    """
+    return _get('well_formed_cache_file')
+
+
+def get_well_formed_workers():
+    """
+    Gets the number of well formed checking processes, or None if checks run
+    synchronously
+    """
+    return _get('well_formed_workers')
+
+
+def get_html_validator():
+    """
+    Gets the configured validator, or None if the default should be used
+    """
+    return _get('html_validator')
+
+
+def get_db_explain_dialect():
+    """
+    Gets the dialect used to EXPLAIN queries
+    """
+    dialect = _get('db_explain_dialect')
+    assert dialect is not None, \
+        "Call viewunit.config.set_db_explain_dialect() before using " + \
+        "expect_no_full_scans"
+    return dialect
+
+
+def get_full_scan_allowlist():
+    """
+    Gets the set of tables views may scan in full
+    """
+    return _get('full_scan_allowlist')
+
+
+def get_benchmark_baseline_file():
+    """
+    Gets the (path, threshold) for benchmark baselines. path is None if
+    benchmarks aren't compared with baselines.
+    """
+    return _get('benchmark_baseline_file')
+
+
+def get_latency_ledger():
+    """
+    Gets the path of the latency ledger, or None if requests aren't recorded
+    """
+    return _get('latency_ledger')
+
+
+def get_replay_file():
+    """
+    Gets the path requests are recorded to for replay, or None
+    """
+    return _get('replay_file')
+
+
+def get_snapshot_store():
+    """
+    Gets the (directory, headers) of the response snapshot store
+    """
+    store = _get('snapshot_store')
+    assert store[0] is not None, \
+        "Call viewunit.config.set_snapshot_store() before using " + \
+        "expect_snapshot"
+    return store
@@ -0,0 +1,268 @@
+"""
+Database fixtures: declarative per-test rows, and snapshots of class-level
+fixtures.
+
+A test class can declare rows to load before each of its tests:
+
+    class MessageTest(ViewTestCase):
+        fixtures = {
+            'users': [{'id': 1, 'name': 'alice'}],
+            'messages': [{'user_id': 1, 'body': 'hi'}],
+        }
+        fixture_dependencies = {'messages': ['users']}
+
+Rows are inserted through the db_execute hook (see
+config.set_db_execute_hook), one executemany per table and set of columns, with
+tables loaded after the ones fixture_dependencies says they reference. After
+the test they're deleted again, in the opposite order: by their 'id' column
+(or the one fixture_keys names for the table) when every row has one, or by
+matching all of their values otherwise. Transactional tests skip the deletes,
+since their rollback takes care of it.
+
+A test class can build the fixtures all of its tests share in a dbSetUpClass
+method, rather than in dbSetUp. With config.set_fixture_snapshots pointing at
+the tests' SQLite database, dbSetUpClass only runs the first time; the
+resulting database file is saved, and copied back into place before each
+test, which is much cheaper than running the inserts again. After the test,
+the database's previous contents are put back, so nothing needs deleting in
+dbTearDown.
+
+Snapshots are saved in a directory, keyed by a hash of the source of
+dbSetUpClass and of the database's schema, so they're reused across runs until
+either changes. Changes to helper functions dbSetUpClass calls aren't noticed;
+delete the directory to rebuild everything.
+
+The database is copied over while no connections to it are open, so don't use
+snapshots with a database your tests (or app) hold connections to between
+requests. Without snapshots configured, dbSetUpClass just runs before every
+test, and dbTearDown has to clean up after it.
+"""
+import collections
+import glob
+import hashlib
+import inspect
+import os
+import sqlite3
+import tempfile
+
+from . import config
+
+# Snapshot path => database contents, for snapshots read in this process
+_SNAPSHOTS = {}
+
+# Ids deleted per statement when cleaning up fixtures
+DELETE_BATCH_SIZE = 500
+
+
+def load(tables, dependencies=None, keys=None, deletes=None):
+    """
+    Insert tables, a dict of table name => list of row dicts, through the
+    db_execute hook. dependencies is a dict of table name => names of the
+    tables it references, which are loaded first, and keys is a dict of table
+    name => key column for deleting its rows (by default, 'id'). Returns a
+    list of deletes to pass to unload.
+
+    The deletes are added to the deletes list, if one is given, as rows are
+    inserted, so if loading fails part way, unloading that list still
+    removes every row inserted.
+    """
+    execute = config.get_db_execute_hook()
+    keys = keys or {}
+    if deletes is None:
+        deletes = []
+    for table in _load_order(tables, dependencies or {}):
+        for columns, batch in _group_rows(tables[table], columns_only=True):
+            execute("INSERT INTO %s (%s) VALUES (%s)" %
+                    (table, ', '.join(columns),
+                     ', '.join(['%s'] * len(columns))),
+                    [tuple(row[column] for column in columns)
+                     for row in batch])
+            deletes.extend(_deletes(table, batch, keys.get(table, 'id')))
+    return deletes
+
+
+def unload(deletes):
+    """
+    Delete the rows load inserted, children first
+    """
+    if not deletes:
+        return
+    execute = config.get_db_execute_hook()
+    for sql, seq_of_params in reversed(deletes):
+        execute(sql, seq_of_params)
+
+
+def _load_order(tables, dependencies):
+    """
+    Return the names in tables, each after the tables it depends on
+    """
+    order = []
+
+    def visit(table, path):
+        """
+        Add table to order, after its dependencies
+        """
+        if table in order:
+            return
+        if table in path:
+            raise Exception("Fixture tables depend on each other: " +
+                            " -> ".join(path + [table]))
+        for dependency in sorted(dependencies.get(table, ())):
+            if dependency in tables:
+                visit(dependency, path + [table])
+        order.append(table)
+
+    for table in sorted(tables):
+        visit(table, [])
+    return order
+
+
+def _group_rows(rows, columns_only=False):
+    """
+    Group rows by their columns (and, unless columns_only, which of them are
+    None), keeping the order groups first appear in. Returns a list of
+    (columns, rows) pairs, with sorted columns.
+    """
+    groups = collections.OrderedDict()
+    for row in rows:
+        columns = tuple(sorted(row))
+        if columns_only:
+            shape = columns
+        else:
+            shape = (columns, tuple(row[column] is None
+                                    for column in columns))
+        groups.setdefault(shape, []).append(row)
+    return [(shape if columns_only else shape[0], group)
+            for shape, group in groups.items()]
+
+
+def _deletes(table, rows, key):
+    """
+    Return (sql, seq_of_params) statements that delete rows from table
+    """
+    if rows and all(row.get(key) is not None for row in rows):
+        deletes = []
+        for start in range(0, len(rows), DELETE_BATCH_SIZE):
+            batch = rows[start:start + DELETE_BATCH_SIZE]
+            deletes.append(("DELETE FROM %s WHERE %s IN (%s)" %
+                            (table, key, ', '.join(['%s'] * len(batch))),
+                            [tuple(row[key] for row in batch)]))
+        return deletes
+
+    deletes = []
+    for columns, group in _group_rows(rows):
+        conditions = [column + (" IS NULL" if group[0][column] is None
+                                else " = %s")
+                      for column in columns]
+        deletes.append(("DELETE FROM %s WHERE %s" %
+                        (table, " AND ".join(conditions)),
+                        [tuple(row[column] for column in columns
+                               if row[column] is not None)
+                         for row in group]))
+    return deletes
+
+
+def set_up(test):
+    """
+    Put the database in the state the test's class's dbSetUpClass builds,
+    from a snapshot if there is one. Returns a value to pass to tear_down, or
+    None if snapshots are off, in which case the caller runs dbSetUpClass.
+    """
+    db_file, directory = config.get_fixture_snapshots()
+    if db_file is None:
+        return None
+
+    base = _read(db_file)
+    path = os.path.join(directory, _snapshot_name(type(test), db_file))
+    data = _SNAPSHOTS.get(path)
+    if data is None and os.path.exists(path):
+        data = _read(path)
+    if data is None:
+        try:
+            test.dbSetUpClass()
+        except Exception:
+            # Don't leave a half-built class state behind for later tests
+            _write(db_file, base)
+            raise
+        data = _read(db_file)
+        _save(path, data)
+    else:
+        _write(db_file, data)
+    _SNAPSHOTS[path] = data
+    return (db_file, base)
+
+
+def tear_down(state):
+    """
+    Put back the database contents set_up replaced
+    """
+    if state is not None:
+        db_file, base = state
+        _write(db_file, base)
+
+
+def _snapshot_name(test_class, db_file):
+    """
+    Return the file name of test_class's snapshot, for the current schema of
+    db_file and source of its dbSetUpClass
+    """
+    method = test_class.dbSetUpClass
+    try:
+        source = inspect.getsource(method)
+    except (IOError, TypeError):
+        source = method.__func__.__code__.co_code
+
+    conn = sqlite3.connect(db_file)
+    try:
+        schema = conn.execute("SELECT sql FROM sqlite_master "
+                              "WHERE sql IS NOT NULL ORDER BY name").fetchall()
+    finally:
+        conn.close()
+
+    digest = hashlib.sha1(source)
+    for (sql,) in schema:
+        digest.update(sql.encode('utf-8'))
+    return '%s.%s-%s.db' % (test_class.__module__, test_class.__name__,
+                            digest.hexdigest()[:16])
+
+
+def _read(path):
+    """
+    Return the contents of the file at path
+    """
+    with open(path, 'rb') as snapshot:
+        return snapshot.read()
+
+
+def _write(db_file, data):
+    """
+    Replace the contents of the database at db_file with data, in place
+    """
+    with open(db_file, 'wb') as database:
+        database.write(data)
+    # A leftover rollback journal would be applied to the new contents
+    if os.path.exists(db_file + '-journal'):
+        os.remove(db_file + '-journal')
+
+
+def _save(path, data):
+    """
+    Save a new snapshot at path, replacing any older ones for the same class.
+    The file is renamed into place, so parallel runs never see it half
+    written.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    for old in glob.glob(path.rsplit('-', 1)[0] + '-*.db'):
+        if old != path:
+            os.remove(old)
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(handle, 'wb') as snapshot:
+        snapshot.write(data)
+    os.rename(temp_path, path)
@@ -0,0 +1,119 @@
+"""
+Selectors for picking values out of decoded JSON, for expect_json_has and
+expect_json_data.
+
+A selector is a small subset of JSONPath: keys separated by dots, list
+indexes (negative ones count from the end) and * wildcards in brackets, and
+an optional leading $ for the document itself:
+
+    users[0].name
+    $.users[*].messages[-1]
+    counts.*
+    ["key.with.dots"]
+
+Each selector is parsed once and cached, and select only walks the parts of
+the document it names.
+"""
+import re
+
+# Selectors parsed so far
+_CACHE = {}
+_CACHE_SIZE = 1000
+
+# One step of a selector: .key, .*, [index], [*] or ["key"]
+_STEP = re.compile(r"""\.(\*|[^.\[\]]+)"""
+                   r"""|\[(\*|-?\d+|'[^']*'|"[^"]*")\]""")
+
+
+class _All(object):
+    """
+    The step that matches every element or value. It's a sentinel rather
+    than the string '*', so that a quoted '*' key is just a key.
+    """
+
+    def __repr__(self):
+        return '*'
+
+
+ALL = _All()
+
+
+def parse(selector):
+    """
+    Return selector's steps, a tuple of keys, list indexes and ALLs. Raises
+    an Exception if it isn't a selector.
+    """
+    steps = _CACHE.get(selector)
+    if steps is None:
+        if len(_CACHE) >= _CACHE_SIZE:
+            _CACHE.clear()
+        steps = _CACHE[selector] = _parse(selector)
+    return steps
+
+
+def _parse(selector):
+    """
+    Parse selector into steps
+    """
+    text = selector[1:] if selector.startswith('$') else selector
+    if text and text[0] not in '.[':
+        text = '.' + text
+
+    steps = []
+    position = 0
+    while position < len(text):
+        match = _STEP.match(text, position)
+        if match is None:
+            raise Exception("Bad JSON selector %r at %r" %
+                            (selector, text[position:]))
+        key, index = match.groups()
+        if key == '*' or index == '*':
+            steps.append(ALL)
+        elif key is not None:
+            steps.append(key)
+        elif index[0] in '\'"':
+            steps.append(index[1:-1])
+        else:
+            steps.append(int(index))
+        position = match.end()
+    return tuple(steps)
+
+
+def has_wildcard(steps):
+    """
+    Return whether steps can select more than one value
+    """
+    return any(step is ALL for step in steps)
+
+
+def select(document, steps):
+    """
+    Return a list of (path, value) pairs for the values in document that
+    steps select, where path is the tuple of keys and indexes leading to
+    the value. Steps that don't lead anywhere select nothing.
+    """
+    found = [((), document)]
+    for step in steps:
+        found = [(path + (key,), value)
+                 for path, node in found
+                 for key, value in _children(node, step)]
+        if not found:
+            break
+    return found
+
+
+def _children(node, step):
+    """
+    Return the (key or index, value) pairs in node that step selects
+    """
+    if isinstance(node, dict):
+        if step is ALL:
+            return sorted(node.items())
+        if not isinstance(step, int) and step in node:
+            return [(step, node[step])]
+    elif isinstance(node, list):
+        if step is ALL:
+            return list(enumerate(node))
+        if isinstance(step, int) and -len(node) <= step < len(node):
+            return [(step % len(node), node[step])]
+    return []
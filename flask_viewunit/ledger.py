@@ -0,0 +1,167 @@
+"""
+A passive latency ledger for view tests.
+
+With config.set_latency_ledger set, every request made by run_view (and
+scenarios, run_view_many and benchmark_view's checked request) appends a small
+record to a SQLite ledger file: the URL rule, method, status, request time,
+response size and template. Records are buffered in memory and written in
+batches, so the suite isn't slowed down.
+
+Each test process is one run. Report on the latest run, compared with the one
+before it, with:
+
+    python -m flask_viewunit.ledger LEDGER_FILE [--top N]
+"""
+import atexit
+import optparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+# Records are written once this many are buffered, and at exit
+FLUSH_EVERY = 1000
+
+# Identifies this run in the ledger. Forked workers (see runner.py) share it,
+# since they inherit this module from the parent.
+RUN = '%s-%d' % (time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (run TEXT, rule TEXT, method TEXT,
+                                    status INTEGER, ms REAL, bytes INTEGER,
+                                    template TEXT);
+CREATE INDEX IF NOT EXISTS records_run ON records (run);
+"""
+
+# Records waiting to be written, and the ledger they're for
+_BUFFER = []
+_PATH = None
+_LOCK = threading.RLock()
+
+
+def record(path, rule, method, status, ms, nbytes, template):
+    """
+    Add a record to the ledger at path
+    """
+    global _PATH
+    with _LOCK:
+        if _PATH != path:
+            flush()
+            _PATH = path
+        _BUFFER.append((RUN, rule, method, status, ms, nbytes, template))
+        if len(_BUFFER) >= FLUSH_EVERY:
+            flush()
+
+
+def flush():
+    """
+    Write buffered records to the ledger. This runs at exit, but processes
+    that skip exit handlers (like multiprocessing children) must call it.
+    """
+    with _LOCK:
+        if _PATH is None or not _BUFFER:
+            return
+
+        conn = sqlite3.connect(_PATH, timeout=30)
+        try:
+            conn.executescript(_SCHEMA)
+            with conn:
+                conn.executemany(
+                    "INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    _BUFFER)
+        finally:
+            conn.close()
+        del _BUFFER[:]
+
+
+atexit.register(flush)
+
+
+def report(path, top=10, out=None):
+    """
+    Print a report on the latest run in the ledger at path: its slowest
+    endpoints, the time distribution of every route, and how each route's
+    median changed since the previous run.
+    """
+    from .viewunit import percentile
+
+    out = out or sys.stdout
+    conn = sqlite3.connect(path)
+    try:
+        runs = [run for (run,) in conn.execute(
+            "SELECT run FROM records GROUP BY run ORDER BY MIN(rowid) DESC "
+            "LIMIT 2")]
+        if not runs:
+            out.write("No records in %s\n" % path)
+            return
+        latest = _route_times(conn, runs[0])
+        previous = _route_times(conn, runs[1]) if len(runs) > 1 else {}
+    finally:
+        conn.close()
+
+    stats = {}
+    for route, times in latest.items():
+        stats[route] = (len(times), min(times), percentile(times, 50),
+                        percentile(times, 95), max(times))
+
+    out.write("Run %s: %d requests to %d routes" % (
+        runs[0], sum(len(times) for times in latest.values()), len(latest)))
+    out.write(", compared with run %s\n" % runs[1] if previous else "\n")
+
+    out.write("\nSlowest endpoints (by p95):\n")
+    slowest = sorted(stats, key=lambda route: -stats[route][3])[:top]
+    for route in slowest:
+        out.write("  %9.2f ms  %s\n" % (stats[route][3], route))
+
+    out.write("\n  %-40s %6s %9s %9s %9s %9s %9s %8s\n" % (
+        'route', 'count', 'min', 'p50', 'p95', 'max', 'prev p50', 'change'))
+    for route in sorted(stats):
+        count, low, median, p95, high = stats[route]
+        if route in previous:
+            prev_median = percentile(previous[route], 50)
+            prev = "%9.2f" % prev_median
+            change = "%+7.0f%%" % ((median / prev_median - 1) * 100
+                                   if prev_median else 0)
+        else:
+            prev, change = "%9s" % '-', "%8s" % 'new'
+        out.write("  %-40s %6d %9.2f %9.2f %9.2f %9.2f %s %s\n" % (
+            route, count, low, median, p95, high, prev, change))
+
+    gone = sorted(set(previous) - set(latest))
+    if gone:
+        out.write("\nRoutes not requested in this run:\n")
+        for route in gone:
+            out.write("  %s\n" % route)
+
+
+def _route_times(conn, run):
+    """
+    Return a dict of 'METHOD rule' => list of request milliseconds for run
+    """
+    times = {}
+    for rule, method, ms in conn.execute(
+            "SELECT rule, method, ms FROM records WHERE run = ?", (run,)):
+        times.setdefault("%s %s" % (method, rule), []).append(ms)
+    return times
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    """
+    parser = optparse.OptionParser(
+        usage='%prog [options] LEDGER_FILE',
+        description='Report on the latest run in a viewunit latency ledger.')
+    parser.add_option('--top', type='int', default=10,
+                      help='slowest endpoints to list (default: %default)')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('expected a ledger file')
+
+    report(args[0], top=options.top)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,228 @@
+"""
+Compiled matchers for the data containment expects (expect_tmpl_data,
+expect_session_data and friends).
+
+An expected value is compiled once into a tree of matchers, which is cached by
+the value's contents, so repeated checks against the same spec (in loops,
+run_view_many tables, benchmark_view) don't walk and inspect it again.
+Matching collects every mismatch, as Mismatch(path, kind, expected, actual)
+tuples, and leaves formatting them to describe, which is only needed on
+failure.
+
+Containment works as it always has: a dict matches if each of its keys is
+found in the actual object (as an attribute, called if it's callable, or else
+as a key) with a matching value, and a list matches a list of the same length
+whose elements match in order. Anything else must be equal.
+"""
+import collections
+import pprint
+
+# Specs compiled so far, by frozen contents
+_CACHE = {}
+_CACHE_SIZE = 1000
+
+# Keys that are also dict attributes, which are looked up as attributes
+_DICT_ATTRS = frozenset(dir(dict))
+
+# A difference between an expected and an actual value. path is a tuple of
+# keys and list indexes; kind is 'unequal', 'missing' (a key), 'no_attr'
+# (neither key nor attribute found) or 'length' (of a list, where expected
+# is the expected length).
+Mismatch = collections.namedtuple('Mismatch',
+                                  ['path', 'kind', 'expected', 'actual'])
+
+
+def diff(expected, actual):
+    """
+    Return a list of the ways actual doesn't contain expected, as Mismatches
+    """
+    mismatches = []
+    compile_expectation(expected).match(actual, (), mismatches)
+    return mismatches
+
+
+def compile_expectation(expected):
+    """
+    Return the matcher for expected, compiling it if it hasn't been seen
+    """
+    try:
+        key = _freeze(expected)
+        matcher = _CACHE.get(key)
+    except TypeError:
+        # Something unhashable in there; compile it every time
+        return _compile(expected)
+
+    if matcher is None:
+        if len(_CACHE) >= _CACHE_SIZE:
+            _CACHE.clear()
+        matcher = _CACHE[key] = _compile(expected)
+    return matcher
+
+
+def describe(name, mismatches):
+    """
+    Return a failure message for the mismatches found checking the expect
+    called name
+    """
+    lines = [_describe_one(name, mismatch) for mismatch in mismatches]
+    if len(lines) == 1:
+        return lines[0]
+    return "%s didn't match (%d differences):\n%s" % (
+        name, len(lines), "\n".join(_indent(line, "  ") for line in lines))
+
+
+def _describe_one(name, mismatch):
+    """
+    Return a message for one mismatch
+    """
+    path = _show_path(name, mismatch.path)
+    if mismatch.kind == 'missing':
+        return "%s: missing key" % path
+    if mismatch.kind == 'no_attr':
+        return "%s: missing attr/method" % path
+    if mismatch.kind == 'length':
+        return "%s: expected a list of %d, found %d:\n%s" % (
+            path, mismatch.expected, len(mismatch.actual),
+            _indent(pprint.pformat(mismatch.actual), "    "))
+    return "%s: expected %r, found %r" % (path, mismatch.expected,
+                                          mismatch.actual)
+
+
+def _show_path(name, path):
+    """
+    Return a path as name.key[index].key
+    """
+    parts = [name]
+    for step in path:
+        if isinstance(step, int):
+            parts.append("[%d]" % step)
+        else:
+            parts.append(".%s" % (step,))
+    return "".join(parts)
+
+
+def _indent(text, prefix):
+    """
+    Indent each line of text for a failure message
+    """
+    return "\n".join(prefix + line for line in text.splitlines())
+
+
+def _freeze(value):
+    """
+    Return a hashable equivalent of an expected value, or raise TypeError
+    """
+    if isinstance(value, dict):
+        return (dict, frozenset((key, _freeze(val))
+                                for key, val in value.items()))
+    if isinstance(value, list):
+        return (list, tuple(_freeze(val) for val in value))
+    hash(value)
+    return (type(value), value)
+
+
+def _compile(expected):
+    """
+    Build the matcher tree for expected
+    """
+    if isinstance(expected, dict):
+        return _Contains([(key, _compile(val))
+                          for key, val in expected.items()])
+    if isinstance(expected, list):
+        return _ListOf(expected, [_compile(val) for val in expected])
+    return _Equals(expected)
+
+
+class _Equals(object):
+    """
+    Matches a value equal to the expected one
+    """
+
+    def __init__(self, expected):
+        self._expected = expected
+
+    def match(self, actual, path, mismatches):
+        """
+        Add a Mismatch to mismatches unless actual matches
+        """
+        # Not !=, which Python 2 doesn't derive from __eq__
+        if not self._expected == actual:
+            mismatches.append(Mismatch(path, 'unequal', self._expected,
+                                       actual))
+
+
+class _Contains(object):
+    """
+    Matches an object with matching values at each of some keys or attributes
+    """
+
+    def __init__(self, items):
+        # (key, matcher, whether the key can be looked up directly in a dict)
+        self._items = [(key, matcher,
+                        not isinstance(key, basestring) or
+                        key not in _DICT_ATTRS)
+                       for key, matcher in items]
+
+    def match(self, actual, path, mismatches):
+        """
+        Add Mismatches for each key that's missing or doesn't match
+        """
+        is_dict = type(actual) is dict
+        for key, matcher, plain_key in self._items:
+            if is_dict and plain_key:
+                if key not in actual:
+                    mismatches.append(Mismatch(path + (key,), 'missing', None,
+                                               actual))
+                    continue
+                value = actual[key]
+            else:
+                kind, value = _lookup(actual, key)
+                if kind is not None:
+                    mismatches.append(Mismatch(path + (key,), kind, None,
+                                               actual))
+                    continue
+            matcher.match(value, path + (key,), mismatches)
+
+
+def _lookup(obj, key):
+    """
+    Find key in obj the way templates do: as an attribute (called, if it's a
+    method) or else as a key. Returns (None, value), or (mismatch kind, None)
+    if it isn't there.
+    """
+    if isinstance(key, basestring) and hasattr(obj, key):
+        value = getattr(obj, key)
+        if callable(value):
+            value = value()
+        return None, value
+    if hasattr(obj, '__contains__'):
+        if key not in obj:
+            return 'missing', None
+        return None, obj[key]
+    return 'no_attr', None
+
+
+class _ListOf(object):
+    """
+    Matches a sequence of the same length, whose elements match in order
+    """
+
+    def __init__(self, expected, matchers):
+        self._expected = expected
+        self._matchers = matchers
+
+    def match(self, actual, path, mismatches):
+        """
+        Add Mismatches for a length difference, and each element that doesn't
+        match
+        """
+        if not hasattr(actual, '__len__'):
+            mismatches.append(Mismatch(path, 'unequal', self._expected,
+                                       actual))
+            return
+        if len(self._matchers) != len(actual):
+            mismatches.append(Mismatch(path, 'length', len(self._matchers),
+                                       actual))
+        for index, (matcher, value) in enumerate(zip(self._matchers,
+                                                     actual)):
+            matcher.match(value, path + (index,), mismatches)
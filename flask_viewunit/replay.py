@@ -0,0 +1,309 @@
+"""
+Load replay: reuse a test run's requests as a load generator.
+
+With config.set_replay_file set, every run_view (and run_view_many spec, and
+benchmark_view) appends the request it makes (path, method, session, data and
+user_id), and the status it got, to a file, one JSON object per line.
+Replaying the file sends those requests to config.get_app() from several
+threads (and optionally forked processes) for a fixed time, and reports
+throughput, latency percentiles and error rate per route. Contention on locks
+and global state shows up as throughput that doesn't grow with the thread
+count.
+
+From Python, after configuring viewunit:
+
+    results = replay.replay(replay.load('requests.jsonl'), duration=30,
+                            threads=8)
+    replay.report(results)
+
+From the command line:
+
+    python -m flask_viewunit.replay --setup app_test -t 8 -d 30 requests.jsonl
+
+Requests are replayed independently, each with a fresh session, with the
+app's testing and CSRF_ENABLED settings changed as they are for tests, and
+aren't checked against any expects. A response whose status differs from the
+recorded one (or, for requests recorded without one, a 5xx), or an exception
+from the app, counts as an error.
+"""
+import json
+import multiprocessing
+import optparse
+import sys
+import threading
+import time
+import urlparse
+
+from werkzeug.exceptions import HTTPException
+
+from . import config
+
+_LOCK = threading.Lock()
+
+
+def record(path, method, session, data, user_id, status=None):
+    """
+    Append a request, and the status it got, to the replay file, if one is
+    configured. Requests whose session or data can't be written as JSON (like
+    file uploads) are left out.
+    """
+    replay_file = config.get_replay_file()
+    if replay_file is None:
+        return
+
+    try:
+        line = json.dumps({'path': path, 'method': method, 'session': session,
+                           'data': data, 'user_id': user_id,
+                           'status': status})
+    except (TypeError, ValueError):
+        return
+    with _LOCK:
+        with open(replay_file, 'a') as out:
+            out.write(line + '\n')
+
+
+def load(path):
+    """
+    Return the list of requests recorded in the replay file at path
+    """
+    with open(path) as recording:
+        return [json.loads(line) for line in recording if line.strip()]
+
+
+def replay(requests, duration=10.0, threads=4, processes=1):
+    """
+    Send requests (dicts as returned by load) to the app, round-robin, from
+    threads threads in each of processes processes, for duration seconds.
+
+    Returns a dict of 'METHOD rule' => dict of count, errors, error_rate,
+    throughput (requests per second) and min, p50, p95, p99 and max in
+    milliseconds. The key None holds the totals over all routes.
+    """
+    assert requests, "Nothing to replay"
+    app = config.get_app()
+    routes = [_route(app, request['path'], request.get('method', 'GET'))
+              for request in requests]
+
+    settings = config.snapshot()
+    # As in ViewTestMixin.start_full, so requests get the responses they did
+    # in the tests
+    was_testing = app.testing
+    old_csrf_enabled = app.config.get('CSRF_ENABLED')
+    app.testing = True
+    app.config['CSRF_ENABLED'] = False
+    try:
+        outcomes, elapsed = _replay_all(settings, requests, routes, duration,
+                                        threads, processes)
+    finally:
+        app.config['CSRF_ENABLED'] = old_csrf_enabled
+        app.testing = was_testing
+
+    merged = {}
+    for outcome in outcomes:
+        for route, (times, errors) in outcome.items():
+            merged_times, merged_errors = merged.setdefault(route, ([], [0]))
+            merged_times.extend(times)
+            merged_errors[0] += errors
+
+    results = {}
+    all_times = []
+    all_errors = 0
+    for route, (times, errors) in merged.items():
+        results[route] = _stats(times, errors[0], elapsed)
+        all_times.extend(times)
+        all_errors += errors[0]
+    results[None] = _stats(all_times, all_errors, elapsed)
+    return results
+
+
+def _replay_all(settings, requests, routes, duration, threads, processes):
+    """
+    Replay from every thread and process, and return a list of each
+    process's outcome (see _replay_threads) and the seconds it took
+    """
+    start = time.time()
+    if processes > 1:
+        queue = multiprocessing.Queue()
+        workers = [multiprocessing.Process(
+            target=_work,
+            args=(queue, settings, requests, routes, duration, threads,
+                  number))
+                   for number in range(processes)]
+        for worker in workers:
+            worker.start()
+        outcomes = [queue.get(timeout=duration + 60) for _worker in workers]
+        for worker in workers:
+            worker.join()
+    else:
+        outcomes = [_replay_threads(settings, requests, routes, duration,
+                                    threads, 0)]
+    return outcomes, time.time() - start
+
+
+def report(results, out=None):
+    """
+    Print the results of replay as a table, busiest routes first
+    """
+    out = out or sys.stdout
+    out.write("%-40s %7s %9s %7s %9s %9s %9s %9s\n" % (
+        'route', 'count', 'req/s', 'errors', 'p50', 'p95', 'p99', 'max'))
+    routes = sorted((route for route in results if route is not None),
+                    key=lambda route: -results[route]['count'])
+    for route in routes + [None]:
+        stats = results[route]
+        out.write("%-40s %7d %9.1f %6.1f%% %9.2f %9.2f %9.2f %9.2f\n" % (
+            route or 'TOTAL', stats['count'], stats['throughput'],
+            stats['error_rate'] * 100, stats['p50'], stats['p95'],
+            stats['p99'], stats['max']))
+
+
+def _route(app, path, method):
+    """
+    Return the 'METHOD rule' key path is reported under, or 'METHOD path' if
+    it doesn't match a rule
+    """
+    adapter = app.url_map.bind('localhost')
+    try:
+        rule, _args = adapter.match(urlparse.urlsplit(path).path, method,
+                                    return_rule=True)
+    except HTTPException:
+        return '%s %s' % (method, path)
+    return '%s %s' % (method, rule.rule)
+
+
+def _work(queue, settings, requests, routes, duration, threads, number):
+    """
+    Worker process body: replay, and send the outcome to the parent
+    """
+    queue.put(_replay_threads(settings, requests, routes, duration, threads,
+                              number * threads))
+
+
+def _replay_threads(settings, requests, routes, duration, threads, first):
+    """
+    Replay from threads threads, numbered from first, and return a dict of
+    route => (list of milliseconds, error count). Each thread runs with the
+    configuration in settings, since overrides don't cross threads.
+    """
+    deadline = time.time() + duration
+    outcomes = [{} for _thread in range(threads)]
+    workers = [threading.Thread(
+        target=_replay_thread,
+        args=(settings, requests, routes, deadline, first + number,
+              outcomes[number]))
+               for number in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    merged = {}
+    for outcome in outcomes:
+        for route, (times, errors) in outcome.items():
+            merged_times, merged_errors = merged.get(route, ([], 0))
+            merged[route] = (merged_times + times, merged_errors + errors)
+    return merged
+
+
+def _replay_thread(settings, requests, routes, deadline, number, outcome):
+    """
+    Thread body: replay requests through one client until deadline, starting
+    at an offset so threads don't move in lockstep. Fills in outcome.
+    """
+    with config.override(**settings):
+        _replay_requests(requests, routes, deadline, number, outcome)
+
+
+def _replay_requests(requests, routes, deadline, number, outcome):
+    """
+    _replay_thread, with the configuration in place
+    """
+    from .viewunit import _setup_session
+
+    client = config.get_app().test_client()
+    times = {}
+    errors = dict((route, 0) for route in routes)
+    i = number
+    while time.time() < deadline:
+        index = i % len(requests)
+        i += 1
+        request = requests[index]
+        route = routes[index]
+        if client.cookie_jar is not None:
+            client.cookie_jar.clear()
+
+        start = time.time()
+        try:
+            _setup_session(client, request.get('session'),
+                           request.get('user_id'))
+            start = time.time()
+            response = client.open(path=request['path'],
+                                   method=request.get('method', 'GET'),
+                                   data=request.get('data'))
+            if request.get('status') is None:
+                failed = response.status_code >= 500
+            else:
+                failed = response.status_code != request['status']
+        except Exception: #pylint: disable=W0703
+            failed = True
+        times.setdefault(route, []).append((time.time() - start) * 1000)
+        errors[route] += failed
+
+    for route in times:
+        outcome[route] = (times[route], errors[route])
+
+
+def _stats(times, errors, elapsed):
+    """
+    Summarize one route's request times
+    """
+    from .viewunit import percentile
+
+    times = sorted(times)
+    count = len(times)
+    return {
+        'count': count,
+        'errors': errors,
+        'error_rate': float(errors) / count if count else 0.0,
+        'throughput': count / elapsed if elapsed else 0.0,
+        'min': times[0] if times else 0.0,
+        'p50': percentile(times, 50) if times else 0.0,
+        'p95': percentile(times, 95) if times else 0.0,
+        'p99': percentile(times, 99) if times else 0.0,
+        'max': times[-1] if times else 0.0,
+    }
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    """
+    from .runner import _setup_function
+
+    parser = optparse.OptionParser(
+        usage='%prog [options] REPLAY_FILE',
+        description='Replay recorded viewunit requests as load.')
+    parser.add_option('-d', '--duration', type='float', default=10.0,
+                      help='seconds to replay for (default: %default)')
+    parser.add_option('-t', '--threads', type='int', default=4,
+                      help='threads per process (default: %default)')
+    parser.add_option('-p', '--processes', type='int', default=1,
+                      help='processes to fork (default: %default)')
+    parser.add_option('--setup', default=None,
+                      help='module (or module.function) that configures '
+                      'viewunit, imported/called before replaying')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('expected a replay file')
+
+    setup = _setup_function(options.setup)
+    if setup is not None:
+        sys.path.insert(0, '.')
+        setup()
+    report(replay(load(args[0]), duration=options.duration,
+                  threads=options.threads, processes=options.processes))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
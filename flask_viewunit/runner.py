@@ -0,0 +1,345 @@
+"""
+Parallel test runner for viewunit tests.
+
+viewunit's configuration (see config.py) is per-process, and ViewTestMixin
+changes the app's settings while a test runs, so view tests can't safely share
+a process. This runner forks a pool of worker processes instead. Each worker
+runs its configuration code once, then runs whole test classes handed out by
+the parent, which merges their results.
+
+From Python:
+
+    result = runner.run_parallel(suite, processes=8,
+                                 setup=configure_viewunit,
+                                 worker_setup=use_worker_db)
+
+From the command line (discovers test*.py under the start directory):
+
+    python -m flask_viewunit.runner -j 8 --setup app_test \
+        --worker-setup app_test.use_worker_db tests/
+
+To give every worker its own test database, pass worker_setup, which each
+worker calls with its worker number (0 to processes - 1) after setup. It must
+point everything that touches the database at the worker's copy: the app's
+own connection, and each of viewunit's database hooks that's in use
+(db_select, db_batch_select, db_execute, db_connection and fixture_snapshots),
+or views and assertions will see different databases.
+
+db_select_factory is a narrower form of this, for when only db_select needs
+to change: each worker calls it with its worker number and uses the result as
+its db_select hook, and nothing else.
+"""
+import collections
+import importlib
+import multiprocessing
+import optparse
+import os
+import Queue
+import sys
+import time
+import unittest
+
+from . import config, ledger, validation
+
+
+def run_parallel(suite, processes=None, setup=None, db_select_factory=None,
+                 stream=None, verbosity=1, worker_setup=None):
+    """
+    Run the tests in suite across processes forked workers (one per CPU by
+    default), and return a unittest.TextTestResult with all of their results.
+
+    setup is called with no arguments once in each worker, before any tests
+    run. worker_setup, if given, is then called with the worker number, and
+    should point the app and all database hooks at that worker's database
+    (see above). db_select_factory, if given, is called with the worker
+    number and should return the worker's db_select hook.
+    """
+    stream = unittest.runner._WritelnDecorator(stream or sys.stderr)
+    processes = processes or multiprocessing.cpu_count()
+    groups = _group_by_class(suite)
+    # Hand out the biggest classes first, so no worker is left with a long
+    # tail at the end
+    order = sorted(range(len(groups)), key=lambda i: -len(groups[i]))
+
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    for index in order:
+        tasks.put(index)
+    workers = []
+    for number in range(min(processes, len(groups))):
+        tasks.put(None)
+        worker = multiprocessing.Process(
+            target=_work,
+            args=(number, groups, tasks, results, setup, db_select_factory,
+                  worker_setup))
+        worker.start()
+        workers.append(worker)
+
+    result = ParallelResult(stream, True, verbosity)
+    start = time.time()
+    outstanding = set(order)
+    while outstanding:
+        try:
+            index, outcomes = results.get(timeout=1)
+        except Queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                break
+            continue
+        outstanding.discard(index)
+        result.add_outcomes(outcomes)
+
+    for index in sorted(outstanding):
+        result.add_outcomes([
+            ('error', _RemoteTest(test), 'Worker process died\n')
+            for test in groups[index]])
+
+    for worker in workers:
+        worker.join()
+
+    result.printErrors()
+    _print_summary(stream, result, time.time() - start)
+    return result
+
+
+class ParallelResult(unittest.TextTestResult):
+    """
+    A TextTestResult built out of the outcomes reported by workers. Tests are
+    _RemoteTest stand-ins, since real test objects can't cross processes.
+    """
+
+    def add_outcomes(self, outcomes):
+        """
+        Record a list of (kind, test, detail) outcomes from a worker
+        """
+        for kind, test, detail in outcomes:
+            self.testsRun += 1
+            if kind == 'failure':
+                self.failures.append((test, detail))
+            elif kind == 'error':
+                self.errors.append((test, detail))
+            elif kind == 'skip':
+                self.skipped.append((test, detail))
+            elif kind == 'expected_failure':
+                self.expectedFailures.append((test, detail))
+            elif kind == 'unexpected_success':
+                self.unexpectedSuccesses.append(test)
+            self._report(kind, test)
+
+    def _report(self, kind, test):
+        """
+        Show progress the way TextTestResult does
+        """
+        if self.showAll:
+            self.stream.writeln('%s ... %s' % (
+                self.getDescription(test),
+                {'success': 'ok', 'failure': 'FAIL', 'error': 'ERROR',
+                 'skip': 'skipped', 'expected_failure': 'expected failure',
+                 'unexpected_success': 'unexpected success'}[kind]))
+        elif self.dots:
+            self.stream.write({'success': '.', 'failure': 'F', 'error': 'E',
+                               'skip': 's', 'expected_failure': 'x',
+                               'unexpected_success': 'u'}[kind])
+            self.stream.flush()
+
+
+class _RemoteTest(object):
+    """
+    Enough of a test's identity to report on it in another process
+    """
+
+    def __init__(self, test):
+        self._id = test.id()
+        self._str = str(test)
+        self._description = test.shortDescription() \
+            if hasattr(test, 'shortDescription') else None
+
+    def id(self):
+        """
+        The test's id
+        """
+        return self._id
+
+    def shortDescription(self):
+        """
+        The first line of the test's docstring, as unittest reports it
+        """
+        return self._description
+
+    def __str__(self):
+        return self._str
+
+
+class _WorkerResult(unittest.TestResult):
+    """
+    Collects (kind, test, detail) outcomes, with tracebacks already formatted,
+    so they can be sent to the parent
+    """
+
+    def __init__(self):
+        super(_WorkerResult, self).__init__()
+        self.outcomes = []
+
+    def addSuccess(self, test):
+        self.outcomes.append(('success', _RemoteTest(test), None))
+
+    def addFailure(self, test, err):
+        self.outcomes.append(('failure', _RemoteTest(test),
+                              self._exc_info_to_string(err, test)))
+
+    def addError(self, test, err):
+        self.outcomes.append(('error', _RemoteTest(test),
+                              self._exc_info_to_string(err, test)))
+
+    def addSkip(self, test, reason):
+        self.outcomes.append(('skip', _RemoteTest(test), reason))
+
+    def addExpectedFailure(self, test, err):
+        self.outcomes.append(('expected_failure', _RemoteTest(test),
+                              self._exc_info_to_string(err, test)))
+
+    def addUnexpectedSuccess(self, test):
+        self.outcomes.append(('unexpected_success', _RemoteTest(test), None))
+
+
+def _work(number, groups, tasks, results, setup, db_select_factory,
+          worker_setup):
+    """
+    Worker process body: configure, then run groups until told to stop
+    """
+    if setup is not None:
+        setup()
+    if worker_setup is not None:
+        worker_setup(number)
+    if db_select_factory is not None:
+        config.set_db_select_hook(db_select_factory(number))
+
+    try:
+        while True:
+            index = tasks.get()
+            if index is None:
+                break
+            result = _WorkerResult()
+            unittest.TestSuite(groups[index]).run(result)
+            results.put((index, result.outcomes))
+    finally:
+        # Worker processes skip exit handlers
+        validation.shutdown()
+        ledger.flush()
+
+
+def _group_by_class(suite):
+    """
+    Return the tests in suite as a list of lists, one per test class
+    """
+    groups = collections.OrderedDict()
+    for test in _flatten(suite):
+        groups.setdefault(type(test), []).append(test)
+    return groups.values()
+
+
+def _flatten(suite):
+    """
+    Yield the individual tests in a (possibly nested) suite, leaving out
+    methods marked with nose's @nottest (like ViewTestCase.test_client) and
+    classes with __test__ = False, which unittest's loader doesn't know to
+    skip
+    """
+    if isinstance(suite, unittest.TestSuite):
+        for test in suite:
+            for inner in _flatten(test):
+                yield inner
+    elif (getattr(type(suite), '__test__', True) and
+          getattr(getattr(suite, getattr(suite, '_testMethodName', ''), None),
+                  '__test__', True)):
+        yield suite
+
+
+def _print_summary(stream, result, elapsed):
+    """
+    Print the closing lines TextTestRunner would
+    """
+    stream.writeln(result.separator2)
+    stream.writeln('Ran %d test%s in %.3fs' % (
+        result.testsRun, result.testsRun != 1 and 's' or '', elapsed))
+    stream.writeln()
+
+    infos = []
+    if result.failures:
+        infos.append('failures=%d' % len(result.failures))
+    if result.errors:
+        infos.append('errors=%d' % len(result.errors))
+    if result.skipped:
+        infos.append('skipped=%d' % len(result.skipped))
+    stream.writeln('%s%s' % ('OK' if result.wasSuccessful() else 'FAILED',
+                             ' (%s)' % ', '.join(infos) if infos else ''))
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    """
+    parser = optparse.OptionParser(
+        usage='%prog [options] [start_dir]',
+        description='Run viewunit tests in parallel worker processes.')
+    parser.add_option('-j', '--processes', type='int', default=None,
+                      help='worker processes (default: one per CPU)')
+    parser.add_option('-p', '--pattern', default='test*.py',
+                      help='test file pattern (default: %default)')
+    parser.add_option('--setup', default=None,
+                      help='module (or module.function) that configures '
+                      'viewunit, imported/called once in each worker')
+    parser.add_option('--worker-setup', default=None,
+                      help='module.function to call with each worker\'s '
+                      'number after --setup, to point the app and database '
+                      'hooks at that worker\'s database')
+    parser.add_option('-v', '--verbose', action='store_const', const=2,
+                      dest='verbosity', default=1)
+    options, args = parser.parse_args(argv)
+
+    start_dir = os.path.abspath(args[0] if args else '.')
+    sys.path.insert(0, start_dir)
+    suite = unittest.TestLoader().discover(start_dir, options.pattern)
+
+    result = run_parallel(suite,
+                          processes=options.processes,
+                          setup=_setup_function(options.setup),
+                          worker_setup=_worker_setup_function(
+                              options.worker_setup),
+                          verbosity=options.verbosity)
+    return 0 if result.wasSuccessful() else 1
+
+
+def _setup_function(name):
+    """
+    Turn a --setup name into a function that imports the module, and calls
+    the function if one was named
+    """
+    if name is None:
+        return None
+
+    def setup():
+        """
+        Import (and maybe call) the named setup code
+        """
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            if '.' not in name:
+                raise
+            module_name, func_name = name.rsplit('.', 1)
+            getattr(importlib.import_module(module_name), func_name)()
+    return setup
+
+
+def _worker_setup_function(name):
+    """
+    Turn a --worker-setup module.function name into the function
+    """
+    if name is None:
+        return None
+    module_name, func_name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,275 @@
+"""
+Golden response snapshots, for expect_snapshot.
+
+A snapshot is a dict of plain values (see normalize) describing a response:
+its status, some of its headers, its template and template data, and its
+body. The first time a test takes one, it's recorded; after that, responses
+are compared with it, and any differences fail the test. Set the
+VIEWUNIT_UPDATE_SNAPSHOTS environment variable to record them all again.
+
+Snapshots are kept in a directory (see config.set_snapshot_store) as two
+files, however many there are: blobs.pack, the zlib compressed JSON of each
+distinct snapshot, appended one after another, and index.json, which maps
+each snapshot's name to the SHA-1 of its JSON, and each SHA-1 to where its
+blob is in the pack. Identical snapshots share a blob.
+
+Nothing is read until a test first uses expect_snapshot, and then only the
+index. Comparing a response just compares hashes; a stored blob is only read
+(and diffed) when the hashes differ. Blobs of replaced snapshots stay in the
+pack; delete the directory and record everything again to drop them.
+"""
+import collections
+import difflib
+import hashlib
+import json
+import os
+import re
+import tempfile
+import zlib
+
+# Unix only; elsewhere, snapshots are recorded without locking
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+INDEX = 'index.json'
+PACK = 'blobs.pack'
+
+# Lines of body diff shown in a failure
+MAX_DIFF_LINES = 40
+
+# Stores opened in this process, by directory
+_STORES = {}
+
+# Memory addresses in reprs, which change from run to run
+_ADDRESS = re.compile(r' at 0x[0-9a-fA-F]+')
+
+
+def check(directory, name, snapshot, update=False):
+    """
+    Compare snapshot with the one stored as name in directory, recording it
+    instead if there isn't one (or update is true). Returns a list of lines
+    describing the differences, which is empty if they match.
+    """
+    store = _store(directory)
+    data = json.dumps(normalize(snapshot), sort_keys=True, indent=1)
+    digest = hashlib.sha1(data).hexdigest()
+
+    stored = store.digest(name)
+    if stored == digest:
+        return []
+    if stored is None or update:
+        store.put(name, digest, data)
+        return []
+    return diff(json.loads(store.read(stored)), json.loads(data))
+
+
+def normalize(value, _seen=None):
+    """
+    Return value as plain JSON-able values that don't change from run to
+    run: mappings become dicts (with string keys), sequences and sets become
+    lists, and objects become dicts of their attributes, with their class
+    name as '__class__'. Anything else becomes its repr, without memory
+    addresses.
+    """
+    if value is None or isinstance(value, (bool, int, long, float, unicode)):
+        return value
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+
+    _seen = _seen or set()
+    if id(value) in _seen:
+        return '<cycle>'
+    _seen = _seen | set([id(value)])
+
+    if isinstance(value, (dict, collections.Mapping)):
+        return dict((key if isinstance(key, basestring) else repr(key),
+                     normalize(value[key], _seen))
+                    for key in value)
+    if isinstance(value, (list, tuple)):
+        return [normalize(item, _seen) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted(normalize(item, _seen) for item in value)
+    if hasattr(value, '__dict__') and not callable(value):
+        attrs = normalize(vars(value), _seen)
+        attrs['__class__'] = type(value).__name__
+        return attrs
+    return _ADDRESS.sub('', repr(value))
+
+
+def diff(old, new):
+    """
+    Return lines describing how the snapshot new differs from old
+    """
+    lines = []
+    _diff(old, new, (), lines)
+    return lines
+
+
+def _diff(old, new, path, lines):
+    """
+    Add lines for the differences between old and new, found at path
+    """
+    if old == new:
+        return
+    where = _show_path(path)
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in sorted(set(old) | set(new)):
+            if key not in new:
+                lines.append("%s: removed" % _show_path(path + (key,)))
+            elif key not in old:
+                lines.append("%s: added %s" % (_show_path(path + (key,)),
+                                               _show(new[key])))
+            else:
+                _diff(old[key], new[key], path + (key,), lines)
+    elif isinstance(old, list) and isinstance(new, list):
+        if len(old) != len(new):
+            lines.append("%s: %d items, was %d" % (where, len(new),
+                                                   len(old)))
+        for index, (old_item, new_item) in enumerate(zip(old, new)):
+            _diff(old_item, new_item, path + (index,), lines)
+    elif (isinstance(old, basestring) and isinstance(new, basestring) and
+          ('\n' in old or '\n' in new)):
+        lines.append("%s:" % where)
+        changes = list(difflib.unified_diff(old.splitlines(),
+                                            new.splitlines(),
+                                            'snapshot', 'response',
+                                            lineterm='', n=2))
+        lines.extend("  " + line for line in changes[:MAX_DIFF_LINES])
+        if len(changes) > MAX_DIFF_LINES:
+            lines.append("  ... (%d more lines)" %
+                         (len(changes) - MAX_DIFF_LINES))
+    else:
+        lines.append("%s: %s, was %s" % (where, _show(new), _show(old)))
+
+
+def _show_path(path):
+    """
+    Return a path of keys and indexes as key.key[index]
+    """
+    parts = []
+    for step in path:
+        if isinstance(step, int):
+            parts.append("[%d]" % step)
+        else:
+            parts.append(("." if parts else "") + step)
+    return "".join(parts)
+
+
+def _show(value):
+    """
+    Return a short version of a snapshot value for a failure message
+    """
+    shown = json.dumps(value, sort_keys=True)
+    if len(shown) > 70:
+        shown = shown[:67] + '...'
+    return shown
+
+
+def _store(directory):
+    """
+    Return the store for directory, opening it the first time
+    """
+    store = _STORES.get(directory)
+    if store is None:
+        store = _STORES[directory] = _Store(directory)
+    return store
+
+
+class _Store(object):
+    """
+    A directory of snapshots: an index and a pack of blobs. The index is read
+    on first use.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._index = None
+
+    def _path(self, name):
+        """
+        Return the path of one of the store's files
+        """
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        """
+        Return the index, reading it if it hasn't been
+        """
+        if self._index is None:
+            self._index = _read_index(self._path(INDEX))
+        return self._index
+
+    def digest(self, name):
+        """
+        Return the SHA-1 of the snapshot called name, or None
+        """
+        return self._load()['snapshots'].get(name)
+
+    def read(self, digest):
+        """
+        Return the JSON of the blob with the given SHA-1
+        """
+        offset, length = self._load()['blobs'][digest]
+        with open(self._path(PACK), 'rb') as pack:
+            pack.seek(offset)
+            return zlib.decompress(pack.read(length))
+
+    def put(self, name, digest, data):
+        """
+        Store data, whose SHA-1 is digest, as the snapshot called name. The
+        pack is locked (where fcntl is available) while it's appended to and
+        the index rewritten, so parallel test processes can record snapshots
+        at once.
+        """
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+
+        with open(self._path(PACK), 'ab') as pack:
+            if fcntl is not None:
+                fcntl.flock(pack, fcntl.LOCK_EX)
+            try:
+                # Another process may have added snapshots since it was read
+                index = _read_index(self._path(INDEX))
+                if digest not in index['blobs']:
+                    blob = zlib.compress(data)
+                    pack.seek(0, os.SEEK_END)
+                    index['blobs'][digest] = [pack.tell(), len(blob)]
+                    pack.write(blob)
+                    pack.flush()
+                index['snapshots'][name] = digest
+                _write_index(self._path(INDEX), index)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(pack, fcntl.LOCK_UN)
+        self._index = index
+
+
+def _read_index(path):
+    """
+    Return the index at path, or an empty one if there isn't one
+    """
+    if not os.path.exists(path):
+        return {'snapshots': {}, 'blobs': {}}
+    with open(path) as index_file:
+        return json.load(index_file)
+
+
+def _write_index(path, index):
+    """
+    Write the index at path, renaming it into place so readers never see it
+    half written
+    """
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         suffix='.tmp')
+    with os.fdopen(handle, 'w') as index_file:
+        json.dump(index, index_file, sort_keys=True, indent=1)
+    # Windows won't rename over an existing file
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(temp_path, path)
@@ -0,0 +1,522 @@
+"""
+HTML well-formedness checking for expect_well_formed.
+
+Parsing a page with html5lib is slow, and most test runs render the same pages
+over and over, so results are cached by a hash of the response body. The cache
+always lives in memory, and can also be kept on disk across runs (see
+config.set_well_formed_cache_file).
+
+Pages that do need parsing can be sent to a pool of worker processes (see
+config.set_well_formed_workers), so the test carries on while they're checked.
+
+The parser itself is pluggable (see config.set_html_validator). Besides
+check_html, which uses html5lib, there is fast_check_html, which avoids the
+html5lib parse for pages that are plainly fine, and lenient_check_html, which
+also trusts lxml, at the cost of missing some errors.
+"""
+import atexit
+import collections
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+
+import html5lib
+
+from . import config
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+
+# Entries kept in memory, regardless of the on-disk cache size
+MEMORY_CACHE_SIZE = 10000
+
+
+def check_html(data):
+    """
+    Parse data with a strict html5lib parser. Return None if it is well
+    formed, otherwise an (error, element, line) tuple describing the first
+    parse error. element is None if the error isn't about a specific element.
+    """
+    parser = html5lib.HTMLParser(strict=True)
+    try:
+        parser.parse(data)
+    except html5lib.html5parser.ParseError:
+        line = str(parser.errors[0][0][0])
+        error = parser.errors[0][1]
+
+        element = None
+        if 'name' in parser.errors[0][2]:
+            element = parser.errors[0][2]['name']
+        return (error, element, line)
+    return None
+
+
+def fast_check_html(data):
+    """
+    A faster validator with the same results as check_html.
+
+    Pages are first run through a cheap tokenizer pass, which passes only
+    simple documents that html5lib would certainly accept. Pages it isn't sure
+    about are parsed with html5lib as usual.
+    """
+    if _prescreen(data):
+        return None
+    return check_html(data)
+
+
+def lenient_check_html(data):
+    """
+    Like fast_check_html, but pages the tokenizer pass isn't sure about are
+    first parsed with lxml's C parser (if lxml is installed), and only parsed
+    with html5lib if lxml finds a problem.
+
+    lxml is much more lenient than html5lib: it accepts unclosed elements,
+    self-closed non-void elements like <p/>, and misnested tables, among
+    others. So this misses errors check_html reports; only use it where speed
+    matters more than catching them.
+    """
+    if _prescreen(data):
+        return None
+    if etree is not None and _DOCTYPE_RE.match(data) and _lxml_clean(data):
+        return None
+    return check_html(data)
+
+
+def check_html_cached(data):
+    """
+    Like the configured validator, but consult (and fill) the result cache
+    first
+    """
+    validator = config.get_html_validator() or check_html
+    key = _cache_key(validator, data)
+    cache = get_cache()
+    hit, result = cache.get(key)
+    if not hit:
+        result = validator(data)
+        cache.put(key, result)
+    return result
+
+
+def check_html_async(data):
+    """
+    Like check_html_cached, but validate in a worker process if the result
+    isn't cached. Returns an object whose result() method waits for and returns
+    the validator's result.
+    """
+    validator = config.get_html_validator() or check_html
+    key = _cache_key(validator, data)
+    hit, result = get_cache().get(key)
+    if hit:
+        return _Finished(result)
+    return _Pending(key, get_pool().submit(validator, data))
+
+
+def _cache_key(validator, data):
+    """
+    Return the result cache key for checking data with validator
+    """
+    name = '%s.%s' % (getattr(validator, '__module__', None),
+                      getattr(validator, '__name__', repr(validator)))
+    return '%s:%s' % (hashlib.sha1(data).hexdigest(), name)
+
+
+def _lxml_clean(data):
+    """
+    Return whether lxml's HTML parser finds no errors in data
+    """
+    try:
+        etree.fromstring(data, etree.HTMLParser(recover=False))
+    except (etree.XMLSyntaxError, ValueError):
+        return False
+    return True
+
+
+_SPACE = ' \t\n\x0c\r'
+_DOCTYPE_RE = re.compile(r'[ \t\n\x0c\r]*<!DOCTYPE html>', re.I)
+_TOKEN_RE = re.compile(r"""
+    (?P<text>[^<&]+)
+  | <!--(?P<comment>.*?)-->
+  | </(?P<end>[a-zA-Z][a-zA-Z0-9]*)[ \t\n\x0c\r]*>
+  | <(?P<start>[a-zA-Z][a-zA-Z0-9]*)
+     (?P<attrs>(?:[ \t\n\x0c\r]+[^ \t\n\x0c\r"'<>/=&]+
+        (?:[ \t\n\x0c\r]*=[ \t\n\x0c\r]*
+           (?:"[^"<&]*"|'[^'<&]*'|[^ \t\n\x0c\r"'=<>`&]+))?)*)
+     [ \t\n\x0c\r]*(?P<close>/?)>
+  | &(?P<entity>[a-zA-Z]+|\#[0-9]{1,7}|\#[xX][0-9a-fA-F]{1,6});
+""", re.X | re.S)
+_ATTR_NAME_RE = re.compile(
+    r"""[ \t\n\x0c\r]+([^ \t\n\x0c\r"'<>/=&]+)
+        (?:[ \t\n\x0c\r]*=[ \t\n\x0c\r]*
+           (?:"[^"]*"|'[^']*'|[^ \t\n\x0c\r"'=<>`&]+))?""", re.X)
+_BAD_CHAR_RE = re.compile(
+    u'[\x00-\x08\x0b\x0e-\x1f\x7f-\x9f\ufdd0-\ufdef\ufffe\uffff]')
+
+_ENTITIES = frozenset(['amp', 'lt', 'gt', 'quot', 'apos', 'nbsp', 'copy',
+                       'reg', 'mdash', 'ndash', 'hellip', 'laquo', 'raquo',
+                       'middot', 'times', 'bull'])
+_HEAD_ELEMENTS = frozenset(['title', 'meta', 'link', 'base', 'script',
+                            'style'])
+_PHRASING_ELEMENTS = frozenset([
+    'a', 'abbr', 'b', 'bdi', 'bdo', 'br', 'cite', 'code', 'data', 'dfn', 'em',
+    'i', 'img', 'input', 'kbd', 'label', 'mark', 'q', 's', 'samp', 'script',
+    'small', 'span', 'strong', 'sub', 'sup', 'time', 'u', 'var', 'wbr'])
+_BLOCK_ELEMENTS = frozenset([
+    'address', 'article', 'aside', 'blockquote', 'button', 'dd', 'div', 'dl',
+    'dt', 'fieldset', 'figcaption', 'figure', 'footer', 'form', 'h1', 'h2',
+    'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'nav', 'ol', 'p',
+    'pre', 'section', 'ul'])
+_VOID_ELEMENTS = frozenset(['base', 'br', 'hr', 'img', 'input', 'link', 'meta',
+                            'wbr'])
+_RAW_TEXT_ELEMENTS = frozenset(['script', 'style', 'title'])
+_NO_NESTING = frozenset(['a', 'button', 'form', 'h1', 'h2', 'h3', 'h4', 'h5',
+                         'h6', 'p'])
+_HEADINGS = frozenset(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+_REQUIRED_PARENTS = {'li': ('ul', 'ol'), 'dt': ('dl',), 'dd': ('dl',)}
+
+
+def _prescreen(data):
+    """
+    Return True if data is certainly well formed. This accepts only a strict,
+    simple subset of HTML: a doctype, explicit html/head/body elements, every
+    element explicitly closed in order, and none of the elements or nestings
+    that make html5lib rearrange the tree. Anything else returns False, which
+    just means "not sure".
+    """
+    try:
+        text = data.decode('utf-8') if isinstance(data, str) else data
+    except UnicodeDecodeError:
+        return False
+    lower = text.lower()
+    if _BAD_CHAR_RE.search(text) or len(lower) != len(text):
+        return False
+
+    match = _DOCTYPE_RE.match(text)
+    if not match:
+        return False
+
+    stack = []
+    # Children of <html> seen so far, and whether <html> has been seen/closed
+    html_children = []
+    html_state = 'before'
+    pos = match.end()
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if not match:
+            return False
+        pos = match.end()
+        kind = match.lastgroup
+        if kind in ('attrs', 'close'):
+            kind = 'start'
+
+        if kind == 'comment':
+            comment = match.group('comment')
+            if '--' in comment or comment.startswith(('>', '->')) or \
+                    comment.endswith('-'):
+                return False
+        elif kind == 'entity':
+            if not stack or stack[-1] in ('html', 'head') or \
+                    not _entity_ok(match.group('entity')):
+                return False
+        elif kind == 'text':
+            if (not stack or stack[-1] in ('html', 'head')) and \
+                    match.group('text').strip(_SPACE):
+                return False
+        elif kind == 'end':
+            name = match.group('end').lower()
+            if not stack or stack[-1] != name:
+                return False
+            stack.pop()
+            if name == 'html':
+                html_state = 'after'
+        else:
+            name = match.group('start').lower()
+            if not _start_ok(name, stack, html_children, html_state):
+                return False
+            if not _attrs_ok(match.group('attrs')):
+                return False
+            if name == 'html':
+                html_state = 'in'
+            elif stack == ['html']:
+                html_children.append(name)
+
+            if name in _VOID_ELEMENTS:
+                continue
+            if match.group('close'):
+                return False
+            if name in _RAW_TEXT_ELEMENTS:
+                end = lower.find('</' + name, pos)
+                if end == -1:
+                    return False
+                content = text[pos:end]
+                if name == 'script' and '<!--' in content:
+                    return False
+                if name == 'title' and ('&' in content or '<' in content):
+                    return False
+                end_match = _TOKEN_RE.match(text, end)
+                if not end_match or end_match.lastgroup != 'end' or \
+                        end_match.group('end').lower() != name:
+                    return False
+                pos = end_match.end()
+                continue
+            stack.append(name)
+
+    return html_state == 'after' and html_children == ['head', 'body']
+
+
+def _start_ok(name, stack, html_children, html_state):
+    """
+    Return whether a start tag for name is simple enough for _prescreen
+    """
+    if not stack:
+        return name == 'html' and html_state == 'before'
+    if stack == ['html']:
+        return (html_children, name) in (([], 'head'), (['head'], 'body'))
+    if stack[1] == 'head':
+        return name in _HEAD_ELEMENTS and len(stack) == 2
+    if name not in _PHRASING_ELEMENTS and name not in _BLOCK_ELEMENTS:
+        return False
+    if name not in _PHRASING_ELEMENTS and 'p' in stack:
+        return False
+    if name in _NO_NESTING and name in stack:
+        return False
+    if name in _HEADINGS and _HEADINGS.intersection(stack):
+        return False
+    if name in _REQUIRED_PARENTS and stack[-1] not in _REQUIRED_PARENTS[name]:
+        return False
+    return True
+
+
+def _attrs_ok(attrs):
+    """
+    Return whether a start tag's attribute string has no repeated attributes
+    """
+    names = [name.lower() for name in _ATTR_NAME_RE.findall(attrs)]
+    return len(names) == len(set(names))
+
+
+def _entity_ok(entity):
+    """
+    Return whether a character reference (without & and ;) is one html5lib
+    accepts without complaint
+    """
+    if not entity.startswith('#'):
+        return entity in _ENTITIES
+    if entity[1:2] in ('x', 'X'):
+        value = int(entity[2:], 16)
+    else:
+        value = int(entity[1:])
+    return (value in (9, 10, 13) or 0x20 <= value <= 0x7e or
+            0xa0 <= value <= 0xd7ff or 0xe000 <= value <= 0xfdcf or
+            0xfdf0 <= value <= 0xfffd)
+
+
+class _Finished(object):
+    """
+    A check whose result was already known
+    """
+
+    def __init__(self, result):
+        self._result = result
+
+    def result(self):
+        """
+        Return the check_html result
+        """
+        return self._result
+
+
+class _Pending(object):
+    """
+    A check running in the worker pool. The result is cached when it's
+    collected, which keeps the cache on the test's thread.
+    """
+
+    def __init__(self, key, future):
+        self._key = key
+        self._future = future
+
+    def result(self):
+        """
+        Wait for, cache and return the check_html result
+        """
+        result = self._future.result()
+        get_cache().put(self._key, result)
+        return result
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the worker pool for the currently configured number of workers
+    """
+    global _POOL
+    assert futures is not None, \
+        "Install the 'futures' package to check well-formedness in the " + \
+        "background"
+
+    workers = config.get_well_formed_workers()
+    with _POOL_LOCK:
+        if _POOL is None or _POOL[0] != workers:
+            if _POOL is not None:
+                _POOL[1].shutdown()
+            pool = futures.ProcessPoolExecutor(max_workers=workers or None)
+            atexit.register(pool.shutdown)
+            _POOL = (workers, pool)
+        return _POOL[1]
+
+
+def shutdown():
+    """
+    Flush the result cache and stop the worker pool. This happens at exit
+    anyway, but processes that leave without running exit handlers (like
+    multiprocessing children) need to call it themselves.
+    """
+    global _POOL
+    if _CACHE is not None:
+        _CACHE.flush()
+    if _POOL is not None:
+        _POOL[1].shutdown()
+        _POOL = None
+
+
+class ResultCache(object):
+    """
+    An LRU cache of validation results, keyed by body hash. If path is given,
+    results are also stored in a SQLite file there, which keeps the
+    max_entries most recently used results across runs.
+
+    Disk writes are buffered, and written by flush(), which runs at exit.
+    The cache can be shared between threads.
+    """
+
+    def __init__(self, path=None, max_entries=None):
+        self.path = path
+        self.max_entries = max_entries
+        self._memory = collections.OrderedDict()
+        self._pending = {}
+        self._conn = None
+        self._clock = 0
+        self._lock = threading.RLock()
+
+        if path is not None:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS results "
+                               "(key TEXT PRIMARY KEY, result TEXT, "
+                               "used INTEGER)")
+            self._clock = self._conn.execute(
+                "SELECT COALESCE(MAX(used), 0) FROM results").fetchone()[0]
+            atexit.register(self.flush)
+
+    def get(self, key):
+        """
+        Return a (hit, result) pair for key
+        """
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key):
+        """
+        get, with the lock held
+        """
+        if key in self._memory:
+            result = self._memory.pop(key)
+            self._memory[key] = result
+            self._touch(key, result)
+            return True, result
+
+        if self._conn is None:
+            return False, None
+
+        row = self._conn.execute("SELECT result FROM results WHERE key = ?",
+                                 (key,)).fetchone()
+        if row is None:
+            return False, None
+
+        result = json.loads(row[0])
+        if result is not None:
+            result = tuple(result)
+        self._remember(key, result)
+        self._touch(key, result)
+        return True, result
+
+    def put(self, key, result):
+        """
+        Store the result for key
+        """
+        with self._lock:
+            self._remember(key, result)
+            self._touch(key, result)
+
+    def flush(self):
+        """
+        Write buffered results to disk, and evict the least recently used
+        entries beyond max_entries
+        """
+        with self._lock:
+            if self._conn is None or not self._pending:
+                return
+
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO results (key, result, used) "
+                "VALUES (?, ?, ?)",
+                [(key, json.dumps(result), used)
+                 for key, (result, used) in self._pending.items()])
+            self._pending.clear()
+            if self.max_entries is not None:
+                self._conn.execute(
+                    "DELETE FROM results WHERE key NOT IN "
+                    "(SELECT key FROM results ORDER BY used DESC LIMIT ?)",
+                    (self.max_entries,))
+            self._conn.commit()
+
+    def _remember(self, key, result):
+        """
+        Add key to the in-memory LRU, evicting the oldest entry if it's full
+        """
+        self._memory.pop(key, None)
+        self._memory[key] = result
+        if len(self._memory) > MEMORY_CACHE_SIZE:
+            self._memory.popitem(last=False)
+
+    def _touch(self, key, result):
+        """
+        Mark key as recently used in the on-disk cache
+        """
+        if self._conn is None:
+            return
+        self._clock += 1
+        self._pending[key] = (result, self._clock)
+        if len(self._pending) >= 1000:
+            self.flush()
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache():
+    """
+    Return the result cache for the currently configured cache file
+    """
+    global _CACHE
+    path, max_entries = config.get_well_formed_cache_file()
+    with _CACHE_LOCK:
+        if _CACHE is None or _CACHE.path != path:
+            if _CACHE is not None:
+                _CACHE.flush()
+            _CACHE = ResultCache(path, max_entries)
+        _CACHE.max_entries = max_entries
+        return _CACHE
@@ -6,13 +6,21 @@ https://github.com/wingu/flask_viewunit/blob/master/tests/test_example.py
 """
 
 #pylint: disable=C0302
+import collections
 from contextlib import contextmanager
+import cProfile
+import csv
 import json
 import functools
-import html5lib
-import pprint
+import itertools
+import math
+import os
 import re
-import types
+import sqlite3
+import sys
+import tempfile
+import threading
+import timeit
 import unittest
 import urlparse
 
@@ -20,7 +28,14 @@ import flask
 from nose.tools import eq_, nottest, ok_
 from werkzeug.utils import parse_cookie
 
-from . import config
+# Unix only; elsewhere, benchmark baselines are recorded without locking
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import (config, fixtures, jsonpath, ledger, matchers, replay,
+               snapshots, validation)
 
 
 class ViewTestMixin(object):
@@ -39,11 +54,27 @@ class ViewTestMixin(object):
     all the mock objects, runs it, and checks for the various expected
     results. Uses nose's assertion mechanisms to report issues. If
     all the assertions pass, it returns the response from the view.
+    For multi-step flows, scenario runs several views with the same client,
+    and for tables of similar view tests there's run_view_many.
+    benchmark_view times a view over many requests.
 
     Also provides a db-focused analogue to setUp/tearDown via
     dbSetUp/dbTearDown.  If db work is placed in these methods, it can
     automatically be run against the test version of the database.
 
+    Rows can also be declared in a fixtures attribute, which viewunit loads
+    before each test and deletes afterwards; see fixtures.py.
+
+    Fixtures shared by all of a class's tests can be built in a
+    dbSetUpClass method instead of dbSetUp. With SQLite, they can then be
+    built once and restored from a snapshot before each test; see
+    fixtures.py.
+
+    Classes that set transactional = True run each test in a database
+    transaction instead, which is rolled back when the test ends, so nothing
+    needs cleaning up in dbTearDown (which isn't called). The connection comes
+    from config.set_db_connection_hook; see get_test_connection.
+
     Important (and Unfortunate) Note: if a subclass of this overrides
     setUp/tearDown, it *must* call super().setUp/tearDown() or much will break.
     This should be fixed.  And/or the fundamental assumptions of
@@ -63,9 +94,24 @@ class ViewTestMixin(object):
      - expect_tmpl_data: A dict which should be contained in the data used
        to fill the template (see note).
 
+     - expect_tmpls: The list of names of every template rendered, in order.
+       expect_tmpl and the other tmpl expects look at the first one.
+
+     - expect_max_render_ms: A number of milliseconds each template must
+       render in, or a dict of template name => milliseconds. Needs render
+       timings; see record_templates.
+
      - expect_json: A dict which when converted to json will be equivalent to
        the json response.
 
+     - expect_json_has: A list of selectors (like 'users[0].name'; see
+       jsonpath.py) which must each find something in the json response
+
+     - expect_json_data: A dict of {selector => value}. The value the
+       selector finds must contain the expected one (see note). A selector
+       with wildcards (like 'users[*].name') finds a list of values, which
+       must match an expected list, or each match an expected non-list.
+
      - expect_form_errors: A tuple of form name (in the template), field name,
        number of errors expected.
 
@@ -98,7 +144,51 @@ class ViewTestMixin(object):
        data is well formed.
        Will check response bodies where the content-type is text/html and the
        status code is 200. Does not currently follow redirects.
-       True by default.
+       True by default. If config.set_well_formed_workers is used, the check
+       runs in the background and failures are reported by end_full.
+
+     - expect_max_queries: The most database statements the view may run.
+       Statements are counted if your app reports them; see record_queries.
+
+     - expect_no_repeated_queries: The most times the view may run any one
+       statement, ignoring literal and parameter values (True means once).
+       Catches N+1 query patterns.
+
+     - expect_no_full_scans: True, or a list of table names. Each statement
+       the view ran is EXPLAINed (see config.set_db_explain_dialect), and any
+       full table scan fails the test. With True, scans of tables in
+       config.set_full_scan_allowlist are allowed; with a list, only scans of
+       the listed tables fail.
+
+     - expect_max_ms: A number of milliseconds the request must finish in.
+
+     - expect_p95_ms: A number of milliseconds, or a (milliseconds, runs)
+       pair. The request is repeated (20 times by default) through the same
+       client, and the 95th percentile of the request times must be within
+       the budget. Only use this on views that are safe to repeat.
+
+     - expect_snapshot: True, or a name. The response's status, headers,
+       template, template data and body are compared with a stored golden
+       snapshot, named after the test, the request and how many snapshots
+       the test has taken, unless a name is given; any differences are
+       reported. Snapshots that don't exist yet are
+       recorded. Needs config.set_snapshot_store; see snapshots.py.
+
+     - expect_chunks: A function, or list of functions, to call with each
+       chunk of a streamed response body as it arrives. Needs stream=True.
+
+     - expect_max_ttfb_ms: A number of milliseconds the first byte of a
+       streamed response body must arrive in. Needs stream=True.
+
+    Every response run_view returns has a viewunit_timings dict, breaking
+    down where the test's time went, and run_view can profile the request
+    with cProfile; see run_view.
+
+    Responses also have a viewunit_templates list of every template rendered,
+    as RenderedTemplate(name, data, ms) tuples.
+
+    Views that stream their responses can be run with stream=True, which
+    reads the body a chunk at a time instead of buffering it; see run_view.
 
     Note: for the data-type expects, we check containment, with a primitive
     notion of deep-equality.  If a List is found in the dict, it must be
@@ -112,33 +202,293 @@ class ViewTestMixin(object):
                  session=None,
                  data=None,
                  user_id=None,
+                 profile=False,
+                 stream=False,
                  **expects):
         """
-        Run a test of a single view
+        Run a test of a single view.
+
+        The response gets a viewunit_timings attribute, an ordered dict of
+        milliseconds spent in each phase of the test: 'session' setup, the
+        'request' itself, and each group of expect checks.
+
+        If profile is true (or the VIEWUNIT_PROFILE_DIR environment variable
+        is set), the request runs under cProfile, and the stats are saved to
+        '<test id>.<n>.prof' in profile (if it's a string),
+        VIEWUNIT_PROFILE_DIR, or 'viewunit_profiles'. The file name is kept in
+        response.viewunit_profile.
+
+        If stream is true, the response body is read a chunk at a time, and
+        thrown away, so views streaming more than fits in memory can be
+        tested: expect_chunks sees each chunk as it arrives, and
+        expect_max_ttfb_ms fails as soon as the first byte is late. Reading
+        it is timed as 'stream', and response.viewunit_stream is a dict of
+        ttfb_ms (milliseconds to the first byte), chunks, bytes and
+        max_chunk_bytes (the most of the body held at once). Expects that
+        need the whole body (expect_json and expect_well_formed) can't be
+        used, and expect_response functions see a response that's already
+        been read.
         """
         _check_expect_names(expects)
 
         response = None
+        timings = collections.OrderedDict()
         with config.get_app().test_client() as client:
-            with client.session_transaction() as test_session:
-                set_session_user_id(test_session, user_id)
-                if session is not None:
-                    test_session.update(session)
-
-            # If we need to expose client.open()'s open_kwargs to the caller of
-            # run_view, it can be passed in above, and used here.
-            response = client.open(path=path,
-                                   method=method,
-                                   data=data)
-            response.template_data = _get_tmpl_data()
-            self._check_expects(expects, response, flask.session)
+            with _timer(timings, 'session'):
+                _setup_session(client, session, user_id)
+            response = self._open_and_check(client, expects,
+                                            timings=timings,
+                                            profile=profile,
+                                            stream=stream,
+                                            replay_as=(session, user_id),
+                                            path=path,
+                                            method=method,
+                                            data=data)
 
         # TODO: Flask issue? FlaskClient.__exit__ isn't cleaning up properly...
-        #pylint: disable=W0212
-        flask._request_ctx_stack.pop()
+        _pop_request_context()
+
+        return response
+
+    @contextmanager
+    def scenario(self, session=None, user_id=None):
+        """
+        Run a multi-step flow through one test client, keeping its cookies
+        (and so the session) between steps. Yields a ViewScenario, whose
+        run_view method works like this one's:
+
+            with self.scenario(user_id=11) as scn:
+                scn.run_view('/messages/new', 'POST', data=...,
+                             expect_redir='/messages')
+                scn.run_view('/messages', expect_tmpl='messages.html')
+
+        session and user_id set up the session once, before the first step.
+        """
+        with config.get_app().test_client() as client:
+            _setup_session(client, session, user_id)
+            yield ViewScenario(self, client)
+
+        _pop_request_context()
+
+    def run_view_many(self, specs):
+        """
+        Run a table of view tests, all through one test client. specs is a
+        list of dicts, each holding run_view's arguments (path, and optionally
+        method, session, data, user_id and expect_*s) plus an optional 'name'
+        to report it by. It can also be the name of a .json, .yaml or .csv file
+        of specs; see load_view_specs.
+
+        Cookies are cleared between specs, so each starts with a fresh
+        session. Every spec is run, and the failures are reported together.
+        Returns the list of responses (None for specs that failed).
+        """
+        if isinstance(specs, basestring):
+            specs = load_view_specs(specs)
+        runs = [_parse_view_spec(i, spec) for i, spec in enumerate(specs)]
+
+        responses = []
+        failures = []
+        with config.get_app().test_client() as client:
+            for name, session, user_id, open_kwargs, expects in runs:
+                if client.cookie_jar is not None:
+                    client.cookie_jar.clear()
+                timings = collections.OrderedDict()
+                try:
+                    with _timer(timings, 'session'):
+                        _setup_session(client, session, user_id)
+                    responses.append(
+                        self._open_and_check(client, expects, timings,
+                                             replay_as=(session, user_id),
+                                             **open_kwargs))
+                except AssertionError, exc:
+                    failures.append("%s: %s" % (name, exc))
+                    responses.append(None)
+
+        _pop_request_context()
+
+        if failures:
+            self.fail("%d of %d view specs failed:\n%s" %
+                      (len(failures), len(runs), "\n".join(failures)))
+        return responses
+
+    def benchmark_view(self,
+                       path,
+                       method='GET',
+                       session=None,
+                       data=None,
+                       user_id=None,
+                       rounds=100,
+                       warmup=10,
+                       **expects):
+        """
+        Time a view over many requests through one client, and return a dict
+        of statistics: rounds, and min, max, mean, median, p95 and stddev in
+        milliseconds, plus ops_per_sec.
+
+        The first request is checked against expects, as in run_view. Then
+        warmup requests are made and thrown away, and rounds requests are
+        timed. Only use this on views that are safe to repeat.
+
+        If config.set_benchmark_baseline_file is set, the median is compared
+        with the stored baseline for this test and request; see there.
+        """
+        _check_expect_names(expects)
+
+        with config.get_app().test_client() as client:
+            _setup_session(client, session, user_id)
+            open_kwargs = {'path': path, 'method': method, 'data': data}
+            self._open_and_check(client, expects,
+                                 replay_as=(session, user_id), **open_kwargs)
+
+            for _ in range(warmup):
+                client.open(**open_kwargs)
+            times = []
+            for _ in range(rounds):
+                start = timeit.default_timer()
+                client.open(**open_kwargs)
+                times.append((timeit.default_timer() - start) * 1000)
+
+        _pop_request_context()
+
+        stats = _summarize(times)
+        test_id = self.id() if hasattr(self, 'id') else type(self).__name__
+        self._check_benchmark_baseline("%s:%s %s" % (test_id, method, path),
+                                       stats)
+        return stats
+
+    def _read_stream(self, expects, response, start):
+        """
+        Read a streamed response's body chunk by chunk, without keeping it,
+        checking expect_chunks and expect_max_ttfb_ms as it arrives. start is
+        when the request was made. Returns the stream's stats.
+        """
+        checks = expects.get('expect_chunks', [])
+        if callable(checks):
+            checks = [checks]
+        budget = expects.get('expect_max_ttfb_ms')
 
+        stats = {'ttfb_ms': None, 'chunks': 0, 'bytes': 0,
+                 'max_chunk_bytes': 0}
+        try:
+            for chunk in response.response:
+                if stats['ttfb_ms'] is None and chunk:
+                    stats['ttfb_ms'] = (timeit.default_timer() - start) * 1000
+                    self._check_ttfb(budget, stats['ttfb_ms'])
+                stats['chunks'] += 1
+                stats['bytes'] += len(chunk)
+                stats['max_chunk_bytes'] = max(stats['max_chunk_bytes'],
+                                               len(chunk))
+                for check in checks:
+                    check(chunk)
+        finally:
+            response.close()
+
+        # An empty body's first byte is as good as there when it ends
+        if stats['ttfb_ms'] is None:
+            stats['ttfb_ms'] = (timeit.default_timer() - start) * 1000
+            self._check_ttfb(budget, stats['ttfb_ms'])
+        return stats
+
+    def _check_ttfb(self, budget, actual):
+        """
+        Check the time to a streamed response's first byte against the
+        expect_max_ttfb_ms budget, if there is one
+        """
+        if budget is not None and actual > budget:
+            self.fail("Expected first byte within %.1f ms, took %.1f ms"
+                      % (budget, actual))
+
+    def _check_benchmark_baseline(self, key, stats):
+        """
+        Compare stats with the stored baseline for key, recording them if
+        there is no baseline yet (or baselines are being updated)
+        """
+        path, threshold = config.get_benchmark_baseline_file()
+        if path is None:
+            return
+
+        baseline = _read_benchmark_baselines(path).get(key)
+        if baseline is None or os.environ.get('VIEWUNIT_UPDATE_BENCHMARKS'):
+            _record_benchmark_baseline(path, key, stats)
+            return
+
+        limit = baseline['median'] * (1 + threshold)
+        if stats['median'] > limit:
+            self.fail("Benchmark %s regressed: median %.2f ms, baseline "
+                      "%.2f ms (+%.0f%%, allowed +%.0f%%)" %
+                      (key, stats['median'], baseline['median'],
+                       (stats['median'] / baseline['median'] - 1) * 100,
+                       threshold * 100))
+
+    def _open_and_check(self, client, expects, timings=None, profile=False,
+                        stream=False, replay_as=None, **open_kwargs):
+        """
+        Make a request with the client, check the expects against it and
+        return the response. Phase timings are added to timings. replay_as is
+        the (session, user_id) to record the request for replay with (see
+        replay.py), or None to leave it out.
+        """
+        _check_stream_expects(expects, stream)
+        if timings is None:
+            timings = collections.OrderedDict()
+        if stream:
+            open_kwargs = dict(open_kwargs, buffered=False)
+        start = timeit.default_timer()
+        with _timer(timings, 'request'):
+            response, profile_file = self._open(client, profile, open_kwargs)
+        if replay_as is not None:
+            replay.record(open_kwargs['path'], open_kwargs['method'],
+                          replay_as[0], open_kwargs['data'], replay_as[1],
+                          response.status_code)
+        response.viewunit_timings = timings
+        response.viewunit_profile = profile_file
+        response.viewunit_stream = None
+        if stream:
+            with _timer(timings, 'stream'):
+                response.viewunit_stream = self._read_stream(expects, response,
+                                                             start)
+        _record_in_ledger(response)
+
+        with _timer(timings, 'tmpl_data'):
+            response.template_data = _get_tmpl_data()
+        response.viewunit_templates = _get_templates()
+        response.viewunit_queries = list(_get_queries())
+        self._check_expects(expects, response, flask.session)
+        if 'expect_p95_ms' in expects:
+            self._check_p95(expects['expect_p95_ms'], client, response,
+                            open_kwargs)
         return response
 
+    def _open(self, client, profile, open_kwargs):
+        """
+        Make a request with the client, profiling it if asked to. Returns the
+        response and the profile's file name (or None).
+        """
+        profile_dir = _profile_dir(profile)
+        if profile_dir is None:
+            return client.open(**open_kwargs), None
+
+        profiler = cProfile.Profile()
+        response = profiler.runcall(client.open, **open_kwargs)
+
+        self._profile_count = getattr(self, '_profile_count', 0) + 1
+        test_id = self.id() if hasattr(self, 'id') else type(self).__name__
+        filename = os.path.join(profile_dir, '%s.%d.prof' % (
+            test_id.replace(os.sep, '_'), self._profile_count))
+        profiler.dump_stats(filename)
+        return response, filename
+
+    # Run each test in a transaction that's rolled back at the end, instead
+    # of calling dbTearDown
+    transactional = False
+
+    # Rows to load before each test: a dict of table name => list of dicts,
+    # the tables each table references, and the columns to delete rows by,
+    # if not 'id'
+    fixtures = None
+    fixture_dependencies = None
+    fixture_keys = None
+
     def start_full(self):
         """
         Set up for full view testing.
@@ -152,9 +502,42 @@ class ViewTestMixin(object):
         config.get_app().config['CSRF_ENABLED'] = False
 
         self.teardown_hooks = []
+        self._pending_well_formed = []
 
-        if callable(getattr(self, 'dbSetUp', None)):
-            self.dbSetUp()
+        class_fixtures = callable(getattr(self, 'dbSetUpClass', None))
+        self._fixtures = None
+        self._fixture_deletes = []
+        try:
+            if class_fixtures:
+                self._fixtures = fixtures.set_up(self)
+            if self.transactional:
+                _begin_test_transaction()
+            if class_fixtures and self._fixtures is None:
+                self.dbSetUpClass()
+            if self.fixtures:
+                fixtures.load(self.fixtures, self.fixture_dependencies,
+                              self.fixture_keys, self._fixture_deletes)
+            if callable(getattr(self, 'dbSetUp', None)):
+                self.dbSetUp()
+            if self.transactional:
+                get_test_connection().savepoint()
+        except Exception:
+            # tearDown won't run, so undo everything here, and report the
+            # original error even if that fails
+            exc_info = sys.exc_info()
+            try:
+                if not self.transactional:
+                    fixtures.unload(self._fixture_deletes)
+            except Exception, exc:
+                print 'Exception unloading fixtures:', exc
+            finally:
+                if self.transactional:
+                    _end_test_transaction()
+                fixtures.tear_down(self._fixtures)
+                config.get_app().config['CSRF_ENABLED'] = \
+                    self._old_csrf_enabled
+                config.get_app().testing = self._was_testing
+            raise exc_info[0], exc_info[1], exc_info[2]
 
     def end_full(self):
         """
@@ -163,16 +546,28 @@ class ViewTestMixin(object):
         Should be called from tearDown.
         """
         try:
-            for func in self.teardown_hooks:
-                func()
-            if hasattr(self, 'dbTearDown') and callable(self.dbTearDown):
-                self.dbTearDown()
-        except Exception, exc:
-            print 'Exception during teardown hook:', exc
-            raise
+            self._check_pending_well_formed()
         finally:
-            config.get_app().config['CSRF_ENABLED'] = self._old_csrf_enabled
-            config.get_app().testing = self._was_testing
+            try:
+                for func in self.teardown_hooks:
+                    func()
+                if not self.transactional and \
+                        hasattr(self, 'dbTearDown') and \
+                        callable(self.dbTearDown):
+                    self.dbTearDown()
+                # After dbTearDown, which may delete rows referencing them
+                if not self.transactional:
+                    fixtures.unload(self._fixture_deletes)
+            except Exception, exc:
+                print 'Exception during teardown hook:', exc
+                raise
+            finally:
+                if self.transactional:
+                    _end_test_transaction()
+                fixtures.tear_down(self._fixtures)
+                config.get_app().config['CSRF_ENABLED'] = \
+                    self._old_csrf_enabled
+                config.get_app().testing = self._was_testing
 
     def dbSetUp(self):
         """
@@ -192,13 +587,26 @@ class ViewTestMixin(object):
         postconditions specified specified in the list of expects fail to be
         met
         """
-        self._check_request_var_expects(expects, response, session)
-        self._check_form_errors(expects)
-        self._check_db_expects(expects)
-        self._check_flashes_expects(expects)
-        self._check_json(expects, response)
-        self._check_response_expects(expects, response)
-        self._check_well_formed(expects, response)
+        timings = getattr(response, 'viewunit_timings', {})
+        with _timer(timings, 'request_vars'):
+            self._check_request_var_expects(expects, response, session)
+        with _timer(timings, 'form_errors'):
+            self._check_form_errors(expects)
+        with _timer(timings, 'db'):
+            self._check_db_expects(expects)
+        with _timer(timings, 'flashes'):
+            self._check_flashes_expects(expects)
+        with _timer(timings, 'json'):
+            self._check_json(expects, response)
+        with _timer(timings, 'response'):
+            self._check_response_expects(expects, response)
+        with _timer(timings, 'well_formed'):
+            self._check_well_formed(expects, response)
+        self._check_max_ms(expects, response)
+        self._check_query_expects(expects, response)
+        self._check_snapshot(expects, response)
+        with _timer(timings, 'full_scans'):
+            self._check_full_scans(expects, response)
 
     def _check_well_formed(self, expects, response):
         """
@@ -207,36 +615,219 @@ class ViewTestMixin(object):
         # Caller can pass expect_well_formed = False to skip this check.
         if not expects.get('expect_well_formed', True):
             return
+        # A streamed body has already been read, and wasn't kept
+        if getattr(response, 'viewunit_stream', None) is not None:
+            return
 
         # If the content-type is text/html and the status code was 200 validate
         # the HTML is well formed.
         # Does not follow redirects.
         if 'text/html' in response.headers['Content-Type'] \
                 and response.status_code == 200:
-            parser = html5lib.HTMLParser(strict=True)
-            try:
-                parser.parse(response.data)
-            except html5lib.html5parser.ParseError:
-                template = _get_tmpl_called()
+            if config.get_well_formed_workers() is not None:
+                self._pending_well_formed.append(
+                    (validation.check_html_async(response.data),
+                     _get_tmpl_called(),
+                     flask.request.path))
+                return
+
+            result = validation.check_html_cached(response.data)
+            if result is not None:
+                error, element, line = result
+                self.fail('Template %s is not well formed %s - %s line: %s'
+                          % (_get_tmpl_called(), error, element, line))
 
-                line = str(parser.errors[0][0][0])
-                error = parser.errors[0][1]
+    def _check_pending_well_formed(self):
+        """
+        Collect the results of well formed checks sent to the worker pool by
+        this test's run_views, and fail if any page wasn't well formed.
+        """
+        pending = self._pending_well_formed
+        self._pending_well_formed = []
+
+        failures = []
+        for check, template, path in pending:
+            result = check.result()
+            if result is not None:
+                error, element, line = result
+                failures.append(
+                    'Template %s is not well formed %s - %s line: %s (%s)'
+                    % (template, error, element, line, path))
+        if failures:
+            self.fail('\n'.join(failures))
+
+    def _check_max_ms(self, expects, response):
+        """
+        Check that the request (including reading a streamed body) finished
+        within expect_max_ms
+        """
+        if 'expect_max_ms' not in expects:
+            return
 
-                element = None
-                if 'name' in parser.errors[0][2]:
-                    element = parser.errors[0][2]['name']
-                self.fail('Template %s is not well formed %s - %s line: %s'
-                          % (template, error, element, line))
+        budget = expects['expect_max_ms']
+        timings = response.viewunit_timings
+        actual = timings['request'] + timings.get('stream', 0)
+        if actual > budget:
+            self.fail("Expected request to take at most %.1f ms, took %.1f ms"
+                      % (budget, actual))
+
+    def _check_query_expects(self, expects, response):
+        """
+        Check the number of statements the view ran, and how often it repeated
+        the same (normalized) statement
+        """
+        queries = getattr(response, 'viewunit_queries', [])
+        if 'expect_max_queries' in expects:
+            max_queries = expects['expect_max_queries']
+            if len(queries) > max_queries:
+                self.fail("Expected at most %d queries, found %d:\n%s" %
+                          (max_queries, len(queries),
+                           "\n".join("  %s" % (sql,) for sql, _ in queries)))
+
+        if 'expect_no_repeated_queries' in expects:
+            max_repeats = int(expects['expect_no_repeated_queries'])
+            counts = collections.OrderedDict()
+            for sql, _params in queries:
+                normalized = normalize_sql(sql)
+                counts[normalized] = counts.get(normalized, 0) + 1
+            repeated = [(sql, count) for sql, count in counts.items()
+                        if count > max_repeats]
+            if repeated:
+                self.fail("Found queries run more than %d time(s):\n%s" %
+                          (max_repeats,
+                           "\n".join("  %dx %s" % (count, sql)
+                                     for sql, count in repeated)))
+
+    def _check_full_scans(self, expects, response):
+        """
+        EXPLAIN the statements the view ran, and fail on full table scans
+        """
+        if not expects.get('expect_no_full_scans'):
+            return
+
+        expect = expects['expect_no_full_scans']
+        if expect is True:
+            allowlist = config.get_full_scan_allowlist()
+            is_flagged = lambda table: table not in allowlist
+        else:
+            is_flagged = frozenset(expect).__contains__
+
+        dialect = config.get_db_explain_dialect()
+        scans = []
+        seen = set()
+        for sql, params in getattr(response, 'viewunit_queries', []):
+            normalized = normalize_sql(sql)
+            if normalized in seen or \
+                    not normalized.startswith(_EXPLAINABLE_STATEMENTS):
+                continue
+            seen.add(normalized)
+
+            if params and isinstance(params, list) and \
+                    isinstance(params[0], (list, tuple, dict)):
+                # executemany; any one set of parameters will do
+                params = params[0]
+            plan = _explain(self.db_select, dialect, sql, params or [])
+            tables = [table for table in _scanned_tables(dialect, plan, sql)
+                      if is_flagged(table)]
+            if tables:
+                scans.append("  %s\n    scans %s:\n%s" % (
+                    sql, ", ".join(tables),
+                    "\n".join("      %s" % line for line in plan)))
+
+        if scans:
+            self.fail("View ran full table scans:\n" + "\n".join(scans))
+
+    def _check_p95(self, expect, client, response, open_kwargs):
+        """
+        Repeat the request, and check the 95th percentile of its times
+        against the expect_p95_ms budget
+        """
+        if isinstance(expect, (tuple, list)):
+            budget, runs = expect
+        else:
+            budget, runs = expect, P95_RUNS
+
+        times = [response.viewunit_timings['request'] +
+                 response.viewunit_timings.get('stream', 0)]
+        for _ in range(runs - 1):
+            timings = {}
+            with _timer(timings, 'request'):
+                repeat = client.open(**open_kwargs)
+                if response.viewunit_stream is not None:
+                    _drain(repeat)
+            times.append(timings['request'])
+
+        actual = percentile(times, 95)
+        if actual > budget:
+            self.fail("Expected p95 request time of at most %.1f ms, found "
+                      "%.1f ms over %d runs (min %.1f, median %.1f, max %.1f)"
+                      % (budget, actual, len(times), min(times),
+                         percentile(times, 50), max(times)))
 
-    #pylint: disable=R0201
     def _check_json(self, expects, response):
         """
         Check that the expected json data matches what is going to be sent by
-        the response object.
+        the response object. The body is decoded once, however many json
+        expects look at it.
         """
         if 'expect_json' in expects:
             json_data = expects['expect_json']
-            eq_(json_data, json.loads(response.data))
+            eq_(json_data, _get_json(response))
+
+        for selector in expects.get('expect_json_has', []):
+            ok_(jsonpath.select(_get_json(response),
+                                jsonpath.parse(selector)),
+                "Couldn't find '%s' in json" % selector)
+
+        if 'expect_json_data' in expects:
+            mismatches = []
+            for selector, expected in sorted(
+                    expects['expect_json_data'].items()):
+                mismatches.extend(_diff_json(_get_json(response), selector,
+                                             expected))
+            if mismatches:
+                failure = self.failureException(
+                    matchers.describe('json', mismatches))
+                failure.mismatches = mismatches
+                raise failure
+
+    def _check_snapshot(self, expects, response):
+        """
+        Compare the response with its stored snapshot, if expect_snapshot
+        asks for it (recording it if it hasn't been)
+        """
+        expect = expects.get('expect_snapshot')
+        if not expect:
+            return
+
+        directory, headers = config.get_snapshot_store()
+        if isinstance(expect, basestring):
+            name = expect
+        else:
+            # Numbered, so a test can snapshot the same request more than
+            # once (as different users, say)
+            self._snapshot_count = getattr(self, '_snapshot_count', 0) + 1
+            test_id = (self.id() if hasattr(self, 'id')
+                       else type(self).__name__)
+            name = "%s:%s %s #%d" % (test_id, flask.request.method,
+                                     flask.request.full_path.rstrip('?'),
+                                     self._snapshot_count)
+
+        snapshot = {
+            'status': response.status_code,
+            'headers': dict((header, response.headers[header])
+                            for header in headers
+                            if header in response.headers),
+            'tmpl': _get_tmpl_called(),
+            'tmpl_data': response.template_data,
+            'body': response.data,
+        }
+        differences = snapshots.check(
+            directory, name, snapshot,
+            update=bool(os.environ.get('VIEWUNIT_UPDATE_SNAPSHOTS')))
+        if differences:
+            self.fail("Response doesn't match snapshot %s:\n%s" %
+                      (name, "\n".join("  " + line for line in differences)))
 
     def _check_response_expects(self, expects, response):
         """
@@ -265,6 +856,16 @@ class ViewTestMixin(object):
                 "Expected tmpl to be '%s', found '%s'" % (
                     expect_tmpl, _get_tmpl_called()))
 
+        if 'expect_tmpls' in expects:
+            eq_(expects['expect_tmpls'],
+                [tmpl.name for tmpl in response.viewunit_templates],
+                "Expected tmpls to be %s, found %s" % (
+                    expects['expect_tmpls'],
+                    [tmpl.name for tmpl in response.viewunit_templates]))
+        if 'expect_max_render_ms' in expects:
+            _check_render_ms(expects['expect_max_render_ms'],
+                             response.viewunit_templates)
+
         redirect_url = _extract_path(response.headers.get('Location', None))
         equals = [("expect_redir", redirect_url)]
         for exp_name, actual_val in equals:
@@ -282,11 +883,8 @@ class ViewTestMixin(object):
                     ("expect_header_data", response.headers)]
         for exp_name, actual_dict in contains:
             if exp_name in expects:
-                for key, exp_val in expects[exp_name].items():
-                    self._check_contains(_show(exp_name),
-                                         key,
-                                         exp_val,
-                                         actual_dict)
+                self._check_contains(_show(exp_name), expects[exp_name],
+                                     actual_dict)
 
         has = [("expect_tmpl_has", _get_tmpl_data()),
                ("expect_session_has", session)]
@@ -338,44 +936,40 @@ class ViewTestMixin(object):
 
     def _check_db_expects(self, expects):
         """
-        Check for db postconditions
+        Check for db postconditions. If a batch select hook is configured, all
+        the pairs are checked with a single query; otherwise each pair gets its
+        own query through the db_select hook.
         """
-        if 'expect_db_has' in expects:
-            for table, dct in expects["expect_db_has"]:
-                clauses = []
-                values = []
-                for k, v in dct.items():
-                    if v is None:
-                        clauses.append("%s is null" % k)
-                    else:
-                        clauses.append("%s = %%s" % k)
-                        values.append(v)
-                rows = self.db_select(
-                    "SELECT * FROM " + table + " WHERE " +
-                    " AND ".join(clauses),
-                    values)
-                if len(rows) == 0:
-                    self.fail("In db table '%(table)s', couldn't find "
-                              "data specified by %(dct)s" % locals())
-
-        if "expect_db_lacks" in expects:
-            for table, dct in expects["expect_db_lacks"]:
-                clauses = []
-                values = []
-                for k, v in dct.items():
-                    if v is None:
-                        clauses.append("%s is null" % k)
-                    else:
-                        clauses.append("%s = %%s" % k)
-                        values.append(v)
-                rows = self.db_select(
-                    "SELECT * FROM " + table + " WHERE " +
-                    " AND ".join(clauses),
-                    values)
-                if len(rows) > 0:
-                    self.fail(
-                        "In db table '%(table)s', found data which should "
-                        "not be present: %(dct)s" % locals())
+        checks = ([(True, table, dct)
+                   for table, dct in expects.get('expect_db_has', [])] +
+                  [(False, table, dct)
+                   for table, dct in expects.get('expect_db_lacks', [])])
+        if not checks:
+            return
+
+        batch_select = config.get_db_batch_select_hook()
+        if batch_select is None:
+            found = (self._db_row_exists(table, dct)
+                     for _expected, table, dct in checks)
+        else:
+            found = _db_batch_exists(batch_select, checks)
+
+        for (expected, table, dct), present in itertools.izip(checks, found):
+            if expected and not present:
+                self.fail("In db table '%(table)s', couldn't find "
+                          "data specified by %(dct)s" % locals())
+            if not expected and present:
+                self.fail(
+                    "In db table '%(table)s', found data which should "
+                    "not be present: %(dct)s" % locals())
+
+    def _db_row_exists(self, table, dct):
+        """
+        Return whether table has a row matching dct, via the db_select hook
+        """
+        where, values = _db_where(dct)
+        rows = self.db_select("SELECT 1 FROM " + table + where, values)
+        return len(rows) > 0
 
     def _check_flashes_expects(self, expects):
         """
@@ -389,72 +983,35 @@ class ViewTestMixin(object):
                 self.fail('Found no flashes, but expected at least %s' %
                           len(expects['expect_flashes_has']))
 
-            for (category, pattern) in expects['expect_flashes_has']:
-                has_match = False
-                for fcategory, message in flashes:
-                    if fcategory == category and re.search(pattern, message):
-                        has_match = True
-                if not has_match:
-                    self.fail('flash (%s, %s) not found' % (category, pattern))
+            pairs = [tuple(pair) for pair in expects['expect_flashes_has']]
+            found = _matching_flash_patterns(pairs, flashes)
+            missing = ['flash (%s, %s) not found' % pair
+                       for i, pair in enumerate(pairs) if i not in found]
+            if missing:
+                self.fail('\n'.join(missing))
 
         if 'expect_flashes_lacks' in expects and flashes:
-            for category, pattern in expects['expect_flashes_lacks']:
-                has_match = False
-                for fcategory, message in flashes:
-                    if fcategory == category and re.search(pattern, message):
-                        has_match = False
-                if has_match:
-                    self.fail('flash (%s, %s) found' % (category, pattern))
-
-    def _check_contains(self, exp_name, key, val, dict_or_inst):
-        """Check that a given actual dictionary or instance contains the value
-        at the key or method specified.  If the expected value is a List
-        or Dict, work recursively to check containment.  Signal failure via
-        the nose.tools assert functions."""
-        if hasattr(dict_or_inst, key):
-            actual_val = getattr(dict_or_inst, key)
-            if callable(actual_val):
-                actual_val = actual_val()
-        elif hasattr(dict_or_inst, '__contains__'):
-            if not key in dict_or_inst:
-                self.fail("%s was missing key '%s'" % (exp_name, key))
-            actual_val = dict_or_inst[key]
-        else:
-            self.fail("%s was missing attr/method '%s'" % (exp_name, key))
-
-        if isinstance(val, types.ListType):
-            self._check_lists(exp_name, val, actual_val)
-        elif isinstance(val, types.DictType):
-            val_dict = val
-            for inner_key, inner_val in val_dict.items():
-                self._check_contains(exp_name, inner_key, inner_val,
-                                     actual_val)
-        else:
-            eq_(val, actual_val,
-                "While examining %s, expected key '%s' to yield %s, found %s" %
-                (exp_name, key, repr(val), repr(actual_val)))
-
-    def _check_lists(self, exp_name, exp_list, actual_list):
-        """Check that the expected list and actual list contain the same
-        data, in the same order.  If an element of the expected list is a
-        Dict or a List, recursively check them."""
-        if len(exp_list) != len(actual_list):
-            self.fail(
-                "In examining %s, expected list:\n%s\n\nFound list:\n%s" %
-                (exp_name,
-                 pprint.pformat(exp_list),
-                 pprint.pformat(actual_list)))
-        for exp_val, actual_val in zip(exp_list, actual_list):
-            if isinstance(exp_val, types.ListType):
-                self._check_lists(exp_name + " >>", exp_val, actual_val)
-            elif isinstance(exp_val, types.DictType):
-                for k, v in exp_val.items():
-                    self._check_contains(exp_name, k, v, actual_val)
-            else:
-                eq_(exp_val,
-                    actual_val,
-                    "In examining %s, within a list, expected %s, found %s" %
-                    (exp_name, exp_val, actual_val))
+            pairs = [tuple(pair) for pair in expects['expect_flashes_lacks']]
+            found = _matching_flash_patterns(pairs, flashes)
+            if found:
+                self.fail('\n'.join('flash (%s, %s) found' % pairs[i]
+                                    for i in sorted(found)))
+
+    def _check_contains(self, exp_name, expected, dict_or_inst):
+        """
+        Check that a given actual dictionary or instance contains the
+        expected dict's values at its keys (or attributes/methods), working
+        recursively through dicts and lists (see matchers.py). Every
+        difference is reported; the failure's mismatches attribute holds them
+        as matchers.Mismatch tuples.
+        """
+        mismatches = matchers.diff(expected, dict_or_inst)
+        if mismatches:
+            failure = self.failureException(
+                matchers.describe(exp_name, mismatches))
+            failure.mismatches = mismatches
+            raise failure
+
     #pylint: enable=R0914
 
     def db_select(self, *args, **kwargs):
@@ -466,18 +1023,80 @@ class ViewTestMixin(object):
     #pylint: enable=R0201
 
 
+class ViewScenario(object):
+    """
+    A series of requests made with one test client; see
+    ViewTestMixin.scenario.
+    """
+
+    def __init__(self, test, client):
+        self.test = test
+        self.client = client
+
+    def run_view(self,
+                 path,
+                 method='GET',
+                 data=None,
+                 follow_redirects=False,
+                 profile=False,
+                 stream=False,
+                 **expects):
+        """
+        Run one step of the scenario, checking expects (and timing,
+        profiling and streaming) just like ViewTestMixin.run_view. With
+        follow_redirects, the expects are checked against the final response.
+        """
+        _check_expect_names(expects)
+        #pylint: disable=W0212
+        return self.test._open_and_check(self.client, expects,
+                                         profile=profile,
+                                         stream=stream,
+                                         path=path,
+                                         method=method,
+                                         data=data,
+                                         follow_redirects=follow_redirects)
+
+
+# Compiled expect_flashes patterns, by their (category, pattern) pairs
+_FLASH_REGEXES = {}
+_FLASH_REGEXES_SIZE = 1000
+
+# Flash patterns that change meaning inside a bigger regex: backreferences
+# and inline flags
+_UNCOMBINABLE = re.compile(r'\\[1-9]|\(\?P=|\(\?[iLmsux]')
+
+# Most groups Python 2's re allows in one regex (its limit of 100 counts
+# group 0)
+_MAX_GROUPS = 99
+
+# How many times expect_p95_ms runs a view, unless told otherwise
+P95_RUNS = 20
+
 TMPL_CALLED = "test_tmpl_called"
 TMPL_DATA = "test_tmpl_data"
+TMPL_DATA_VIEW = "test_tmpl_data_view"
+TEMPLATES = "test_templates"
+QUERIES = "test_queries"
 
 
 def _get_tmpl_data():
     """
-    Return a (single) dictionary of all data passed to the template.  Meaning,
-    flatten the search list into a single dictionary (but make sure that the
-    order of dict merging properly favors keys from *earlier* dicts in the list
-    over later).
+    Return a (single) mapping of all data passed to the template.  A Cheetah
+    search list is presented as one read-only mapping that favors keys from
+    *earlier* dicts in the list over later, without copying them. The mapping
+    is built once per request.
+    """
+    tmpl_data = getattr(flask.g, TMPL_DATA_VIEW, None)
+    if tmpl_data is None:
+        tmpl_data = _template_data_view(getattr(flask.g, TMPL_DATA, None))
+        setattr(flask.g, TMPL_DATA_VIEW, tmpl_data)
+    return tmpl_data
+
+
+def _template_data_view(tmpl_data):
+    """
+    Return the mapping _get_tmpl_data presents for tmpl_data
     """
-    tmpl_data = getattr(flask.g, TMPL_DATA, None)
     if not tmpl_data:
         return {}
 
@@ -490,14 +1109,88 @@ def _get_tmpl_data():
         # Okay, assume we have a list
         pass
 
-    search_list = tmpl_data
+    return _SearchList(tmpl_data)
 
-    result = {}
-    # Reverse so that we search in proper order
-    for d in reversed(search_list):
-        result.update(d)
 
-    return result
+class _SearchList(collections.Mapping):
+    """
+    A read-only view of a list of dicts as one mapping, where keys in earlier
+    dicts hide the same keys in later ones. Values are only looked up when
+    asked for.
+    """
+
+    def __init__(self, maps):
+        self._maps = maps
+        self._keys = None
+
+    def __getitem__(self, key):
+        for mapping in self._maps:
+            if key in mapping:
+                return mapping[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return any(key in mapping for mapping in self._maps)
+
+    def __iter__(self):
+        return iter(self._key_list())
+
+    def __len__(self):
+        return len(self._key_list())
+
+    def _key_list(self):
+        """
+        Return (and remember) the keys, in the order they're first found
+        """
+        if self._keys is None:
+            seen = set()
+            self._keys = []
+            for mapping in self._maps:
+                for key in mapping:
+                    if key not in seen:
+                        seen.add(key)
+                        self._keys.append(key)
+        return self._keys
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def _db_where(dct):
+    """
+    Return a (' WHERE ...', values) pair matching the columns in dct, where
+    None values match NULL.
+    """
+    clauses = []
+    values = []
+    for k, v in dct.items():
+        if v is None:
+            clauses.append("%s is null" % k)
+        else:
+            clauses.append("%s = %%s" % k)
+            values.append(v)
+    if not clauses:
+        return "", values
+    return " WHERE " + " AND ".join(clauses), values
+
+
+def _db_batch_exists(batch_select, checks):
+    """
+    Return a list of booleans, one per (expected, table, dct) check, saying
+    whether a matching row exists. Runs one EXISTS query for all the checks.
+    """
+    columns = []
+    values = []
+    for i, (_expected, table, dct) in enumerate(checks):
+        where, where_values = _db_where(dct)
+        columns.append("EXISTS (SELECT 1 FROM %s%s) AS e%d" %
+                       (table, where, i))
+        values.extend(where_values)
+
+    row = batch_select("SELECT " + ", ".join(columns), values)[0]
+    if hasattr(row, 'keys'):
+        return [bool(row['e%d' % i]) for i in range(len(checks))]
+    return [bool(row[i]) for i in range(len(checks))]
 
 
 def _dot(obj, attr):
@@ -523,18 +1216,385 @@ def _get_tmpl_called():
 
 def template_called(name, data):
     """
-    Mark the template as called for this request
+    Mark the template as called for this request. Every template is recorded,
+    in order, with its data (not a copy); the first is the one expect_tmpl
+    and friends check.
     """
-    # Only record the first template per request
     if not hasattr(flask.g, TMPL_CALLED):
         flask.g.test_tmpl_called = name
         flask.g.test_tmpl_data = data
+        flask.g.test_templates = []
+    # [name, data, ms], filled in by record_templates if it's timing
+    flask.g.test_templates.append([name, data, None])
+
+
+def record_templates(render):
+    """
+    Wrap an app's render function, so that it calls template_called and
+    records how long each template takes to render, for
+    expect_max_render_ms. render is called as render(name, data, ...):
+
+        @viewunit.record_templates
+        def render(name, data):
+            return flask.render_template(name, **data)
+    """
+    @functools.wraps(render)
+    def recording_render(name, data, *args, **kwargs):
+        """
+        Record the template, and time rendering it
+        """
+        template_called(name, data)
+        record = flask.g.test_templates[-1]
+        start = timeit.default_timer()
+        try:
+            return render(name, data, *args, **kwargs)
+        finally:
+            record[2] = (timeit.default_timer() - start) * 1000
+    return recording_render
+
+
+# A template rendered during a request, with its data and render time in
+# milliseconds (None if it wasn't timed)
+RenderedTemplate = collections.namedtuple('RenderedTemplate',
+                                          ['name', 'data', 'ms'])
+
+
+def _get_templates():
+    """
+    Return the templates rendered during this request, as RenderedTemplates
+    """
+    return [RenderedTemplate(*record)
+            for record in getattr(flask.g, TEMPLATES, [])]
+
+
+def _check_render_ms(budget, templates):
+    """
+    Check that each template rendered within budget: a number of
+    milliseconds, or a dict of template name => milliseconds
+    """
+    for tmpl in templates:
+        limit = budget.get(tmpl.name) if isinstance(budget, dict) else budget
+        if limit is None:
+            continue
+        ok_(tmpl.ms is not None,
+            "No render time for tmpl '%s'. Is your render() function "
+            "wrapped with viewunit.record_templates()?" % tmpl.name)
+        ok_(tmpl.ms <= limit,
+            "Expected tmpl '%s' to render in at most %.1f ms, took %.1f ms" %
+            (tmpl.name, limit, tmpl.ms))
+
+
+def query_executed(sql, params=None):
+    """
+    Record a database statement run during this request, for
+    expect_max_queries and expect_no_repeated_queries. Statements run outside
+    of a request (in dbSetUp, say) are ignored.
+
+    Call this from your app's database layer, or wrap its connection factory
+    with record_queries to have it called for you.
+    """
+    if flask.has_request_context():
+        if not hasattr(flask.g, QUERIES):
+            flask.g.test_queries = []
+        flask.g.test_queries.append((sql, params))
+
+
+def record_queries(connect):
+    """
+    Wrap a DB-API connection factory, so that statements run through its
+    connections' cursors (or sqlite3's connection.execute shortcuts) are
+    recorded with query_executed. For example, in your viewunit setup:
+
+        mydb.connect = viewunit.record_queries(mydb.connect)
+    """
+    @functools.wraps(connect)
+    def recording_connect(*args, **kwargs):
+        """
+        Open a connection whose statements are recorded
+        """
+        return _RecordingConnection(connect(*args, **kwargs))
+    return recording_connect
+
+
+class _RecordingConnection(object):
+    """
+    A DB-API connection proxy whose cursors record their statements
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, *args, **kwargs):
+        """
+        Return a recording cursor
+        """
+        return _RecordingCursor(self._conn.cursor(*args, **kwargs))
+
+    def execute(self, sql, *args):
+        """
+        sqlite3's execute shortcut
+        """
+        query_executed(sql, args[0] if args else None)
+        return self._conn.execute(sql, *args)
+
+    def executemany(self, sql, seq_of_params):
+        """
+        sqlite3's executemany shortcut
+        """
+        seq_of_params = list(seq_of_params)
+        query_executed(sql, seq_of_params)
+        return self._conn.executemany(sql, seq_of_params)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class _RecordingCursor(object):
+    """
+    A DB-API cursor proxy that records its statements
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, *args):
+        """
+        Record and run a statement
+        """
+        query_executed(sql, args[0] if args else None)
+        return self._cursor.execute(sql, *args)
+
+    def executemany(self, sql, seq_of_params):
+        """
+        Record and run a statement against a sequence of parameters
+        """
+        seq_of_params = list(seq_of_params)
+        query_executed(sql, seq_of_params)
+        return self._cursor.executemany(sql, seq_of_params)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+_TEST_DB = threading.local()
+
+# Taken after dbSetUp, so that an app's rollback keeps the fixtures
+_SAVEPOINT = 'viewunit_test'
+
+
+def get_test_connection():
+    """
+    Return the connection a transactional test (see
+    ViewTestMixin.transactional) is running in, or None outside of one. The
+    app's database layer, dbSetUp and the db_select hook should use it when
+    it's there, so they all see the test's uncommitted writes.
+    """
+    return getattr(_TEST_DB, 'connection', None)
+
+
+def transactional_connect(connect):
+    """
+    Wrap a DB-API connection factory, so that during transactional tests it
+    returns the test's connection instead of opening a new one. For example,
+    in your viewunit setup:
+
+        mydb.connect = viewunit.transactional_connect(mydb.connect)
+    """
+    @functools.wraps(connect)
+    def test_or_new_connection(*args, **kwargs):
+        """
+        Return the test's connection, if there is one, or a new one
+        """
+        conn = get_test_connection()
+        if conn is None:
+            conn = connect(*args, **kwargs)
+        return conn
+    return test_or_new_connection
+
+
+def _begin_test_transaction():
+    """
+    Open the test connection, and start its transaction
+    """
+    conn = config.get_db_connection_hook()()
+    if isinstance(conn, sqlite3.Connection):
+        # sqlite3 commits before DDL statements on its own, unless it's left
+        # to us to manage transactions
+        conn.isolation_level = None
+        conn.execute("BEGIN")
+    _TEST_DB.connection = _TestConnection(conn)
+
+
+def _end_test_transaction():
+    """
+    Roll back and close the test connection
+    """
+    conn = _TEST_DB.__dict__.pop('connection', None)
+    if conn is not None:
+        conn.end()
+
+
+class _TestConnection(object):
+    """
+    A DB-API connection proxy for transactional tests. commit and close do
+    nothing, and rollback only goes back to the state after dbSetUp, so the
+    app can't end the test's transaction.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._savepoint = False
+
+    def savepoint(self):
+        """
+        Mark the state rollback returns to
+        """
+        self._conn.cursor().execute("SAVEPOINT " + _SAVEPOINT)
+        self._savepoint = True
+
+    def commit(self):
+        """
+        Leave the changes for the test's rollback
+        """
+        pass
+
+    def rollback(self):
+        """
+        Undo changes made since dbSetUp
+        """
+        if self._savepoint:
+            self._conn.cursor().execute("ROLLBACK TO SAVEPOINT " +
+                                        _SAVEPOINT)
+
+    def close(self):
+        """
+        Keep the connection open for the rest of the test
+        """
+        pass
+
+    def end(self):
+        """
+        Roll back the test's transaction, and really close the connection
+        """
+        try:
+            if isinstance(self._conn, sqlite3.Connection):
+                # Python's sqlite3 doesn't know about our BEGIN
+                self._conn.execute("ROLLBACK")
+            else:
+                self._conn.rollback()
+        finally:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, _exc_value, _traceback):
+        if exc_type is not None:
+            self.rollback()
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+_SQL_LITERAL_RE = re.compile(r"""'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b""")
+_SQL_PLACEHOLDER_RE = re.compile(r"%\(\w+\)s|%s|\?|(?<!:):\w+")
+_SQL_IN_LIST_RE = re.compile(r"\bin\s*\((?:\s*\?\s*,)*\s*\?\s*\)", re.I)
+_SQL_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    """
+    Return sql with literals and placeholders replaced by '?', IN lists
+    collapsed and whitespace and case normalized, so that statements which
+    differ only in their parameters compare equal
+    """
+    sql = _SQL_LITERAL_RE.sub("?", sql)
+    sql = _SQL_PLACEHOLDER_RE.sub("?", sql)
+    sql = _SQL_IN_LIST_RE.sub("in (?)", sql)
+    return _SQL_SPACE_RE.sub(" ", sql).strip().lower()
+
+
+_EXPLAINABLE_STATEMENTS = ('select', 'with', 'insert', 'update', 'delete')
+_SQLITE_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\S+)(?: AS (\S+))?$")
+_POSTGRES_SCAN_RE = re.compile(r"Seq Scan on (\S+)(?: (\w+))?")
+
+# The tables a statement reads or writes (up to the end of its FROM clause),
+# and each table (with its alias, if any) in that list
+_FROM_CLAUSE_RE = re.compile(
+    r"\b(?:from|update)\s+(.*?)(?=\b(?:where|group\s+by|order\s+by|limit|"
+    r"having|union|returning|set)\b|[();]|$)", re.I | re.S)
+_TABLE_REF_RE = re.compile(
+    r"""(?:^|,|\bjoin\b)\s*([\w."]+)
+       (?:\s+(?:as\s+)?
+          (?!(?:on|using|left|right|inner|outer|full|cross|natural|join)\b)
+          (\w+))?""", re.I | re.X)
+
+
+def _explain(db_select, dialect, sql, params):
+    """
+    Return the query plan for sql as a list of lines, using db_select
+    """
+    prefix = "EXPLAIN QUERY PLAN " if dialect == 'sqlite' else "EXPLAIN "
+    lines = []
+    for row in db_select(prefix + sql, params):
+        if hasattr(row, 'keys'):
+            lines.append(row['detail'] if 'detail' in row
+                         else row.values()[-1])
+        else:
+            lines.append(row[-1])
+    return lines
+
+
+def _scanned_tables(dialect, plan, sql):
+    """
+    Return the names of the tables the query plan for sql scans in full.
+    Plans can name a table by its alias (SQLite's only show the alias), so
+    those are looked up in sql.
+    """
+    aliases = _table_aliases(sql)
+    tables = []
+    for line in plan:
+        if dialect == 'sqlite':
+            match = _SQLITE_SCAN_RE.match(line.strip())
+        else:
+            match = _POSTGRES_SCAN_RE.search(line)
+        if match:
+            name, alias = match.groups()
+            tables.append(name if alias else
+                          aliases.get(name.lower(), name))
+    return tables
+
+
+def _table_aliases(sql):
+    """
+    Return a dict of alias (lowercased) => table name for the tables in sql's
+    FROM (and UPDATE) clauses
+    """
+    aliases = {}
+    for clause in _FROM_CLAUSE_RE.findall(sql):
+        for table, alias in _TABLE_REF_RE.findall(clause):
+            if alias:
+                aliases[alias.lower()] = table.replace('"', '')
+    return aliases
+
+
+def _get_queries():
+    """
+    Return the list of (sql, params) statements recorded for this request
+    """
+    return getattr(flask.g, QUERIES, [])
 
 EXPECT_LIST = [
     "tmpl",
     "tmpl_has",
     "tmpl_lacks",
     "tmpl_data",
+    "tmpls",
+    "max_render_ms",
     "form_errors",
     "cookie_data",
     "header_data",
@@ -547,9 +1607,24 @@ EXPECT_LIST = [
     "flashes_has",
     "flashes_lacks",
     "json",
+    "json_has",
+    "json_data",
     "response",
-    "well_formed"
+    "well_formed",
+    "max_ms",
+    "p95_ms",
+    "max_queries",
+    "no_repeated_queries",
+    "no_full_scans",
+    "snapshot",
+    "chunks",
+    "max_ttfb_ms"
 ]
+
+# Expects that only apply to streamed responses, and ones that need the whole
+# body (so can't be used with them)
+STREAM_EXPECTS = ["chunks", "max_ttfb_ms"]
+BODY_EXPECTS = ["json", "json_has", "json_data", "well_formed", "snapshot"]
 EXPECT_DICT = dict([("expect_" + e, True) for e in EXPECT_LIST])
 
 
@@ -566,6 +1641,324 @@ def _check_expect_names(expects):
             raise Exception("List of expects has unknown key: " + k)
 
 
+_VIEW_SPEC_ARGS = ["name", "path", "method", "session", "data", "user_id"]
+
+
+def load_view_specs(filename):
+    """
+    Load a list of run_view_many specs from a file, by extension:
+
+     - .json: a list of spec dicts
+     - .yaml/.yml: a list of spec dicts (needs PyYAML)
+     - .csv: a header row naming spec keys, then one row per spec. The name,
+       path and method cells are plain strings; the rest are JSON. Empty cells
+       are left out of the spec.
+    """
+    lower = filename.lower()
+    with open(filename) as spec_file:
+        if lower.endswith('.json'):
+            return json.load(spec_file)
+        if lower.endswith(('.yaml', '.yml')):
+            import yaml
+            return yaml.safe_load(spec_file)
+        if lower.endswith('.csv'):
+            specs = []
+            for row in csv.DictReader(spec_file):
+                spec = {}
+                for key, cell in row.items():
+                    if not cell:
+                        continue
+                    if key in ('name', 'path', 'method'):
+                        spec[key] = cell
+                    else:
+                        spec[key] = json.loads(cell)
+                specs.append(spec)
+            return specs
+    raise Exception("Unknown view spec file type: " + filename)
+
+
+def _parse_view_spec(index, spec):
+    """
+    Validate a run_view_many spec, and split it into a
+    (name, session, user_id, open_kwargs, expects) tuple.
+    """
+    expects = dict((k, v) for k, v in spec.items()
+                   if k not in _VIEW_SPEC_ARGS)
+    _check_expect_names(expects)
+    if 'path' not in spec:
+        raise Exception("View spec #%d has no path" % index)
+
+    method = spec.get('method', 'GET')
+    name = spec.get('name') or "spec #%d (%s %s)" % (index, method,
+                                                       spec['path'])
+    open_kwargs = {'path': spec['path'],
+                   'method': method,
+                   'data': spec.get('data')}
+    return (name, spec.get('session'), spec.get('user_id'), open_kwargs,
+            expects)
+
+
+def percentile(values, pct):
+    """
+    Return the pct'th percentile of a list of numbers, by the nearest-rank
+    method
+    """
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def _check_stream_expects(expects, stream):
+    """
+    Verify that streaming expects are only used with stream=True, and ones
+    that need the whole body aren't
+    """
+    if stream:
+        for name in BODY_EXPECTS:
+            if expects.get("expect_" + name, False) is not False:
+                raise Exception("expect_%s needs the whole response body, so "
+                                "can't be used with stream=True" % name)
+    else:
+        for name in STREAM_EXPECTS:
+            if "expect_" + name in expects:
+                raise Exception("expect_%s needs stream=True" % name)
+
+
+def _matching_flash_patterns(pairs, flashes):
+    """
+    Return the set of indexes of the (category, pattern) pairs whose pattern
+    is found (as by re.search) in a flashed message of their category.
+    flashes is a list of (category, message) pairs.
+    """
+    regexes = _compile_flash_patterns(tuple(pairs))
+    found = set()
+    for category, message in flashes:
+        for regex, index in regexes.get(category, ()):
+            if index is not None:
+                if regex.search(message):
+                    found.add(index)
+                continue
+            for name, value in regex.match(message).groupdict().iteritems():
+                if value is not None:
+                    found.add(int(name[1:]))
+        if len(found) == len(pairs):
+            break
+    return found
+
+
+def _compile_flash_patterns(pairs):
+    """
+    Return a dict of category => list of (regex, index) for a tuple of
+    (category, pattern) pairs, compiling them the first time they're seen.
+
+    Each category's patterns are combined into one regex, of an optional
+    lookahead per pattern, whose named group p<index> is set if the pattern
+    is found; its index is None. A category with more groups than re allows
+    gets several combined regexes. Patterns that can't be combined (with
+    backreferences, named groups or inline flags, or too many groups) get
+    their own regex, with their index.
+    """
+    regexes = _FLASH_REGEXES.get(pairs)
+    if regexes is not None:
+        return regexes
+
+    by_category = collections.OrderedDict()
+    for index, (category, pattern) in enumerate(pairs):
+        by_category.setdefault(category, []).append((index, pattern))
+
+    regexes = {}
+    for category, patterns in by_category.items():
+        combined = []
+        groups = 0
+        regexes[category] = []
+        for index, pattern in patterns:
+            regex = re.compile(pattern)
+            if regex.groupindex or _UNCOMBINABLE.search(pattern) or \
+                    regex.groups >= _MAX_GROUPS:
+                regexes[category].append((regex, index))
+                continue
+            if groups + 1 + regex.groups > _MAX_GROUPS:
+                regexes[category].append(
+                    (re.compile(''.join(combined)), None))
+                combined = []
+                groups = 0
+            combined.append(r'(?:(?=[\s\S]*?(?P<p%d>%s)))?' %
+                            (index, pattern))
+            groups += 1 + regex.groups
+        if combined:
+            regexes[category].append((re.compile(''.join(combined)), None))
+
+    if len(_FLASH_REGEXES) >= _FLASH_REGEXES_SIZE:
+        _FLASH_REGEXES.clear()
+    _FLASH_REGEXES[pairs] = regexes
+    return regexes
+
+
+def _read_benchmark_baselines(path):
+    """
+    Return the benchmark baselines stored at path, or {} if there are none
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def _record_benchmark_baseline(path, key, stats):
+    """
+    Store stats as key's baseline in the file at path. A lock file next to it
+    is held (where fcntl is available) while the baselines are re-read and
+    the file is renamed into place, so parallel test processes recording
+    baselines at once don't drop each other's.
+    """
+    with open(path + '.lock', 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            baselines = _read_benchmark_baselines(path)
+            baselines[key] = stats
+            handle, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+            with os.fdopen(handle, 'w') as baseline_file:
+                json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+            # Windows won't rename over an existing file
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _get_json(response):
+    """
+    Return the response body decoded as json, decoding it the first time
+    it's asked for and keeping it in response.viewunit_json
+    """
+    if not hasattr(response, 'viewunit_json'):
+        response.viewunit_json = json.loads(response.data)
+    return response.viewunit_json
+
+
+def _diff_json(document, selector, expected):
+    """
+    Return the ways the values selector finds in document don't contain
+    expected, as matchers.Mismatches with paths from the top of document
+    """
+    steps = jsonpath.parse(selector)
+    found = jsonpath.select(document, steps)
+    wildcard = jsonpath.has_wildcard(steps)
+    if not found and not (wildcard and expected == []):
+        return [matchers.Mismatch(steps, 'missing', expected, None)]
+
+    if not wildcard:
+        pairs = [(found[0][0], expected, found[0][1])]
+    elif not isinstance(expected, list):
+        pairs = [(path, expected, value) for path, value in found]
+    elif len(expected) != len(found):
+        return [matchers.Mismatch(steps, 'length', len(expected),
+                                  [value for _, value in found])]
+    else:
+        pairs = [(path, exp, value)
+                 for (path, value), exp in zip(found, expected)]
+
+    return [mismatch._replace(path=path + mismatch.path)
+            for path, exp, value in pairs
+            for mismatch in matchers.diff(exp, value)]
+
+
+def _pop_request_context():
+    """
+    Pop the request context a test client leaves behind, if there is one,
+    along with its app context. (Views using flask.stream_with_context push
+    theirs twice, and the client only pops it once.)
+    """
+    #pylint: disable=W0212
+    ctx = flask._request_ctx_stack.top
+    if ctx is not None:
+        ctx.pop()
+
+
+def _drain(response):
+    """
+    Read and throw away a streamed response's body
+    """
+    try:
+        for _ in response.response:
+            pass
+    finally:
+        response.close()
+
+
+def _record_in_ledger(response):
+    """
+    Add the request just made to the latency ledger, if one is configured
+    """
+    path = config.get_latency_ledger()
+    if path is None:
+        return
+
+    # Streamed bodies weren't kept, so can't be measured again
+    stream = response.viewunit_stream
+    timings = response.viewunit_timings
+    url_rule = flask.request.url_rule
+    ledger.record(path,
+                  url_rule.rule if url_rule is not None else None,
+                  flask.request.method,
+                  response.status_code,
+                  timings['request'] + timings.get('stream', 0),
+                  (response.calculate_content_length() if stream is None
+                   else stream['bytes']),
+                  _get_tmpl_called())
+
+
+def _summarize(times):
+    """
+    Return a dict of statistics about a list of millisecond timings
+    """
+    mean = sum(times) / len(times)
+    variance = sum((t - mean) ** 2 for t in times) / len(times)
+    return {'rounds': len(times),
+            'min': min(times),
+            'max': max(times),
+            'mean': mean,
+            'median': percentile(times, 50),
+            'p95': percentile(times, 95),
+            'stddev': math.sqrt(variance),
+            'ops_per_sec': 1000.0 / mean if mean else float('inf')}
+
+
+@contextmanager
+def _timer(timings, phase):
+    """
+    Add the milliseconds spent in the with block to timings[phase]
+    """
+    start = timeit.default_timer()
+    try:
+        yield
+    finally:
+        timings[phase] = (timings.get(phase, 0) +
+                          (timeit.default_timer() - start) * 1000)
+
+
+def _profile_dir(profile):
+    """
+    Return the directory to save a run_view profile in (creating it if
+    need be), or None if the run_view shouldn't be profiled
+    """
+    env_dir = os.environ.get('VIEWUNIT_PROFILE_DIR')
+    if isinstance(profile, basestring):
+        directory = profile
+    elif profile or env_dir:
+        directory = env_dir or 'viewunit_profiles'
+    else:
+        return None
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+
 def _extract_path(url):
     """
     Extract and return the path from a url.  If an empty string is passed in,
@@ -663,6 +2056,20 @@ def _get_cookies(headers):
         return result
 
 
+def _setup_session(client, session, user_id):
+    """
+    Set up the client's session with user_id logged in, plus the contents of
+    the session dict. Skips the session round trip if there's nothing to set.
+    """
+    if session is None and user_id is None:
+        return
+
+    with client.session_transaction() as test_session:
+        set_session_user_id(test_session, user_id)
+        if session is not None:
+            test_session.update(session)
+
+
 def set_session_user_id(test_session, user_id):
     """
     If user_id is None, this is a noop.
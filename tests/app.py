@@ -8,7 +8,10 @@ one file for this example.
 See tests/test_example.py for an example of using ViewUnit, and
 tests/app_test.py for an example of configuring it.
 """
+import atexit
 import os
+import sqlite3
+import tempfile
 from uuid import uuid4
 
 import flask
@@ -23,13 +26,59 @@ app.secret_key = uuid4().hex  # DON'T DO THIS in a real-world situation, or
                               # sessions will expire on every app restart.
 
 
+# A throwaway SQLite database, standing in for the app's real one
+DB_FILE = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY,
+                                     user_id INTEGER REFERENCES users (id),
+                                     body TEXT);
+CREATE INDEX IF NOT EXISTS messages_user_id ON messages (user_id);
+"""
+
+
+def connect():
+    """
+    Open a connection to the app's database. Tests wrap this to watch the
+    queries views make (see app_test.py).
+    """
+    return sqlite3.connect(DB_FILE)
+
+
+def get_db():
+    """
+    Get this request's database connection.
+    """
+    if not hasattr(flask.g, 'db'):
+        flask.g.db = connect()
+    return flask.g.db
+
+
+@app.teardown_request
+def close_db(_exc):
+    """
+    Close the request's database connection, if it opened one.
+    """
+    db = flask.g.pop('db', None)
+    if db is not None:
+        db.close()
+
+
+conn = connect()
+conn.executescript(SCHEMA)
+conn.close()
+atexit.register(os.remove, DB_FILE)
+
+
+@viewunit.record_templates
 def render(name, data):
     """
     To use the template verification of viewunit (expect_tmpl and
-    expect_tmpl_has), you'll need to provide your own call to render that will
-    intercept the arguments before passing them on to flask.render_template.
+    expect_tmpl_has), you'll need to provide your own call to render that
+    passes the arguments to viewunit.template_called before passing them on to
+    flask.render_template. Wrapping it with viewunit.record_templates does
+    that, and times the render too.
     """
-    viewunit.template_called(name, data)
     return flask.render_template(name, **data)
 
 
@@ -60,3 +109,81 @@ def get_user_id():
     data in there, make sure it's also in your set_session_user implementation.
     """
     return flask.session.get('user_id')
+
+
+# A page with a stray end tag, for exercising expect_well_formed
+@app.route('/malformed', methods=['GET'])
+def malformed():
+    """
+    Return a page that isn't well formed HTML.
+    """
+    return "<!DOCTYPE html><html><body><p>Oops</b></p></body></html>"
+
+
+# A stand-in for a login form, for exercising multi-step flows
+@app.route('/login', methods=['POST'])
+def login():
+    """
+    Log in as the posted user_id, and go to the index page.
+    """
+    flask.session['user_id'] = int(flask.request.form['user_id'])
+    return flask.redirect(flask.url_for('index'))
+
+
+# Lists users and their messages, one query per user unless ?join=1 is given
+@app.route('/users', methods=['GET'])
+def users():
+    """
+    Show every user along with their messages.
+    """
+    db = get_db()
+    if flask.request.args.get('join'):
+        rows = db.execute("SELECT u.id, u.name, m.body "
+                          "FROM users u LEFT JOIN messages AS m "
+                          "ON m.user_id = u.id "
+                          "ORDER BY u.id, m.id").fetchall()
+        by_user = {}
+        for user_id, name, body in rows:
+            by_user.setdefault((user_id, name), [])
+            if body is not None:
+                by_user[(user_id, name)].append(body)
+        user_list = [{'name': name, 'messages': bodies}
+                     for (_id, name), bodies in sorted(by_user.items())]
+    else:
+        user_list = []
+        for user_id, name in db.execute(
+                "SELECT id, name FROM users ORDER BY id").fetchall():
+            bodies = [body for (body,) in db.execute(
+                "SELECT body FROM messages WHERE user_id = ? ORDER BY id",
+                (user_id,)).fetchall()]
+            user_list.append({'name': name, 'messages': bodies})
+
+    return flask.jsonify(users=user_list)
+
+
+# Renders a fragment per letter, then the page, for exercising expect_tmpls
+@app.route('/letters', methods=['GET'])
+def letters():
+    """
+    Show a greeting fragment for each letter in the querystring.
+    """
+    fragments = [render("letter.html", {'letter': letter})
+                 for letter in flask.request.args.get('letters', 'ab')]
+    return render("letters.html", {'fragments': fragments})
+
+
+# Streams a CSV a row at a time, for exercising run_view(stream=True)
+@app.route('/export', methods=['GET'])
+def export():
+    """
+    Stream a CSV of as many numbered rows as the querystring asks for.
+    """
+    rows = int(flask.request.args.get('rows', 10))
+
+    def generate():
+        yield 'id,name\n'
+        for row in xrange(rows):
+            yield '%d,row %d\n' % (row, row)
+
+    return flask.Response(flask.stream_with_context(generate()),
+                          mimetype='text/csv')
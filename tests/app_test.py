@@ -4,7 +4,10 @@ configuration code at the module level of a file that you have to import in
 order to access the ViewTestCase, like this.
 """
 
+import sqlite3
+
 from flask.ext import viewunit
+import app as app_module
 from app import app
 
 
@@ -19,10 +22,55 @@ def set_session_user(test_session, user_id):
     test_session['user_id'] = user_id
 
 
-# Configure ViewUnit to use app and the above session setter. If there were a
-# database portion of this test, the select function should be registered here
+# Viewunit database hook, for expect_db_has and friends. Our app uses SQLite,
+# whose placeholders are ? rather than viewunit's %s.
+def db_select(sql, params):
+    """
+    Run a select against the app's database, returning a list of rows.
+    Transactional tests' writes are only visible on the test's connection.
+    """
+    conn = viewunit.get_test_connection()
+    if conn is not None:
+        return conn.execute(sql.replace('%s', '?'), params).fetchall()
+
+    conn = sqlite3.connect(app_module.DB_FILE)
+    try:
+        return conn.execute(sql.replace('%s', '?'), params).fetchall()
+    finally:
+        conn.close()
+
+
+# Viewunit fixture hook, for declaring fixtures on test classes
+def db_execute(sql, seq_of_params):
+    """
+    Run a statement against the app's database once per parameter tuple.
+    """
+    conn = viewunit.get_test_connection()
+    if conn is not None:
+        conn.executemany(sql.replace('%s', '?'), seq_of_params)
+        return
+
+    conn = sqlite3.connect(app_module.DB_FILE)
+    try:
+        with conn:
+            conn.executemany(sql.replace('%s', '?'), seq_of_params)
+    finally:
+        conn.close()
+
+
+# Configure ViewUnit to use app, the above session setter and database hooks
 viewunit.config.set_app(app)
 viewunit.config.set_session_user_setter(set_session_user)
+viewunit.config.set_db_select_hook(db_select)
+viewunit.config.set_db_execute_hook(db_execute)
+
+# Transactional tests run on one connection to the app's database, which the
+# app's views share
+viewunit.config.set_db_connection_hook(app_module.connect)
+app_module.connect = viewunit.transactional_connect(app_module.connect)
+
+# Record the queries the app's views make, for expect_max_queries
+app_module.connect = viewunit.record_queries(app_module.connect)
 
 
 # This is so your tests can say 'from app_test import ViewTestCase
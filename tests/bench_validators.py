@@ -0,0 +1,75 @@
+"""
+Benchmark of the expect_well_formed validators on large generated pages.
+
+Run it from the tests directory:
+
+    python bench_validators.py [rows]
+
+Not collected by nose, since it takes a while.
+"""
+import sys
+import timeit
+
+from flask.ext.viewunit import validation
+
+
+def make_page(rows):
+    """
+    Generate a page with a table-free list and some prose per row, in the
+    style of a typical listing view.
+    """
+    items = []
+    for i in range(rows):
+        items.append(
+            '<li class="row" id="row-%d"><a href="/items/%d">Item %d</a> '
+            '<span class="price">&#36;%d.00</span>'
+            '<p>Some <em>descriptive</em> text &amp; more.</p></li>'
+            % (i, i, i, i))
+    return ('<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8">'
+            '<title>Items</title></head>\n<body>\n<div><h1>Items</h1>'
+            '<ul>%s</ul></div>\n</body>\n</html>\n' % '\n'.join(items))
+
+
+def make_html5_page(rows):
+    """
+    Like make_page, but with HTML5 elements that lxml doesn't know, and a
+    form that the prescreen won't accept, so the fast validator has to fall
+    back to html5lib.
+    """
+    return make_page(rows).replace('<div>', '<section><form><select>'
+                                   '<option>a</option></select></form>'
+                                   ).replace('</div>', '</section>')
+
+
+def bench(name, validator, page, number=5):
+    """
+    Print the average time validator takes on page
+    """
+    seconds = timeit.timeit(lambda: validator(page), number=number) / number
+    print '%-40s %8.1f ms' % (name, seconds * 1000)
+
+
+def main():
+    """
+    Compare the validators on a few kinds of page
+    """
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    page = make_page(rows)
+    html5_page = make_html5_page(rows)
+    print 'Page size: %d bytes, lxml %s' % (
+        len(page), 'installed' if validation.etree is not None else 'missing')
+
+    bench('html5lib', validation.check_html, page)
+    bench('fast (prescreen)', validation.fast_check_html, page)
+    bench('prescreen only', validation._prescreen, page)
+    if validation.etree is not None:
+        bench('lenient (prescreen, lxml)', validation.lenient_check_html,
+              page)
+        bench('lxml only', validation._lxml_clean, page)
+    bench('html5lib, html5 page', validation.check_html, html5_page)
+    bench('fast, html5 page (fallback)', validation.fast_check_html,
+          html5_page)
+
+
+if __name__ == '__main__':
+    main()
@@ -25,3 +25,18 @@ class ExampleTest(ViewTestCase):
         self.run_view('/',
                       user_id=11,
                       expect_tmpl_data={'user_name': 'user #11'})
+
+    def test_login_flow(self):
+        # Scenarios keep the session cookie between steps
+        with self.scenario() as scn:
+            scn.run_view('/', expect_tmpl_data={'user_name': 'new user'})
+            scn.run_view('/login', 'POST',
+                         data={'user_id': 5},
+                         expect_redir='/')
+            scn.run_view('/', expect_tmpl_data={'user_name': 'user #5'})
+
+        with self.scenario() as scn:
+            scn.run_view('/login', 'POST',
+                         data={'user_id': 6},
+                         follow_redirects=True,
+                         expect_tmpl_data={'user_name': 'user #6'})
@@ -0,0 +1,223 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from nose.tools import eq_, ok_
+
+from flask.ext.viewunit import config, fixtures
+import app as app_module
+from app_test import ViewTestCase
+
+
+def count_rows(table='users'):
+    """
+    Count the rows in a table
+    """
+    conn = sqlite3.connect(app_module.DB_FILE)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM " + table).fetchone()[0]
+    finally:
+        conn.close()
+
+
+class UserFixtureTest(ViewTestCase):
+    """
+    Tests sharing class-level fixtures, run by SnapshotTest.
+    """
+    __test__ = False
+    builds = []
+
+    def dbSetUpClass(self):
+        self.builds.append(1)
+        conn = sqlite3.connect(app_module.DB_FILE)
+        with conn:
+            conn.executemany("INSERT INTO users (id, name) VALUES (?, ?)",
+                             [(1, 'alice'), (2, 'bob')])
+        conn.close()
+
+    def dbTearDown(self):
+        if config.get_fixture_snapshots()[0] is None:
+            conn = sqlite3.connect(app_module.DB_FILE)
+            with conn:
+                conn.execute("DELETE FROM users")
+            conn.close()
+
+    def test_fixtures(self):
+        self.run_view('/users', expect_json={'users': [
+            {'name': 'alice', 'messages': []},
+            {'name': 'bob', 'messages': []}]})
+
+    def test_changes_are_undone(self):
+        conn = sqlite3.connect(app_module.DB_FILE)
+        with conn:
+            conn.execute("DELETE FROM users WHERE id = 1")
+        conn.close()
+        eq_(1, count_rows())
+
+
+class FailingClassSetUpTest(UserFixtureTest):
+    """
+    Class-level fixtures that fail after inserting rows, run by
+    SnapshotTest.test_failed_set_up.
+    """
+    __test__ = False
+
+    def dbSetUpClass(self):
+        super(FailingClassSetUpTest, self).dbSetUpClass()
+        raise ValueError("dbSetUpClass failed")
+
+
+class SnapshotTest(unittest.TestCase):
+    """
+    Tests for snapshots of dbSetUpClass fixtures.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        del UserFixtureTest.builds[:]
+        fixtures._SNAPSHOTS.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        fixtures._SNAPSHOTS.clear()
+
+    def run_fixture_suite(self):
+        result = unittest.TestResult()
+        unittest.TestSuite(
+            [UserFixtureTest('test_changes_are_undone'),
+             UserFixtureTest('test_fixtures'),
+             UserFixtureTest('test_changes_are_undone')]).run(result)
+        eq_([], result.failures + result.errors)
+        eq_(0, count_rows())
+
+    def test_snapshots(self):
+        with config.override():
+            config.set_fixture_snapshots(app_module.DB_FILE, self.directory)
+            self.run_fixture_suite()
+            eq_(1, len(UserFixtureTest.builds))
+            snapshots = os.listdir(self.directory)
+            eq_(1, len(snapshots))
+            ok_(snapshots[0].startswith(
+                'test_fixtures.UserFixtureTest-'), snapshots[0])
+
+            # A later run uses the snapshot on disk
+            fixtures._SNAPSHOTS.clear()
+            self.run_fixture_suite()
+            eq_(1, len(UserFixtureTest.builds))
+
+    def test_failed_set_up(self):
+        app = config.get_app()
+        with config.override():
+            config.set_fixture_snapshots(app_module.DB_FILE, self.directory)
+            result = unittest.TestResult()
+            FailingClassSetUpTest('test_fixtures').run(result)
+        eq_(1, len(result.errors))
+        ok_(result.errors[0][1].strip().endswith(
+            "ValueError: dbSetUpClass failed"), result.errors[0][1])
+        eq_(0, count_rows())
+        eq_([], os.listdir(self.directory))
+        eq_((False, None), (app.testing, app.config.get('CSRF_ENABLED')))
+
+    def test_without_snapshots(self):
+        self.run_fixture_suite()
+        eq_(3, len(UserFixtureTest.builds))
+
+
+class DeclaredFixtureTest(ViewTestCase):
+    """
+    Tests for declarative fixtures.
+    """
+    fixtures = {
+        'messages': [{'user_id': 1, 'body': 'hi'},
+                     {'user_id': 1, 'body': None},
+                     {'user_id': 2, 'body': 'yo'}],
+        'users': [{'id': 1, 'name': 'alice'}, {'id': 2, 'name': 'bob'}],
+    }
+    fixture_dependencies = {'messages': ['users']}
+
+    def test_fixtures(self):
+        self.run_view('/users?join=1', expect_json={'users': [
+            {'name': 'alice', 'messages': ['hi']},
+            {'name': 'bob', 'messages': ['yo']}]})
+        eq_(3, len(self.db_select("SELECT * FROM messages", [])))
+
+    def test_load_order(self):
+        eq_(['users', 'messages', 'others'],
+            fixtures._load_order(['messages', 'others', 'users'],
+                                 {'messages': ['users'],
+                                  'others': ['messages', 'missing']}))
+        try:
+            fixtures._load_order(['a', 'b'], {'a': ['b'], 'b': ['a']})
+            ok_(False, "Expected an exception for a dependency cycle")
+        except Exception, exc:
+            eq_("Fixture tables depend on each other: a -> b -> a",
+                str(exc))
+
+    def test_bulk_load(self):
+        rows = [{'id': i, 'name': 'user %d' % i} for i in range(3, 10003)]
+        start = time.time()
+        deletes = fixtures.load({'users': rows})
+        fixtures.unload(deletes)
+        elapsed = time.time() - start
+        eq_(2, count_rows('users'))
+        ok_(elapsed < 2, "Loading 10k rows took %.2f s" % elapsed)
+
+
+class TransactionalFixtureTest(DeclaredFixtureTest):
+    """
+    Declarative fixtures in a transactional test, run by test_cleanup.
+    """
+    __test__ = False
+    transactional = True
+
+
+class FailingSetUpTest(DeclaredFixtureTest):
+    """
+    Declarative fixtures in a test whose dbSetUp fails, run by
+    test_failed_set_up.
+    """
+    __test__ = False
+
+    def dbSetUp(self):
+        raise ValueError("dbSetUp failed")
+
+
+class FailingLoadTest(DeclaredFixtureTest):
+    """
+    Declarative fixtures that fail to load after the users are inserted, run
+    by test_failed_set_up.
+    """
+    __test__ = False
+    fixtures = dict(DeclaredFixtureTest.fixtures,
+                    messages=[{'user_id': 1, 'nosuch': 'column'}])
+
+
+class FixtureCleanupTest(unittest.TestCase):
+    """
+    Tests that declarative fixtures are cleaned up.
+    """
+
+    def test_cleanup(self):
+        result = unittest.TestResult()
+        unittest.TestSuite([DeclaredFixtureTest('test_fixtures'),
+                            TransactionalFixtureTest('test_fixtures'),
+                            DeclaredFixtureTest('test_fixtures')]).run(result)
+        eq_([], result.failures + result.errors)
+        eq_(0, count_rows('users'))
+        eq_(0, count_rows('messages'))
+
+    def test_failed_set_up(self):
+        result = unittest.TestResult()
+        unittest.TestSuite([FailingSetUpTest('test_fixtures'),
+                            FailingLoadTest('test_fixtures')]).run(result)
+        eq_([], result.failures)
+        eq_(2, len(result.errors))
+        ok_(result.errors[0][1].strip().endswith(
+            "ValueError: dbSetUp failed"), result.errors[0][1])
+        ok_("no column named nosuch" in result.errors[1][1],
+            result.errors[1][1])
+        eq_(0, count_rows('users'))
+        eq_(0, count_rows('messages'))
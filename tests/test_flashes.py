@@ -0,0 +1,80 @@
+import flask
+import mock
+from nose.tools import eq_, ok_
+
+from flask.ext.viewunit import viewunit
+from app import app
+from app_test import ViewTestCase
+
+
+def flashing_index():
+    """
+    Flash a few messages
+    """
+    flask.flash('Saved message 12')
+    flask.flash('Could not send\nto bob', 'error')
+    flask.flash('Could not send to carol', 'error')
+    return 'ok'
+
+
+class FlashTest(ViewTestCase):
+    """
+    Tests for the flash expects.
+    """
+
+    def run_flashing_view(self, **expects):
+        with mock.patch.dict(app.view_functions, {'index': flashing_index}):
+            return self.run_view('/', expect_well_formed=False, **expects)
+
+    def test_flashes(self):
+        self.run_flashing_view(
+            expect_flashes_has=[('message', r'^Saved'),
+                                ('message', r'message \d+'),
+                                ('error', 'to bob'),
+                                ['error', r'(b)o\1'],
+                                ('error', r'(?P<who>carol)')],
+            expect_flashes_lacks=[('message', 'bob'),
+                                  ('error', '^to bob'),
+                                  ('warning', 'Saved')])
+
+    def test_flash_failures(self):
+        try:
+            self.run_flashing_view(
+                expect_flashes_has=[('message', 'Saved'),
+                                    ('message', 'Deleted'),
+                                    ('error', 'Saved')])
+            ok_(False, "Expected AssertionError for missing flashes")
+        except AssertionError, exc:
+            eq_("flash (message, Deleted) not found\n"
+                "flash (error, Saved) not found", str(exc))
+
+        try:
+            self.run_flashing_view(
+                expect_flashes_lacks=[('error', 'carol'),
+                                      ('message', 'Deleted')])
+            ok_(False, "Expected AssertionError for an unwanted flash")
+        except AssertionError, exc:
+            eq_("flash (error, carol) found", str(exc))
+
+    def test_compiled_once(self):
+        pairs = (('error', 'a'), ('error', r'(\d)\1'), ('message', 'b'))
+        regexes = viewunit._compile_flash_patterns(pairs)
+        ok_(regexes is viewunit._compile_flash_patterns(pairs))
+        # The backreference gets its own regex
+        eq_([1, None], [index for _, index in regexes['error']])
+        eq_(set([0, 1]), viewunit._matching_flash_patterns(
+            pairs, [('error', 'a 11'), ('message', 'a')]))
+
+    def test_many_patterns(self):
+        pairs = [('error', r'(x)%d\b' % number) for number in range(120)]
+        regexes = viewunit._compile_flash_patterns(tuple(pairs))
+        eq_(3, len(regexes['error']))
+        ok_(all(regex.groups <= 99 for regex, _ in regexes['error']))
+        eq_(set([5, 119]), viewunit._matching_flash_patterns(
+            pairs, [('error', 'x5'), ('error', 'x119'), ('message', 'x7')]))
+
+        self.run_flashing_view(
+            expect_flashes_has=[('message', r'(m)essage \d{1,%d}' % number)
+                                for number in range(2, 122)],
+            expect_flashes_lacks=[('error', 'dave %d' % number)
+                                  for number in range(120)])
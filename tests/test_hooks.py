@@ -1,13 +1,17 @@
-from nose.tools import ok_
+import sqlite3
+import threading
 
-from flask.ext.viewunit import config, ViewTestCase
+import flask
+from nose.tools import eq_, ok_
+
+from flask.ext.viewunit import config, template_called, ViewTestCase
 from app import app
 
 
 class HookTest(ViewTestCase):
     """
-    All the flask hooks/functions use module-wide global state, so this is not
-    going to be entirely pretty. Sorry.
+    Each test runs inside a config.override, so the hooks it sets don't leak
+    into other tests.
     """
 
     def test_app_hook(self):
@@ -54,38 +58,104 @@ class HookTest(ViewTestCase):
         config.set_db_select_hook(db_select)
         self.run_view('/', expect_db_has=[('tables', {'foo': 1})])
 
-    def setUp(self):
-        """
-        Unset any viewunit hooks before tests
-        """
-        # Ignore Pylint errors for catching any exception type, for this little
-        # hacky section
-        # pylint: disable=W0702
-        try:
-            self._old_app = config.get_app()
-        except:
-            self._old_app = None
+    def test_db_batch_hook(self):
         config.set_app(app)
 
-        super(HookTest, self).setUp()
+        conn = sqlite3.connect(':memory:')
+        conn.execute("CREATE TABLE users (id INTEGER, name TEXT)")
+        conn.execute("INSERT INTO users VALUES (1, 'alice')")
+        conn.execute("INSERT INTO users VALUES (2, NULL)")
 
-        try:
-            self._old_session_hook = config.get_session_user_setter()
-        except:
-            self._old_session_hook = None
+        queries = []
+
+        def db_select(sql, params):
+            queries.append(sql)
+            return conn.execute(sql.replace('%s', '?'), params).fetchall()
+
+        config.set_db_batch_select_hook(db_select)
+        self.run_view('/',
+                      expect_db_has=[('users', {'id': 1, 'name': 'alice'}),
+                                     ('users', {'id': 2, 'name': None})],
+                      expect_db_lacks=[('users', {'id': 3}),
+                                       ('users', {'id': 1, 'name': None})])
+        eq_(1, len(queries))
 
         try:
-            self._old_db_hook = config.get_db_select_hook()
-        except:
-            self._old_db_hook = None
-        # pylint: enable=W0702
+            self.run_view('/',
+                          expect_db_has=[('users', {'id': 1})],
+                          expect_db_lacks=[('users', {'name': 'alice'})])
+            ok_(False, "Expected AssertionError for present data")
+        except AssertionError, exc:
+            ok_('found data which should not be present' in str(exc))
+
+    def setUp(self):
+        """
+        Unset any viewunit hooks before tests, for this thread only
+        """
+        self._override = config.override(app=app,
+                                         session_user_setter=None,
+                                         db_select=None,
+                                         db_batch_select=None)
+        self._override.__enter__()
+        super(HookTest, self).setUp()
 
     def tearDown(self):
         """
         Restore the viewunit state to where it was before the tests
         """
         super(HookTest, self).tearDown()
+        self._override.__exit__(None, None, None)
+
+
+class OverrideTest(ViewTestCase):
+    """
+    Tests for thread-local configuration overrides.
+    """
+
+    def test_override(self):
+        with config.override(db_select=lambda _sql, _params: [('a',)]):
+            eq_([('a',)], self.db_select('SELECT 1', []))
+            with config.override():
+                config.set_db_select_hook(lambda _sql, _params: [('b',)])
+                eq_([('b',)], self.db_select('SELECT 1', []))
+            eq_([('a',)], self.db_select('SELECT 1', []))
+
+        connect = lambda: None
+        with config.override(db_connection=connect):
+            ok_(config.get_db_connection_hook() is connect)
+
+        try:
+            config.override(not_a_hook=None).__enter__()
+            ok_(False, "Expected AssertionError for an unknown hook")
+        except AssertionError:
+            pass
 
-        config.set_app(self._old_app)
-        config.set_session_user_setter(self._old_session_hook)
-        config.set_db_select_hook(self._old_db_hook)
+    def test_threads(self):
+        other_app = flask.Flask(__name__)
+
+        @other_app.route('/')
+        def other_index():
+            template_called('other.html', {})
+            return 'other'
+
+        failures = []
+
+        def drive(thread_app, tmpl):
+            try:
+                with config.override(app=thread_app):
+                    for _ in range(20):
+                        self.run_view('/',
+                                      expect_tmpl=tmpl,
+                                      expect_well_formed=False)
+            except AssertionError, exc:
+                failures.append(exc)
+
+        threads = [threading.Thread(target=drive, args=args)
+                   for args in [(app, 'index.html'),
+                                (other_app, 'other.html')] * 2]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_([], failures)
+        eq_(app, config.get_app())
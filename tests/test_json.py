@@ -0,0 +1,76 @@
+import json
+
+import mock
+from nose.tools import eq_, ok_
+
+from flask.ext.viewunit import jsonpath
+from app_test import ViewTestCase
+
+
+class JsonTest(ViewTestCase):
+    """
+    Tests for selector-based json expects.
+    """
+    fixtures = {
+        'messages': [{'user_id': 1, 'body': 'hi'},
+                     {'user_id': 1, 'body': 'there'}],
+        'users': [{'id': 1, 'name': 'alice'}, {'id': 2, 'name': 'bob'}],
+    }
+    fixture_dependencies = {'messages': ['users']}
+
+    def test_selectors(self):
+        eq_(('users', 0, 'name'), jsonpath.parse('users[0].name'))
+        eq_(('users', jsonpath.ALL, 'a.b', -1),
+            jsonpath.parse('$.users[*]["a.b"][-1]'))
+        eq_((), jsonpath.parse('$'))
+        try:
+            jsonpath.parse('users[x]')
+            ok_(False, "Expected an exception for a bad selector")
+        except Exception, exc:
+            eq_("Bad JSON selector 'users[x]' at '[x]'", str(exc))
+
+        document = {'users': [{'name': 'a'}, {'name': 'b', 'id': 2}]}
+        eq_([(('users', 1, 'name'), 'b')],
+            jsonpath.select(document, jsonpath.parse('users[-1].name')))
+        eq_([(('users', 1, 'id'), 2)],
+            jsonpath.select(document, jsonpath.parse('users.*.id')))
+        eq_([], jsonpath.select(document, jsonpath.parse('users[2].name')))
+        eq_([], jsonpath.select(document, jsonpath.parse('users.name')))
+        eq_([(('*',), 1)],
+            jsonpath.select({'*': 1, 'a': 2}, jsonpath.parse('["*"]')))
+        eq_([(('*',), 1), (('a',), 2)],
+            jsonpath.select({'*': 1, 'a': 2}, jsonpath.parse('[*]')))
+
+    def test_json_expects(self):
+        with mock.patch('json.loads', side_effect=json.loads) as loads:
+            response = self.run_view(
+                '/users',
+                expect_json_has=['users[1].name', 'users[*].messages'],
+                expect_json_data={'users[0]': {'name': 'alice'},
+                                  'users[0].messages[-1]': 'there',
+                                  'users[*].name': ['alice', 'bob'],
+                                  'users[*].messages': [['hi', 'there'],
+                                                        []],
+                                  'users[*].age': []})
+            eq_(1, loads.call_count)
+        eq_('bob', response.viewunit_json['users'][1]['name'])
+
+    def test_json_failures(self):
+        try:
+            self.run_view('/users', expect_json_has=['users[2]'])
+            ok_(False, "Expected AssertionError for a missing selector")
+        except AssertionError, exc:
+            eq_("Couldn't find 'users[2]' in json", str(exc))
+
+        try:
+            self.run_view('/users',
+                          expect_json_data={'users[*].name': 'alice',
+                                            'users[0].messages': ['hi'],
+                                            'users[5]': {}})
+            ok_(False, "Expected AssertionError for wrong json data")
+        except AssertionError, exc:
+            eq_([('users', 0, 'messages'), ('users', 1, 'name'),
+                 ('users', 5)],
+                sorted(mismatch.path for mismatch in exc.mismatches))
+            ok_("json.users[1].name: expected 'alice', found u'bob'"
+                in str(exc), str(exc))
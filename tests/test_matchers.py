@@ -0,0 +1,93 @@
+from nose.tools import eq_, ok_
+
+from flask.ext.viewunit import matchers
+from flask.ext.viewunit.matchers import Mismatch
+from app_test import ViewTestCase
+
+
+class User(object):
+    """
+    An object whose attributes and methods expects can look at
+    """
+    name = 'alice'
+
+    def greeting(self):
+        return 'hi ' + self.name
+
+
+class Row(object):
+    """
+    A value object with __eq__ but no __ne__, like many ORM rows
+    """
+
+    def __init__(self, row_id):
+        self.row_id = row_id
+
+    def __eq__(self, other):
+        return isinstance(other, Row) and other.row_id == self.row_id
+
+
+class MatcherTest(ViewTestCase):
+    """
+    Tests for compiled containment matchers.
+    """
+
+    def test_diff(self):
+        actual = {'user': User(), 'rows': [{'id': 1}, {'id': 2}],
+                  'items': 'not dict.items', 'extra': 1}
+        eq_([], matchers.diff({'user': {'name': 'alice',
+                                        'greeting': 'hi alice'},
+                               'rows': [{'id': 1}, {}]}, actual))
+        # As ever, attributes (like dict.items) win over keys
+        eq_([('items',)], [mismatch.path for mismatch in matchers.diff(
+            {'items': 'not dict.items'}, actual)])
+
+        mismatches = matchers.diff({'user': {'name': 'bob', 'age': 3},
+                                    'rows': [{'id': 2}],
+                                    'missing': None}, actual)
+        eq_(sorted([(('user', 'name'), 'unequal', 'bob', 'alice'),
+                    (('user', 'age'), 'no_attr'),
+                    (('rows',), 'length', 1),
+                    (('rows', 0, 'id'), 'unequal', 2, 1),
+                    (('missing',), 'missing')]),
+            sorted(mismatch[:{'unequal': 4, 'length': 3}.get(mismatch.kind,
+                                                              2)]
+                   for mismatch in mismatches))
+
+    def test_eq_only(self):
+        eq_([], matchers.diff({'r': Row(1), 'rows': [Row(2)]},
+                              {'r': Row(1), 'rows': [Row(2)]}))
+        eq_(['unequal'], [mismatch.kind for mismatch in
+                          matchers.diff({'r': Row(1)}, {'r': Row(2)})])
+
+    def test_compiled_once(self):
+        spec = {'a': [1, {'b': 2}]}
+        matcher = matchers.compile_expectation(spec)
+        ok_(matcher is matchers.compile_expectation({'a': [1, {'b': 2}]}))
+        ok_(matcher is not matchers.compile_expectation({'a': [1, {'b': 3}]}))
+        # Unhashable values still work
+        eq_([], matchers.diff({'a': set([1])}, {'a': set([1])}))
+
+    def test_describe(self):
+        eq_("tmpl_data.a[1].b: expected 2, found 3",
+            matchers.describe('tmpl_data',
+                              [Mismatch(('a', 1, 'b'), 'unequal', 2, 3)]))
+        eq_("session_data didn't match (2 differences):\n"
+            "  session_data.x: missing key\n"
+            "  session_data.y: expected a list of 1, found 2:\n"
+            "      [1, 2]",
+            matchers.describe('session_data',
+                              [Mismatch(('x',), 'missing', None, {}),
+                               Mismatch(('y',), 'length', 1, [1, 2])]))
+
+    def test_run_view_reports_every_mismatch(self):
+        try:
+            self.run_view('/?letter=a', user_id=3,
+                          expect_tmpl_data={'magic_letter': 'b',
+                                            'user_name': 'user #4'})
+            ok_(False, "Expected AssertionError for wrong tmpl data")
+        except AssertionError, exc:
+            eq_([('magic_letter',), ('user_name',)],
+                sorted(mismatch.path for mismatch in exc.mismatches))
+            ok_(str(exc).startswith(
+                "tmpl_data didn't match (2 differences):"), str(exc))
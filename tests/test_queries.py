@@ -0,0 +1,101 @@
+import sqlite3
+
+from nose.tools import eq_, ok_
+
+from flask.ext.viewunit import config, normalize_sql, viewunit
+import app as app_module
+from app_test import ViewTestCase
+
+
+class QueryTest(ViewTestCase):
+    """
+    Tests for query counting expectations.
+    """
+
+    def dbSetUp(self):
+        conn = sqlite3.connect(app_module.DB_FILE)
+        with conn:
+            conn.executemany("INSERT INTO users (id, name) VALUES (?, ?)",
+                             [(1, 'alice'), (2, 'bob'), (3, 'carol')])
+            conn.executemany("INSERT INTO messages (user_id, body) "
+                             "VALUES (?, ?)",
+                             [(1, 'hi'), (1, 'there'), (3, 'yo')])
+        conn.close()
+
+    def dbTearDown(self):
+        conn = sqlite3.connect(app_module.DB_FILE)
+        with conn:
+            conn.execute("DELETE FROM messages")
+            conn.execute("DELETE FROM users")
+        conn.close()
+
+    def test_max_queries(self):
+        response = self.run_view('/users?join=1', expect_max_queries=1,
+                                 expect_db_has=[('users', {'name': 'bob'})])
+        eq_(1, len(response.viewunit_queries))
+
+        try:
+            self.run_view('/users', expect_max_queries=2)
+            ok_(False, "Expected AssertionError for too many queries")
+        except AssertionError, exc:
+            lines = str(exc).splitlines()
+            eq_("Expected at most 2 queries, found 4:", lines[0])
+            eq_("  SELECT id, name FROM users ORDER BY id", lines[1])
+
+    def test_no_repeated_queries(self):
+        self.run_view('/users?join=1', expect_no_repeated_queries=True)
+        self.run_view('/users', expect_no_repeated_queries=3)
+        try:
+            self.run_view('/users', expect_no_repeated_queries=1)
+            ok_(False, "Expected AssertionError for repeated queries")
+        except AssertionError, exc:
+            eq_("Found queries run more than 1 time(s):\n"
+                "  3x select body from messages where user_id = ? "
+                "order by id", str(exc))
+
+    def test_normalize_sql(self):
+        eq_("select * from t where a = ? and b in (?) and c = ?",
+            normalize_sql("SELECT *\n  FROM t WHERE a = 'it''s' "
+                          "AND b IN (1, 2, 3) AND c = %(c)s"))
+        eq_("select * from t where id in (?)",
+            normalize_sql("select * from t where id in (%s, %s)"))
+
+    def test_no_full_scans(self):
+        with config.override():
+            config.set_db_explain_dialect('sqlite')
+
+            # messages are looked up by index, but users are scanned
+            self.run_view('/users', expect_no_full_scans=['messages'])
+            try:
+                self.run_view('/users', expect_no_full_scans=True)
+                ok_(False, "Expected AssertionError for a full scan")
+            except AssertionError, exc:
+                eq_(["View ran full table scans:",
+                     "  SELECT id, name FROM users ORDER BY id",
+                     "    scans users:"],
+                    str(exc).splitlines()[:3])
+
+            # The join's plan only names users by its alias
+            try:
+                self.run_view('/users?join=1', expect_no_full_scans=['users'])
+                ok_(False, "Expected AssertionError for an aliased scan")
+            except AssertionError, exc:
+                ok_("    scans users:" in str(exc).splitlines(), str(exc))
+
+            config.set_full_scan_allowlist(['users'])
+            self.run_view('/users?join=1', expect_no_full_scans=True)
+
+    def test_scan_aliases(self):
+        sql = ('SELECT * FROM users u JOIN messages AS m ON m.user_id = u.id, '
+               '"groups" g, tags WHERE u.id IN (SELECT id FROM bans b)')
+        eq_({'u': 'users', 'm': 'messages', 'g': 'groups', 'b': 'bans'},
+            viewunit._table_aliases(sql))
+        eq_(['users', 'tags', 'messages'],
+            viewunit._scanned_tables('postgres',
+                                     ['Seq Scan on users u  (cost=1)',
+                                      'Seq Scan on tags  (cost=1)',
+                                      '  ->  Seq Scan on messages m'], sql))
+        eq_(['users', 'groups'],
+            viewunit._scanned_tables('sqlite',
+                                     ['SCAN u', 'SCAN TABLE groups AS g'],
+                                     sql))
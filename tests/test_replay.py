@@ -0,0 +1,108 @@
+import os
+import shutil
+import StringIO
+import tempfile
+
+import flask
+import mock
+from nose.tools import eq_, ok_
+
+from flask.ext.viewunit import config, replay
+from app import app
+from app_test import ViewTestCase
+
+
+class ReplayTest(ViewTestCase):
+    """
+    Tests for recording view tests' requests and replaying them as load.
+    """
+
+    def setUp(self):
+        super(ReplayTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.replay_file = os.path.join(self.directory, 'requests.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(ReplayTest, self).tearDown()
+
+    def record(self):
+        with config.override():
+            config.set_replay_file(self.replay_file)
+            self.run_view('/?letter=b', user_id=3)
+            self.run_view('/login', 'POST', data={'user_id': 4},
+                          expect_redir='/')
+            self.run_view_many([{'path': '/users', 'session': {'x': 1}}])
+        return replay.load(self.replay_file)
+
+    def test_record(self):
+        eq_([{'path': '/?letter=b', 'method': 'GET', 'session': None,
+              'data': None, 'user_id': 3, 'status': 200},
+             {'path': '/login', 'method': 'POST', 'session': None,
+              'data': {'user_id': 4}, 'user_id': None, 'status': 302},
+             {'path': '/users', 'method': 'GET', 'session': {'x': 1},
+              'data': None, 'user_id': None, 'status': 200}],
+            self.record())
+
+    def test_replay(self):
+        requests = self.record()
+        results = replay.replay(requests, duration=0.2, threads=3)
+        eq_(set([None, 'GET /', 'POST /login', 'GET /users']), set(results))
+        eq_(sum(results[route]['count'] for route in results if route),
+            results[None]['count'])
+        for stats in results.values():
+            ok_(stats['count'] > 0)
+            eq_(0, stats['errors'])
+            ok_(stats['min'] <= stats['p50'] <= stats['p95'] <=
+                stats['p99'] <= stats['max'])
+
+        out = StringIO.StringIO()
+        replay.report(results, out)
+        lines = out.getvalue().splitlines()
+        eq_(['route', 'count'], lines[0].split()[:2])
+        eq_('TOTAL', lines[-1].split()[0])
+
+    def test_errors(self):
+        def broken_users():
+            raise Exception("Broken")
+
+        requests = [{'path': '/users'}, {'path': '/', 'user_id': 3}]
+        with mock.patch.dict(app.view_functions, {'users': broken_users}):
+            results = replay.replay(requests, duration=0.2, threads=2)
+        eq_(1.0, results['GET /users']['error_rate'])
+        eq_(0.0, results['GET /']['error_rate'])
+
+    def test_status_changes(self):
+        def forbidden_users():
+            flask.abort(403)
+
+        requests = [{'path': '/users', 'status': 200},
+                    {'path': '/missing', 'status': 404},
+                    {'path': '/', 'status': 404}]
+        with mock.patch.dict(app.view_functions, {'users': forbidden_users}):
+            results = replay.replay(requests, duration=0.2, threads=2)
+        eq_(1.0, results['GET /users']['error_rate'])
+        eq_(0.0, results['GET /missing']['error_rate'])
+        eq_(1.0, results['GET /']['error_rate'])
+
+    def test_app_settings(self):
+        seen = []
+
+        def users():
+            seen.append((flask.current_app.testing,
+                         flask.current_app.config.get('CSRF_ENABLED')))
+            return 'ok'
+
+        # Outside a test, as from the command line
+        with mock.patch.dict(app.config,
+                             {'TESTING': False, 'CSRF_ENABLED': True}):
+            with mock.patch.dict(app.view_functions, {'users': users}):
+                replay.replay([{'path': '/users'}], duration=0.1, threads=1)
+            eq_((False, True), (app.testing, app.config['CSRF_ENABLED']))
+        eq_(set([(True, False)]), set(seen))
+
+    def test_processes(self):
+        results = replay.replay([{'path': '/'}], duration=0.2, threads=1,
+                                processes=2)
+        ok_(results['GET /']['count'] > 0)
+        ok_(results['GET /']['throughput'] > 0)
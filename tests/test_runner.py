@@ -0,0 +1,86 @@
+import StringIO
+import unittest
+
+from nose.tools import eq_, ok_
+
+from flask.ext.viewunit import config, runner
+from app_test import ViewTestCase
+import test_example
+
+
+class RunnerTest(unittest.TestCase):
+    """
+    Tests for the parallel runner. The suites run here are built from classes
+    defined inside the tests, so nose doesn't collect them itself.
+    """
+
+    def test_run_parallel(self):
+        class FailingTest(ViewTestCase):
+            def test_fails(self):
+                self.run_view('/', expect_tmpl='other.html')
+
+            def test_passes(self):
+                self.run_view('/', expect_tmpl='index.html')
+
+        suite = unittest.TestSuite([
+            test_example.ExampleTest('test_magic_letter'),
+            test_example.ExampleTest('test_user_id'),
+            unittest.TestLoader().loadTestsFromTestCase(FailingTest)])
+
+        stream = StringIO.StringIO()
+        result = runner.run_parallel(suite, processes=2, stream=stream)
+        eq_(4, result.testsRun)
+        eq_(1, len(result.failures))
+        eq_([], result.errors)
+        ok_(result.failures[0][0].id().endswith('FailingTest.test_fails'))
+        ok_("Expected tmpl to be 'other.html'" in result.failures[0][1])
+        ok_('FAILED (failures=1)' in stream.getvalue())
+
+    def test_per_worker_db_hook(self):
+        class WorkerDbTest(ViewTestCase):
+            def test_worker_db(self):
+                eq_([('worker', 0)], self.db_select('SELECT 1', []))
+
+        def db_select_factory(number):
+            return lambda _sql, _params: [('worker', number)]
+
+        suite = unittest.TestLoader().loadTestsFromTestCase(WorkerDbTest)
+        result = runner.run_parallel(suite, processes=1,
+                                     setup=lambda: config.set_app(
+                                         config.get_app()),
+                                     db_select_factory=db_select_factory,
+                                     stream=StringIO.StringIO())
+        ok_(result.wasSuccessful(), result.failures + result.errors)
+
+    def test_worker_setup(self):
+        class WorkerSetupTest(ViewTestCase):
+            def test_worker_hooks(self):
+                eq_([('worker', 0)], self.db_select('SELECT 1', []))
+                eq_(('worker', 0), config.get_db_execute_hook()('', []))
+
+        def worker_setup(number):
+            config.set_db_select_hook(
+                lambda _sql, _params: [('worker', number)])
+            config.set_db_execute_hook(
+                lambda _sql, _params: ('worker', number))
+
+        suite = unittest.TestLoader().loadTestsFromTestCase(WorkerSetupTest)
+        result = runner.run_parallel(suite, processes=1,
+                                     worker_setup=worker_setup,
+                                     stream=StringIO.StringIO())
+        ok_(result.wasSuccessful(), result.failures + result.errors)
+
+    def test_not_a_test(self):
+        class HelperTest(ViewTestCase):
+            __test__ = False
+
+            def test_helper(self):
+                ok_(False, "Helper classes shouldn't run")
+
+        suite = unittest.TestSuite([
+            test_example.ExampleTest('test_magic_letter'),
+            unittest.TestLoader().loadTestsFromTestCase(HelperTest)])
+        result = runner.run_parallel(suite, processes=1,
+                                     stream=StringIO.StringIO())
+        eq_(1, result.testsRun)
+        ok_(result.wasSuccessful(), result.failures + result.errors)
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+
+import mock
+from nose.tools import eq_, ok_
+
+from flask.ext.viewunit import config, snapshots
+from app_test import ViewTestCase
+
+
+class Point(object):
+    """
+    An object to snapshot
+    """
+
+    def __init__(self, x):
+        self.x = x
+
+
+class SnapshotTest(ViewTestCase):
+    """
+    Tests for golden response snapshots.
+    """
+
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        snapshots._STORES.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        snapshots._STORES.clear()
+        super(SnapshotTest, self).tearDown()
+
+    def test_snapshots(self):
+        with config.override():
+            config.set_snapshot_store(self.directory)
+            self.run_view('/?letter=a', user_id=3, expect_snapshot=True)
+            self.run_view('/?letter=a', user_id=3, expect_snapshot='index')
+            self.run_view('/?letter=a', user_id=3, expect_snapshot=True)
+            eq_(['blobs.pack', 'index.json'],
+                sorted(os.listdir(self.directory)))
+            # Both snapshots share a blob
+            store = snapshots._store(self.directory)
+            eq_(1, len(store._load()['blobs']))
+            prefix = ('test_snapshots.SnapshotTest.test_snapshots:'
+                      'GET /?letter=a')
+            eq_(['index', prefix + ' #1', prefix + ' #2'],
+                sorted(store._load()['snapshots']))
+
+            # A fresh store only reads the index when it's first used
+            snapshots._STORES.clear()
+            store = snapshots._store(self.directory)
+            eq_(None, store._index)
+            self.run_view('/?letter=a', user_id=3, expect_snapshot='index')
+            ok_(store._index is not None)
+
+    def test_without_fcntl(self):
+        with config.override():
+            config.set_snapshot_store(self.directory)
+            with mock.patch.object(snapshots, 'fcntl', None):
+                self.run_view('/', expect_snapshot='index')
+                self.run_view('/?letter=a', expect_snapshot='other')
+            eq_(2, len(snapshots._store(self.directory)._load()['blobs']))
+
+    def test_same_path_twice(self):
+        with config.override():
+            config.set_snapshot_store(self.directory)
+            self.run_view('/', expect_snapshot=True)
+            self.run_view('/', user_id=5, expect_snapshot=True)
+            eq_(2, len(snapshots._store(self.directory)._load()['blobs']))
+
+    def test_mismatch(self):
+        with config.override():
+            config.set_snapshot_store(self.directory)
+            self.run_view('/?letter=a', expect_snapshot='index')
+            try:
+                self.run_view('/?letter=b', expect_snapshot='index')
+                ok_(False, "Expected AssertionError for a changed response")
+            except AssertionError, exc:
+                message = str(exc)
+                ok_(message.startswith(
+                    "Response doesn't match snapshot index:\n"
+                    "  body:\n"), message)
+                ok_("    -This page is brought to you by the letter a.\n"
+                    "    +This page is brought to you by the letter b.\n"
+                    in message, message)
+                ok_(message.endswith(
+                    '\n  tmpl_data.magic_letter: "b", was "a"'), message)
+
+            with mock.patch.dict(os.environ,
+                                 {'VIEWUNIT_UPDATE_SNAPSHOTS': '1'}):
+                self.run_view('/?letter=b', expect_snapshot='index')
+            self.run_view('/?letter=b', expect_snapshot='index')
+
+    def test_normalize(self):
+        eq_({'a': [1, u'x', {'__class__': 'Point', 'x': [u'2']}],
+             '(1, 2)': [1, 2], 'f': '<function <lambda>>'},
+            snapshots.normalize({'a': (1, 'x', Point(set(['2']))),
+                                 (1, 2): frozenset([2, 1]),
+                                 'f': lambda: None}))
+        eq_(['extra: added 1', 'users: 1 items, was 2',
+             'users[0].name: "bob", was "al"'],
+            snapshots.diff({'users': [{'name': 'al'}, {}]},
+                           {'users': [{'name': 'bob'}], 'extra': 1}))
@@ -0,0 +1,78 @@
+import json
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_, ok_
+
+from app_test import ViewTestCase
+
+
+SPECS = [
+    {'path': '/?letter=a', 'expect_tmpl_data': {'magic_letter': 'a'}},
+    {'path': '/', 'user_id': 3, 'expect_tmpl_data': {'user_name': 'user #3'}},
+    {'name': 'login', 'path': '/login', 'method': 'POST',
+     'data': {'user_id': 4}, 'expect_redir': '/'},
+    # Cookies from the login above don't carry over
+    {'path': '/', 'expect_tmpl_data': {'user_name': 'new user'}},
+]
+
+
+class RunViewManyTest(ViewTestCase):
+    """
+    Tests for table-driven view tests.
+    """
+
+    def setUp(self):
+        super(RunViewManyTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(RunViewManyTest, self).tearDown()
+
+    def test_specs(self):
+        responses = self.run_view_many(SPECS)
+        eq_([200, 200, 302, 200], [r.status_code for r in responses])
+
+    def test_failures_are_aggregated(self):
+        specs = [
+            {'path': '/?letter=a', 'expect_tmpl_data': {'magic_letter': 'b'}},
+            {'path': '/', 'expect_tmpl': 'index.html'},
+            {'name': 'wrong user', 'path': '/', 'user_id': 3,
+             'expect_tmpl_data': {'user_name': 'user #4'}},
+        ]
+        try:
+            self.run_view_many(specs)
+            ok_(False, "Expected AssertionError for failing specs")
+        except AssertionError, exc:
+            lines = str(exc).splitlines()
+            eq_("2 of 3 view specs failed:", lines[0])
+            ok_(lines[1].startswith("spec #0 (GET /?letter=a): "), lines[1])
+            ok_(lines[2].startswith("wrong user: "), lines[2])
+
+    def test_bad_expect_names_fail_up_front(self):
+        calls = []
+        self.on_teardown(lambda: eq_([], calls))
+        try:
+            self.run_view_many([
+                {'path': '/', 'expect_response': [calls.append]},
+                {'path': '/', 'expect_nothing': 1}])
+            ok_(False, "Expected an exception for an unknown expect")
+        except Exception, exc:
+            eq_("List of expects has unknown key: expect_nothing", str(exc))
+
+    def test_json_file(self):
+        filename = os.path.join(self.directory, 'specs.json')
+        with open(filename, 'w') as spec_file:
+            json.dump(SPECS, spec_file)
+        eq_(4, len(self.run_view_many(filename)))
+
+    def test_csv_file(self):
+        filename = os.path.join(self.directory, 'specs.csv')
+        with open(filename, 'w') as spec_file:
+            spec_file.write(
+                'path,method,user_id,expect_tmpl_data\n'
+                '/?letter=q,,,"{""magic_letter"": ""q""}"\n'
+                '/,GET,7,"{""user_name"": ""user #7""}"\n')
+        eq_(2, len(self.run_view_many(filename)))
@@ -0,0 +1,85 @@
+from nose.tools import eq_, ok_
+
+from app_test import ViewTestCase
+
+
+class StreamingTest(ViewTestCase):
+    """
+    Tests for running views that stream their responses.
+    """
+
+    def test_stream(self):
+        chunks = []
+        response = self.run_view('/export?rows=3', stream=True,
+                                 expect_chunks=chunks.append,
+                                 expect_max_ttfb_ms=10000,
+                                 expect_header_data={
+                                     'Content-Type': 'text/csv; '
+                                                     'charset=utf-8'})
+        eq_(['id,name\n', '0,row 0\n', '1,row 1\n', '2,row 2\n'], chunks)
+        stats = response.viewunit_stream
+        eq_(4, stats['chunks'])
+        eq_(len(''.join(chunks)), stats['bytes'])
+        eq_(8, stats['max_chunk_bytes'])
+        ok_(0 <= stats['ttfb_ms'] <= response.viewunit_timings['request'] +
+            response.viewunit_timings['stream'])
+
+    def test_large_stream(self):
+        rows = []
+
+        def count_rows(chunk):
+            rows.append(chunk.count('\n'))
+
+        response = self.run_view('/export?rows=100000', stream=True,
+                                 expect_chunks=[count_rows])
+        eq_(100001, sum(rows))
+        ok_(response.viewunit_stream['bytes'] > 1000000)
+        ok_(response.viewunit_stream['max_chunk_bytes'] < 100)
+
+    def test_stops_early(self):
+        chunks = []
+        try:
+            self.run_view('/export?rows=1000', stream=True,
+                          expect_chunks=chunks.append,
+                          expect_max_ttfb_ms=0)
+            ok_(False, "Expected AssertionError for a slow first byte")
+        except AssertionError, exc:
+            ok_(str(exc).startswith("Expected first byte within 0.0 ms, "
+                                    "took "), str(exc))
+        eq_([], chunks)
+
+        def no_row_500(chunk):
+            ok_(not chunk.startswith('500,'), "Found row 500")
+            chunks.append(chunk)
+
+        try:
+            self.run_view('/export?rows=1000', stream=True,
+                          expect_chunks=no_row_500)
+            ok_(False, "Expected AssertionError from expect_chunks")
+        except AssertionError, exc:
+            eq_("Found row 500", str(exc))
+        eq_(501, len(chunks))
+
+    def test_stream_expects(self):
+        for expects in [{'expect_chunks': []},
+                        {'expect_max_ttfb_ms': 100}]:
+            try:
+                self.run_view('/export', **expects)
+                ok_(False, "Expected an exception without stream=True")
+            except AssertionError:
+                raise
+            except Exception, exc:
+                ok_(str(exc).endswith("needs stream=True"), str(exc))
+
+        try:
+            self.run_view('/export', stream=True, expect_json={})
+            ok_(False, "Expected an exception for expect_json")
+        except AssertionError:
+            raise
+        except Exception, exc:
+            eq_("expect_json needs the whole response body, so can't be "
+                "used with stream=True", str(exc))
+
+        # Well formed checks are skipped, unless asked for
+        self.run_view('/', stream=True, expect_tmpl='index.html',
+                      expect_max_ms=10000)
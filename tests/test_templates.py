@@ -0,0 +1,87 @@
+import mock
+from nose.tools import eq_, ok_
+
+from flask.ext.viewunit import template_called
+from app import app
+from app_test import ViewTestCase
+
+
+class TemplateDataTest(ViewTestCase):
+    """
+    Tests for the template data views pass to their templates.
+    """
+
+    def test_search_list(self):
+        class Exploding(dict):
+            """
+            A dict whose values mustn't be looked at
+            """
+            def __getitem__(self, key):
+                raise AssertionError("Looked up %s" % key)
+
+        search_list = [{'user_name': 'alice', 'rows': []},
+                       {'user_name': 'hidden', 'magic_letter': 'q'},
+                       Exploding(big=1)]
+
+        def search_list_index():
+            template_called('index.html', search_list)
+            return 'ok'
+
+        with mock.patch.dict(app.view_functions,
+                             {'index': search_list_index}):
+            response = self.run_view(
+                '/', expect_tmpl_data={'user_name': 'alice', 'rows': []},
+                expect_tmpl_has=['magic_letter'],
+                expect_tmpl_lacks=['other'],
+                expect_well_formed=False)
+
+        data = response.template_data
+        eq_('q', data['magic_letter'])
+        eq_(['big', 'magic_letter', 'rows', 'user_name'], sorted(data))
+        eq_(4, len(data))
+        ok_('big' in data)
+        ok_(not hasattr(data, '__setitem__'))
+
+    def test_all_templates(self):
+        response = self.run_view('/letters?letters=xyz',
+                                 expect_tmpl='letter.html',
+                                 expect_tmpl_data={'letter': 'x'},
+                                 expect_tmpls=['letter.html'] * 3 +
+                                 ['letters.html'],
+                                 expect_max_render_ms={'letters.html': 10000},
+                                 expect_well_formed=True)
+        templates = response.viewunit_templates
+        eq_(['x', 'y', 'z'], [tmpl.data['letter'] for tmpl in templates[:3]])
+        ok_(all(tmpl.ms >= 0 for tmpl in templates))
+        eq_(3, len(templates[3].data['fragments']))
+
+        try:
+            self.run_view('/letters', expect_tmpls=['letters.html'])
+            ok_(False, "Expected AssertionError for the wrong templates")
+        except AssertionError, exc:
+            ok_(str(exc).startswith("Expected tmpls to be ['letters.html'], "
+                                    "found ['letter.html', 'letter.html', "
+                                    "'letters.html']"), str(exc))
+
+        try:
+            self.run_view('/letters', expect_max_render_ms=0)
+            ok_(False, "Expected AssertionError for a slow render")
+        except AssertionError, exc:
+            ok_(str(exc).startswith("Expected tmpl 'letter.html' to render "
+                                    "in at most 0.0 ms, took "), str(exc))
+
+    def test_untimed_templates(self):
+        def untimed_index():
+            template_called('index.html', {})
+            return 'ok'
+
+        with mock.patch.dict(app.view_functions, {'index': untimed_index}):
+            response = self.run_view('/', expect_tmpls=['index.html'],
+                                     expect_well_formed=False)
+            eq_(None, response.viewunit_templates[0].ms)
+            try:
+                self.run_view('/', expect_max_render_ms=100,
+                              expect_well_formed=False)
+                ok_(False, "Expected AssertionError without render times")
+            except AssertionError, exc:
+                ok_("viewunit.record_templates()" in str(exc), str(exc))
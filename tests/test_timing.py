@@ -0,0 +1,208 @@
+import json
+import os
+import pstats
+import shutil
+import sqlite3
+import StringIO
+import tempfile
+import threading
+
+import mock
+from nose.tools import eq_, ok_
+
+from flask.ext.viewunit import config, ledger, percentile
+from app import app, index
+from app_test import ViewTestCase
+
+
+class TimingTest(ViewTestCase):
+    """
+    Tests for run_view's timing breakdown and profiling.
+    """
+
+    def test_timings(self):
+        response = self.run_view('/', user_id=1)
+        eq_(['session', 'request', 'tmpl_data', 'request_vars', 'form_errors',
+             'db', 'flashes', 'json', 'response', 'well_formed',
+             'full_scans'],
+            response.viewunit_timings.keys())
+        ok_(all(ms >= 0 for ms in response.viewunit_timings.values()))
+        eq_(None, response.viewunit_profile)
+
+    def test_profile(self):
+        directory = tempfile.mkdtemp()
+        try:
+            response = self.run_view('/', profile=directory)
+            eq_(os.path.join(directory, self.id() + '.1.prof'),
+                response.viewunit_profile)
+            stats = pstats.Stats(response.viewunit_profile)
+            ok_(any(func[2] == 'index' for func in stats.stats))
+
+            with mock.patch.dict(os.environ,
+                                 {'VIEWUNIT_PROFILE_DIR': directory}):
+                response = self.run_view('/')
+            eq_(os.path.join(directory, self.id() + '.2.prof'),
+                response.viewunit_profile)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_max_ms(self):
+        self.run_view('/', expect_max_ms=10000)
+        try:
+            self.run_view('/', expect_max_ms=0)
+            ok_(False, "Expected AssertionError for a slow request")
+        except AssertionError, exc:
+            ok_(str(exc).startswith(
+                "Expected request to take at most 0.0 ms, took "), str(exc))
+
+    def test_p95_ms(self):
+        requests = []
+
+        def counting_index():
+            requests.append(1)
+            return index()
+
+        with mock.patch.dict(app.view_functions, {'index': counting_index}):
+            self.run_view('/', expect_p95_ms=(10000, 5))
+        eq_(5, len(requests))
+
+        try:
+            self.run_view('/', expect_p95_ms=0)
+            ok_(False, "Expected AssertionError for a slow request")
+        except AssertionError, exc:
+            ok_(str(exc).startswith("Expected p95 request time of at most "
+                                    "0.0 ms, found "), str(exc))
+            ok_(" over 20 runs " in str(exc), str(exc))
+
+    def test_percentile(self):
+        eq_(5, percentile(range(1, 11), 50))
+        eq_(10, percentile(range(1, 11), 95))
+        eq_(1, percentile([1], 0))
+
+
+class BenchmarkTest(ViewTestCase):
+    """
+    Tests for benchmark_view and its baselines.
+    """
+
+    def setUp(self):
+        super(BenchmarkTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.baseline_file = os.path.join(self.directory, 'baselines.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(BenchmarkTest, self).tearDown()
+
+    def test_stats(self):
+        stats = self.benchmark_view('/', rounds=10, warmup=2,
+                                    expect_tmpl='index.html')
+        eq_(10, stats['rounds'])
+        ok_(stats['min'] <= stats['median'] <= stats['p95'] <= stats['max'])
+        ok_(stats['ops_per_sec'] > 0)
+
+    def test_baseline(self):
+        with config.override():
+            config.set_benchmark_baseline_file(self.baseline_file, 0.5)
+            first = self.benchmark_view('/', rounds=5, warmup=0)
+            with open(self.baseline_file) as baseline_file:
+                baselines = json.load(baseline_file)
+            eq_({self.id() + ':GET /': first}, baselines)
+
+            # Pretend the view used to be much faster
+            baselines[self.id() + ':GET /']['median'] = first['median'] / 10
+            with open(self.baseline_file, 'w') as baseline_file:
+                json.dump(baselines, baseline_file)
+            try:
+                self.benchmark_view('/', rounds=5, warmup=0)
+                ok_(False, "Expected AssertionError for a regression")
+            except AssertionError, exc:
+                ok_(str(exc).startswith(
+                    "Benchmark %s:GET / regressed: median " % self.id()),
+                    str(exc))
+
+            with mock.patch.dict(os.environ,
+                                 {'VIEWUNIT_UPDATE_BENCHMARKS': '1'}):
+                updated = self.benchmark_view('/', rounds=5, warmup=0)
+            with open(self.baseline_file) as baseline_file:
+                eq_(updated, json.load(baseline_file)[self.id() + ':GET /'])
+
+    def test_parallel_baselines(self):
+        def record(number):
+            with config.override(**settings):
+                for key in range(5):
+                    self._check_benchmark_baseline(
+                        'test %d.%d' % (number, key), {'median': 1.0})
+
+        with config.override():
+            config.set_benchmark_baseline_file(self.baseline_file)
+            settings = config.snapshot()
+            threads = [threading.Thread(target=record, args=(number,))
+                       for number in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        with open(self.baseline_file) as baseline_file:
+            eq_(40, len(json.load(baseline_file)))
+
+
+class LedgerTest(ViewTestCase):
+    """
+    Tests for the latency ledger.
+    """
+
+    def setUp(self):
+        super(LedgerTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.ledger_file = os.path.join(self.directory, 'ledger.db')
+
+    def tearDown(self):
+        ledger.flush()
+        shutil.rmtree(self.directory)
+        super(LedgerTest, self).tearDown()
+
+    def run_views(self):
+        with config.override():
+            config.set_latency_ledger(self.ledger_file)
+            self.run_view('/', user_id=1)
+            self.run_view('/users')
+            self.run_view('/nonexistent')
+        ledger.flush()
+
+    def test_records(self):
+        self.run_views()
+        conn = sqlite3.connect(self.ledger_file)
+        rows = conn.execute("SELECT run, rule, method, status, template "
+                            "FROM records ORDER BY rowid").fetchall()
+        conn.close()
+        eq_([(ledger.RUN, '/', 'GET', 200, 'index.html'),
+             (ledger.RUN, '/users', 'GET', 200, None),
+             (ledger.RUN, None, 'GET', 404, None)], rows)
+
+        # Nothing is recorded without a ledger configured
+        self.run_view('/')
+        eq_([], ledger._BUFFER)
+
+    def test_report(self):
+        with mock.patch.object(ledger, 'RUN', 'first'):
+            self.run_views()
+        with mock.patch.object(ledger, 'RUN', 'second'):
+            with config.override():
+                config.set_latency_ledger(self.ledger_file)
+                self.run_view('/', user_id=1)
+                self.run_view('/', user_id=1)
+            ledger.flush()
+
+        out = StringIO.StringIO()
+        ledger.report(self.ledger_file, top=1, out=out)
+        lines = out.getvalue().splitlines()
+        eq_("Run second: 2 requests to 1 routes, compared with run first",
+            lines[0])
+        eq_("Slowest endpoints (by p95):", lines[2])
+        ok_(lines[3].endswith(" ms  GET /"), lines[3])
+        ok_(lines[5].split()[:2] == ['route', 'count'], lines[5])
+        ok_(lines[6].split()[:2] == ['GET', '/'], lines[6])
+        ok_(lines[6].endswith('%'), lines[6])
+        eq_(["Routes not requested in this run:", "  GET /users",
+             "  GET None"], lines[8:])
@@ -0,0 +1,72 @@
+import sqlite3
+import unittest
+
+from nose.tools import eq_, ok_
+
+from flask.ext import viewunit
+import app as app_module
+from app_test import ViewTestCase
+
+
+def count_users():
+    """
+    Count the committed rows in the users table
+    """
+    conn = sqlite3.connect(app_module.DB_FILE)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    finally:
+        conn.close()
+
+
+class TransactionalTest(ViewTestCase):
+    """
+    Tests for running tests in a transaction that's rolled back.
+    """
+    transactional = True
+
+    def dbSetUp(self):
+        viewunit.get_test_connection().executemany(
+            "INSERT INTO users (id, name) VALUES (?, ?)",
+            [(1, 'alice'), (2, 'bob')])
+
+    def dbTearDown(self):
+        ok_(False, "dbTearDown shouldn't run for transactional tests")
+
+    def test_views_share_the_transaction(self):
+        self.run_view('/users?join=1',
+                      expect_db_has=[('users', {'name': 'bob'})],
+                      expect_db_lacks=[('users', {'name': 'eve'})],
+                      expect_json={'users': [
+                          {'name': 'alice', 'messages': []},
+                          {'name': 'bob', 'messages': []}]})
+        # Nothing is committed
+        eq_(0, count_users())
+
+    def test_app_cannot_end_the_transaction(self):
+        conn = app_module.connect()
+        conn.execute("INSERT INTO users (id, name) VALUES (3, 'carol')")
+        conn.commit()
+        conn.close()
+        eq_(3, len(self.db_select("SELECT * FROM users", [])))
+
+        # An app's rollback keeps the fixtures
+        conn.rollback()
+        eq_([(1,), (2,)], self.db_select("SELECT id FROM users", []))
+
+
+class RollbackTest(unittest.TestCase):
+    """
+    Tests that transactional tests leave the database as they found it.
+    """
+
+    def test_rollback(self):
+        result = unittest.TestResult()
+        unittest.TestSuite(
+            [TransactionalTest('test_views_share_the_transaction'),
+             TransactionalTest('test_app_cannot_end_the_transaction')]
+        ).run(result)
+        eq_([], result.failures + result.errors)
+        eq_(2, result.testsRun)
+        eq_(0, count_users())
+        eq_(None, viewunit.get_test_connection())
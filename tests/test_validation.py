@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+
+import mock
+from nose.tools import eq_, ok_
+
+from flask.ext.viewunit import config, validation
+from app_test import ViewTestCase
+
+
+GOOD_PAGE = ("<!DOCTYPE html><html><head><title>Fine</title></head>"
+             "<body><p>Fine</p></body></html>")
+BAD_PAGE = "<!DOCTYPE html><html><body><p>Oops</b></p></body></html>"
+
+# Pages the validators must agree on, some of which lxml accepts
+CORPUS = [
+    GOOD_PAGE,
+    BAD_PAGE,
+    GOOD_PAGE.replace('<p>Fine</p>', '<div><p>Fine</p>'),
+    GOOD_PAGE.replace('<p>Fine</p>', '<p/>'),
+    GOOD_PAGE.replace('<p>Fine</p>',
+                      '<table><div>x</div><tr><td>1</td></tr></table>'),
+    GOOD_PAGE.replace('<p>Fine</p>',
+                      '<table><tbody><tr><td>1</td></tr></tbody></table>'),
+    GOOD_PAGE.replace('<p>Fine</p>', '<p>a<p>b</p>'),
+    GOOD_PAGE.replace('<p>Fine</p>', '<li>loose</li>'),
+    GOOD_PAGE.replace('<p>Fine</p>', '<p class="a" class="b">x</p>'),
+    GOOD_PAGE.replace('<p>Fine</p>', '<p>&nosuch; &amp;</p>'),
+    GOOD_PAGE.replace('<p>Fine</p>', '<ul><li>a<li>b</ul>'),
+    GOOD_PAGE.replace('<!DOCTYPE html>', ''),
+    GOOD_PAGE.replace('<p>Fine</p>', '<!-- a ---><p>Fine</p>'),
+    GOOD_PAGE.replace('<p>Fine</p>', '<!--a---><!-- ok --><p>Fine</p>'),
+]
+
+
+class WellFormedTest(ViewTestCase):
+    """
+    Tests for expect_well_formed and its result cache.
+    """
+
+    def test_malformed_page(self):
+        try:
+            self.run_view('/malformed')
+            ok_(False, "Expected AssertionError for a malformed page")
+        except AssertionError, exc:
+            ok_(str(exc).startswith('Template None is not well formed'),
+                str(exc))
+
+        self.run_view('/malformed', expect_well_formed=False)
+
+    def test_fast_validator(self):
+        ok_(validation._prescreen(GOOD_PAGE))
+        ok_(not validation._prescreen(BAD_PAGE))
+
+        for page in CORPUS:
+            eq_(validation.check_html(page), validation.fast_check_html(page))
+
+        # The lenient validator only ever passes more pages
+        for page in CORPUS:
+            if validation.check_html(page) is None:
+                eq_(None, validation.lenient_check_html(page))
+        eq_(validation.check_html(BAD_PAGE),
+            validation.lenient_check_html(BAD_PAGE))
+        with mock.patch.object(validation, 'etree', None):
+            for page in CORPUS:
+                eq_(validation.check_html(page),
+                    validation.lenient_check_html(page))
+
+        config.set_html_validator(validation.fast_check_html)
+        try:
+            self.run_view('/')
+            try:
+                self.run_view('/malformed')
+                ok_(False, "Expected AssertionError for a malformed page")
+            except AssertionError, exc:
+                eq_('Template None is not well formed %s - %s line: %s' %
+                    validation.check_html(BAD_PAGE), str(exc))
+        finally:
+            config.set_html_validator(None)
+
+    def test_cache_hit_skips_parse(self):
+        body = BAD_PAGE + "<!-- %s -->" % self.id()
+        expected = validation.check_html(body)
+        ok_(expected is not None)
+
+        with mock.patch.object(validation, 'check_html',
+                               wraps=validation.check_html) as check:
+            eq_(expected, validation.check_html_cached(body))
+            eq_(expected, validation.check_html_cached(body))
+            eq_(1, check.call_count)
+
+    def test_disk_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'cache')
+            config.set_well_formed_cache_file(path, max_entries=2)
+
+            for i in range(3):
+                validation.check_html_cached(GOOD_PAGE + "<!-- %s -->" % i)
+            eq_(validation.check_html(BAD_PAGE),
+                validation.check_html_cached(BAD_PAGE))
+            validation.get_cache().flush()
+
+            # A fresh cache reads results back from disk, least recently used
+            # entries having been evicted
+            cache = validation.ResultCache(path, 2)
+            eq_((True, validation.check_html(BAD_PAGE)),
+                cache.get(validation._cache_key(validation.check_html,
+                                                BAD_PAGE)))
+            eq_(2, cache._conn.execute(
+                "SELECT COUNT(*) FROM results").fetchone()[0])
+            cache.flush()
+        finally:
+            config.set_well_formed_cache_file(None)
+            validation.get_cache()
+            shutil.rmtree(directory)
+
+    def test_background_check(self):
+        config.set_well_formed_workers(2)
+        try:
+            # Neither run_view waits for its page to be parsed
+            self.run_view('/malformed')
+            self.run_view('/?letter=%s' % self.id())
+            try:
+                self._check_pending_well_formed()
+                ok_(False, "Expected AssertionError for a malformed page")
+            except AssertionError, exc:
+                eq_(1, len(str(exc).splitlines()))
+                ok_(str(exc).endswith('(/malformed)'), str(exc))
+            self._check_pending_well_formed()
+        finally:
+            config.set_well_formed_workers(None)